@@ -1,33 +1,168 @@
+import collections
+import functools
 import itertools
+import operator
 from collections import Counter
 
+from . import __version__
+from .seqfile import _decode_lines
+from .spacesaving import SpaceSavingCounter
+from .tablecache import cache_filepath, read_table, write_table
+
 
 class BarcodeAssigner(object):
+    """Assign reads to samples by looking up barcodes in a hash table.
+
+    The table lists every sequence within the allowed number of
+    mismatches. If cache_dir is given, the table is saved there and
+    loaded by later assigners with the same barcodes and settings.
+
+    Barcodes of unassigned reads are counted exactly, or if
+    max_unassigned is given, approximately in a table of that size.
+
+    If min_quality is given, bases in the index reads with a quality
+    score below min_quality are replaced by "N" before the lookup, and
+    mismatches are only allowed at these bases. The table then lists
+    each barcode with up to mismatches bases replaced by "N".
+
+    If classify_unassigned is True, barcodes of unassigned reads are
+    also sorted into categories by an UnassignedClassifier.
+    """
+
     allowed_mismatches = [0, 1, 2]
 
-    def __init__(self, samples, mismatches=0, revcomp=True):
+    def __init__(
+        self,
+        samples,
+        mismatches=0,
+        revcomp=True,
+        packed=False,
+        cache_dir=None,
+        max_unassigned=None,
+        min_quality=None,
+        classify_unassigned=False,
+    ):
         self.samples = samples
         if mismatches not in self.allowed_mismatches:
             raise ValueError(
                 "Only %s mismatches allowed (got %s)"
                 % (self.allowed_mismatches, mismatches)
             )
+        if (min_quality is not None) and not (0 <= min_quality <= MAX_QUALITY):
+            raise ValueError(
+                "Minimum quality must be from 0 to %s (got %s)"
+                % (MAX_QUALITY, min_quality)
+            )
         self.mismatches = mismatches
         self.revcomp = revcomp
+        self.packed = packed
+        self.max_unassigned = max_unassigned
+        self.min_quality = min_quality
+        self.classify_unassigned = classify_unassigned
+        # Whether each unassigned barcode seen is near a sample barcode
+        self._near_barcode = {}
+        self.reset_counts()
+        if cache_dir is None:
+            self._build_table()
+        else:
+            self._load_table(cache_dir)
+
+    def _build_table(self):
+        self._init_hash()
+        if self.packed:
+            self._barcodes = dict(
+                zip(pack_barcodes(list(self._barcodes)), self._barcodes.values())
+            )
+
+    def _load_table(self, cache_dir):
+        # Samples are saved as their position in the list of samples,
+        # which is fixed by the cache key.
+        fp = cache_filepath(
+            cache_dir,
+            __version__,
+            type(self).__name__,
+            self.mismatches,
+            self.revcomp,
+            self.packed,
+            self.min_quality is not None,
+            tuple((s.name, s.barcode) for s in self.samples),
+        )
+        table = read_table(fp)
+        if _is_valid_table(table, len(self.samples)):
+            keys, sample_idxs = table
+            self._barcodes = dict(zip(keys, map(self.samples.__getitem__, sample_idxs)))
+            return
+        self._build_table()
+        sample_idxs = dict((id(s), n) for n, s in enumerate(self.samples))
+        keys = list(self._barcodes)
+        idxs = [sample_idxs[id(s)] for s in self._barcodes.values()]
+        write_table(fp, (keys, idxs))
+
+    def reset_counts(self):
         # Sample names assumed to be unique after validating input data
         self.read_counts = dict((s.name, 0) for s in self.samples)
         self.read_counts["unassigned"] = 0
-        self.unassigned_counts = Counter()
-        self._init_hash()
+        self.unassigned_counts = unassigned_counter(self.max_unassigned)
+        # Reads assigned only because low-quality bases were masked,
+        # and reads within the mismatches of a barcode that were not
+        # assigned, because a mismatch was at a high-quality base
+        self.quality_counts = {"rescued": 0, "rejected": 0}
+        # Pairs of index sequences from different samples, found by
+        # DualIndexBarcodeAssigner
+        self.hopped_counts = Counter()
+        if not self.classify_unassigned:
+            self.unassigned_classes = None
+        elif getattr(self, "unassigned_classes", None) is None:
+            self.unassigned_classes = UnassignedClassifier(
+                self.samples,
+                list(map(self._sample_barcode, self.samples)),
+                self._max_mismatches() + 1,
+            )
+        else:
+            # The categories of barcodes seen so far are kept
+            self.unassigned_classes.reset_counts()
+
+    def _max_mismatches(self):
+        return self.mismatches
+
+    def merge_counts(
+        self,
+        read_counts,
+        unassigned_counts,
+        quality_counts=None,
+        hopped_counts=None,
+        class_counts=None,
+    ):
+        """Add counts from another assigner with the same samples."""
+        for sample_name, n in read_counts.items():
+            self.read_counts[sample_name] += n
+        self.unassigned_counts.update(unassigned_counts)
+        for key, n in (quality_counts or {}).items():
+            self.quality_counts[key] += n
+        self.hopped_counts.update(hopped_counts or {})
+        if class_counts is not None:
+            self.unassigned_classes.merge(class_counts)
+
+    def _count_unassigned(self, seqs, i1_length=None, class_seqs=None):
+        # Barcodes may be classified from other sequences than the ones
+        # counted, such as indexes already corrected by the assigner
+        self.unassigned_counts.update(seqs)
+        if self.unassigned_classes is not None:
+            if class_seqs is None:
+                class_seqs = seqs
+            self.unassigned_classes.add(class_seqs, i1_length)
+
+    def _sample_barcode(self, sample):
+        # Barcodes assumed to be present after validating input data
+        if self.revcomp:
+            return reverse_complement(sample.barcode)
+        else:
+            return sample.barcode
 
     def _init_hash(self):
         self._barcodes = {}
         for s in self.samples:
-            # Barcodes assumed to be present after validating input data
-            if self.revcomp:
-                bc = reverse_complement(s.barcode)
-            else:
-                bc = s.barcode
+            bc = self._sample_barcode(s)
 
             # Barcodes assumed to be unique after validating input data
             self._barcodes[bc] = s
@@ -44,14 +179,25 @@ class BarcodeAssigner(object):
                 else:
                     self._barcodes[error_bc] = s
 
-    def _error_barcodes(self, barcode):
+    def _error_barcodes(self, barcode, mismatches=None):
+        if mismatches is None:
+            mismatches = self.mismatches
         # If the number of mismatches is set to 0, there will be no
         # error barcodes. Immediately stop the iteration.
-        if self.mismatches == 0:
+        if mismatches == 0:
+            return
+        if self.min_quality is not None:
+            # Mismatches only at low-quality bases, which become "N"
+            for num_ns in range(1, mismatches + 1):
+                for idx_set in itertools.combinations(range(len(barcode)), num_ns):
+                    bc_ns = list(barcode)
+                    for idx in idx_set:
+                        bc_ns[idx] = "N"
+                    yield "".join(bc_ns)
             return
         # Each item in idx_sets is a set of indices where mismatches
         # should occur.
-        idx_sets = itertools.combinations(range(len(barcode)), self.mismatches)
+        idx_sets = itertools.combinations(range(len(barcode)), mismatches)
         for idx_set in idx_sets:
             # Change to list because strings are immutable
             bc_ns = list(barcode)
@@ -70,18 +216,692 @@ class BarcodeAssigner(object):
             for error_bc in deambiguate(bc_acgt):
                 yield error_bc
 
+    def _key(self, seq):
+        # Key for a barcode sequence in the hash table
+        if self.packed:
+            return pack_barcodes([seq])[0]
+        return seq
+
     def assign(self, seq):
-        sample = self._barcodes.get(seq)
+        sample = self._barcodes.get(self._key(seq))
+        if sample is None:
+            sample = self._search(seq)
         if sample is not None:
             self.read_counts[sample.name] += 1
         else:
             self.read_counts["unassigned"] += 1
-            self.unassigned_counts[seq] += 1
+            self._count_unassigned([seq])
         return sample
 
+    def _batch_keys(self, parts):
+        if self.packed:
+            return pack_barcodes(*parts)
+        return join_barcodes(*parts)
+
+    def assign_batch(self, *parts, quals=None):
+        """Assign a batch of reads, returning the sample for each read.
+
+        Each part is a list of index sequences, str or bytes, with one
+        item per read. The barcode for a read is made by joining its
+        sequences from every part. If the assigner has a min_quality,
+        quals gives the quality strings for each part.
+        """
+        keys = self._batch_keys(parts)
+        samples = list(map(self._barcodes.get, keys))
+        misses = itertools.compress(range(len(samples)), map(operator.not_, samples))
+        misses = list(misses)
+        if misses and (self.min_quality is not None) and (quals is not None):
+            self._assign_masked(parts, quals, samples, misses)
+            misses = [n for n in misses if samples[n] is None]
+        if self.packed:
+            # Unassigned barcodes are counted as they were read
+            seqs = join_barcodes(*(_select(part, misses) for part in parts))
+        else:
+            seqs = _select(keys, misses)
+        unassigned = []
+        for n, seq in zip(misses, seqs):
+            sample = self._search(seq)
+            if sample is None:
+                unassigned.append(seq)
+            else:
+                samples[n] = sample
+        # Barcodes from two index reads can be split for hopped pairs
+        i1_length = None
+        if (len(parts) == 2) and parts[0]:
+            i1_length = len(parts[0][0])
+        self._count_unassigned(unassigned, i1_length)
+        self._count_samples(samples)
+        return samples
+
+    def _count_samples(self, samples):
+        for sample, n in Counter(samples).items():
+            if sample is None:
+                self.read_counts["unassigned"] += n
+            else:
+                self.read_counts[sample.name] += n
+
+    def _assign_masked(self, parts, quals, samples, misses):
+        # Reads not found as they were read are looked up again with
+        # low-quality bases replaced by "N". Low-quality bases that
+        # match should not use up the mismatches, so if there are more
+        # of them than mismatches, each combination is tried in turn.
+        miss_parts = [_select(part, misses) for part in parts]
+        masked = [
+            mask_low_quality(seqs, _select(part_quals, misses), self.min_quality)
+            for seqs, part_quals in zip(miss_parts, quals)
+        ]
+        raw_seqs = join_barcodes(*miss_parts)
+        masked_seqs = join_barcodes(*masked)
+        unassigned = []
+        for n, seq, masked_seq in zip(misses, raw_seqs, masked_seqs):
+            if seq != masked_seq:
+                low = [i for i, (a, b) in enumerate(zip(seq, masked_seq)) if a != b]
+                keys = self._variant_keys(_masked_variants(seq, low, self.mismatches))
+                found = set(filter(None, map(self._barcodes.get, keys)))
+                if len(found) == 1:
+                    samples[n] = found.pop()
+                    self.quality_counts["rescued"] += 1
+                    continue
+            unassigned.append(seq)
+        self._count_rejected(unassigned)
+
+    def _variant_keys(self, variants):
+        if self.packed:
+            return pack_barcodes(variants)
+        return variants
+
+    def _count_rejected(self, seqs):
+        # Reads that are not assigned, but have a barcode within the
+        # mismatches at any bases, were turned away by their quality.
+        # Unassigned barcodes repeat, so each is checked once.
+        near_barcode = self._near_barcode
+        rejected = 0
+        for seq in seqs:
+            is_near = near_barcode.get(seq)
+            if is_near is None:
+                variants = _masked_variants(seq, range(len(seq)), self.mismatches)
+                keys = self._variant_keys(variants)
+                is_near = any(map(self._barcodes.__contains__, keys))
+                if len(near_barcode) < UnassignedClassifier.max_cached:
+                    near_barcode[seq] = is_near
+            rejected += is_near
+        self.quality_counts["rejected"] += rejected
+
+    def _search(self, seq):
+        # All matches are in the hash table
+        return None
+
     def most_common_unassigned(self, n=100):
         return self.unassigned_counts.most_common(n)
 
+    def most_common_hopped(self, n=100):
+        return self.hopped_counts.most_common(n)
+
+
+class HammingBarcodeAssigner(BarcodeAssigner):
+    """Assign reads to the barcode within a number of mismatches.
+
+    Instead of listing every sequence with errors, each barcode is cut
+    into (mismatches + 1) segments. A read with no more than mismatches
+    errors matches the barcode exactly in at least one segment, so
+    only barcodes sharing a segment with the read are compared to it.
+    An "N" in the read counts as a mismatch. Memory use does not depend
+    on the number of mismatches, so more of them are allowed.
+    """
+
+    allowed_mismatches = list(range(9))
+
+    # Matches found by searching are added to the hash table, up to
+    # this many entries.
+    max_cached_matches = 1000000
+
+    def _init_hash(self):
+        if self.min_quality is not None:
+            raise ValueError("Index quality can only be used with the hash lookup")
+        self._barcodes = {}
+        self._index = {}
+        barcodes = []
+        for s in self.samples:
+            bc = self._sample_barcode(s)
+            self._barcodes[bc] = s
+            barcodes.append((bc, s))
+        self._check_distances(barcodes)
+
+        # Index of barcode segments, for each barcode length. Barcodes
+        # too short to cut into (mismatches + 1) segments are compared
+        # to every read of the same length.
+        for bc, s in barcodes:
+            if len(bc) <= self.mismatches:
+                bounds, segment_index = self._index.setdefault(len(bc), (None, []))
+                segment_index.append((bc, s))
+                continue
+            bounds, segment_index = self._index.setdefault(
+                len(bc), (_segment_bounds(len(bc), self.mismatches + 1), {})
+            )
+            for n, (start, end) in enumerate(bounds):
+                segment_index.setdefault((n, bc[start:end]), []).append((bc, s))
+
+    def _load_table(self, cache_dir):
+        # The segment index is quick to build, so it is not cached
+        self._build_table()
+
+    def _check_distances(self, barcodes):
+        # A read can match two barcodes if they are within twice the
+        # number of mismatches. Such barcodes share at least one of
+        # (2 * mismatches + 1) segments, which we use to find them.
+        # Barcodes too short to cut into that many segments are compared
+        # to every other barcode of the same length.
+        if self.mismatches == 0:
+            return
+        segments = {}
+        for bc, s in barcodes:
+            if len(bc) <= 2 * self.mismatches:
+                bounds = [(0, 0)]
+            else:
+                bounds = _segment_bounds(len(bc), 2 * self.mismatches + 1)
+            for n, (start, end) in enumerate(bounds):
+                key = (len(bc), n, bc[start:end])
+                for other_bc, other_s in segments.get(key, []):
+                    if hamming_distance(bc, other_bc) <= 2 * self.mismatches:
+                        raise ValueError(
+                            "Barcode %s for sample %s matches barcode for "
+                            "sample %s with %s mismatches"
+                            % (other_bc, other_s, s, self.mismatches)
+                        )
+                segments.setdefault(key, []).append((bc, s))
+
+    def _search(self, seq):
+        index = self._index.get(len(seq))
+        if index is None:
+            return None
+        bounds, segment_index = index
+        if bounds is None:
+            candidates = [segment_index]
+        else:
+            candidates = (
+                segment_index.get((n, seq[start:end]), [])
+                for n, (start, end) in enumerate(bounds)
+            )
+        for matches in candidates:
+            for bc, s in matches:
+                if hamming_distance(seq, bc) <= self.mismatches:
+                    if len(self._barcodes) < self.max_cached_matches:
+                        self._barcodes[self._key(seq)] = s
+                    return s
+        return None
+
+
+class DualIndexBarcodeAssigner(BarcodeAssigner):
+    """Assign reads with two index reads, allowing mismatches in each.
+
+    Each index read is looked up in its own table of sequences with
+    errors, and the sample is found from the pair of index sequences.
+    The tables grow with the number of distinct sequences for each
+    index, not with the combinations of errors in both. Reads where
+    both index sequences match, but not to the same sample, are
+    counted as hopped pairs.
+
+    Barcodes are split after i1_length bases, the length of the I1
+    reads, or in half if i1_length is not given. Both tables are built
+    and checked for collisions when the assigner is created.
+    """
+
+    def __init__(
+        self,
+        samples,
+        mismatches_i1=0,
+        mismatches_i2=0,
+        revcomp=True,
+        i1_length=None,
+        max_unassigned=None,
+        classify_unassigned=False,
+    ):
+        for mismatches in (mismatches_i1, mismatches_i2):
+            if mismatches not in self.allowed_mismatches:
+                raise ValueError(
+                    "Only %s mismatches allowed (got %s)"
+                    % (self.allowed_mismatches, mismatches)
+                )
+        self.samples = samples
+        self.mismatches_i1 = mismatches_i1
+        self.mismatches_i2 = mismatches_i2
+        self.revcomp = revcomp
+        self.packed = False
+        self.min_quality = None
+        self.max_unassigned = max_unassigned
+        self.classify_unassigned = classify_unassigned
+        self.reset_counts()
+        if (i1_length is None) and samples:
+            i1_length = len(self._sample_barcode(samples[0])) // 2
+        self._build_tables(i1_length)
+
+    def _max_mismatches(self):
+        return self.mismatches_i1 + self.mismatches_i2
+
+    def _build_tables(self, i1_length):
+        self._pairs = {}
+        for s in self.samples:
+            bc = self._sample_barcode(s)
+            if not (0 < i1_length < len(bc)):
+                raise ValueError(
+                    "Barcode %s for sample %s can not be split after %s bases"
+                    % (bc, s, i1_length)
+                )
+            self._pairs[(bc[:i1_length], bc[i1_length:])] = s
+        i1_barcodes = dict.fromkeys(i1 for i1, _ in self._pairs)
+        i2_barcodes = dict.fromkeys(i2 for _, i2 in self._pairs)
+        self._i1_table = self._index_table(i1_barcodes, self.mismatches_i1)
+        self._i2_table = self._index_table(i2_barcodes, self.mismatches_i2)
+        self.i1_length = i1_length
+
+    def _index_table(self, barcodes, mismatches):
+        # Each index sequence with errors, mapped to the index sequence
+        table = dict((bc, bc) for bc in barcodes)
+        for bc in barcodes:
+            for error_bc in self._error_barcodes(bc, mismatches):
+                other_bc = table.setdefault(error_bc, bc)
+                if other_bc != bc:
+                    raise ValueError(
+                        "Index %s matches index %s with %s mismatches"
+                        % (bc, other_bc, mismatches)
+                    )
+        return table
+
+    def assign(self, seq):
+        return self.assign_batch([seq[: self.i1_length]], [seq[self.i1_length :]])[0]
+
+    def assign_batch(self, *parts, quals=None):
+        """Assign a batch of reads, given the I1 and I2 sequences."""
+        if len(parts) != 2:
+            raise ValueError("Two index sequences needed for each read")
+        i1s, i2s = parts
+        if i1s and (len(i1s[0]) != self.i1_length):
+            raise ValueError(
+                "I1 reads of length %s, but barcodes are split after %s bases"
+                % (len(i1s[0]), self.i1_length)
+            )
+        pairs = list(
+            zip(
+                map(self._i1_table.get, join_barcodes(i1s)),
+                map(self._i2_table.get, join_barcodes(i2s)),
+            )
+        )
+        samples = list(map(self._pairs.get, pairs))
+        misses = itertools.compress(range(len(samples)), map(operator.not_, samples))
+        misses = list(misses)
+        seqs = join_barcodes(_select(i1s, misses), _select(i2s, misses))
+        hopped = []
+        class_seqs = None
+        if self.unassigned_classes is not None:
+            class_seqs = list(seqs)
+        for k, n in enumerate(misses):
+            i1, i2 = pairs[n]
+            if (i1 is not None) and (i2 is not None):
+                hopped.append("%s+%s" % (i1, i2))
+                if class_seqs is not None:
+                    # Classified by the corrected indexes, so that the
+                    # hopped class agrees with the hopped counts
+                    class_seqs[k] = i1 + i2
+        self._count_unassigned(seqs, self.i1_length, class_seqs)
+        self.hopped_counts.update(hopped)
+        self._count_samples(samples)
+        return samples
+
+
+class UnassignedClassifier(object):
+    """Sort the barcodes of unassigned reads into categories.
+
+    A barcode made of the I1 sequence of one sample and the I2 sequence
+    of another is a hopped pair. Otherwise, barcodes with an "N" are
+    counted together, and a barcode closer to one sample than to any
+    other, within max_mismatches, is a near miss to that sample. The
+    rest are unknown. An index shared by several samples is counted
+    for the first sample with that index.
+
+    Counts are kept by category code: 0 for barcodes with "N", 1 for
+    unknown barcodes, then near misses to each sample, then hopped
+    pairs for each pair of samples, by the sample for I1 and then for
+    I2. Only categories with reads are stored, so the counts stay small
+    to send between processes however many samples there are.
+
+    Assigners use one more mismatch than they allow, so that near
+    misses are the reads that one more mismatch would have assigned.
+    """
+
+    # Categories are saved for up to this many distinct barcodes
+    max_cached = 100000
+
+    def __init__(self, samples, barcodes, max_mismatches=1):
+        self.samples = samples
+        self.barcodes = barcodes
+        self.max_mismatches = max_mismatches
+        self.counts = Counter()
+        self._codes = {}
+        self._i1_length = None
+        self._i1_samples = {}
+        self._i2_samples = {}
+        # Index of barcode segments, as in HammingBarcodeAssigner
+        self._index = {}
+        for n, bc in enumerate(barcodes):
+            bounds, segment_index = self._index.setdefault(
+                len(bc), (_segment_bounds(len(bc), max_mismatches + 1), {})
+            )
+            for k, (start, end) in enumerate(bounds):
+                segment_index.setdefault((k, bc[start:end]), []).append(n)
+
+    def reset_counts(self):
+        """Set every count to zero, keeping the categories found so far."""
+        self.counts = Counter()
+
+    def add(self, seqs, i1_length=None):
+        """Count unassigned barcodes.
+
+        If i1_length is given, barcodes are split after that many
+        bases to look for hopped pairs.
+        """
+        if i1_length != self._i1_length:
+            self._split_barcodes(i1_length)
+        counts = self.counts
+        codes = self._codes
+        for seq, n in Counter(seqs).items():
+            code = codes.get(seq)
+            if code is None:
+                code = self._classify(seq)
+                if len(codes) < self.max_cached:
+                    codes[seq] = code
+            counts[code] += n
+
+    def _split_barcodes(self, i1_length):
+        self._i1_length = i1_length
+        self._codes = {}
+        self._i1_samples = {}
+        self._i2_samples = {}
+        if i1_length is None:
+            return
+        for n, bc in enumerate(self.barcodes):
+            if 0 < i1_length < len(bc):
+                self._i1_samples.setdefault(bc[:i1_length], n)
+                self._i2_samples.setdefault(bc[i1_length:], n)
+
+    def _classify(self, seq):
+        num_samples = len(self.samples)
+        if self._i1_length is not None:
+            i1_sample = self._i1_samples.get(seq[: self._i1_length])
+            i2_sample = self._i2_samples.get(seq[self._i1_length :])
+            if (i1_sample is not None) and (i2_sample is not None):
+                if i1_sample != i2_sample:
+                    return 2 + num_samples * (i1_sample + 1) + i2_sample
+        if "N" in seq:
+            return 0
+        index = self._index.get(len(seq))
+        if index is None:
+            return 1
+        bounds, segment_index = index
+        candidates = set()
+        for k, (start, end) in enumerate(bounds):
+            candidates.update(segment_index.get((k, seq[start:end]), []))
+        distances = sorted(
+            (hamming_distance(seq, self.barcodes[n]), n) for n in candidates
+        )
+        if distances and (distances[0][0] <= self.max_mismatches):
+            # Barcodes as close to two samples are unknown
+            if (len(distances) == 1) or (distances[1][0] > distances[0][0]):
+                return 2 + distances[0][1]
+        return 1
+
+    def merge(self, counts):
+        """Add the counts from another classifier for the same samples."""
+        self.counts.update(counts)
+
+    def totals(self):
+        """Number of unassigned reads in each category."""
+        num_samples = len(self.samples)
+        hopped = 0
+        near_miss = 0
+        for code, n in self.counts.items():
+            if code >= 2 + num_samples:
+                hopped += n
+            elif code >= 2:
+                near_miss += n
+        return collections.OrderedDict(
+            [
+                ("hopped", hopped),
+                ("n", self.counts[0]),
+                ("near_miss", near_miss),
+                ("unknown", self.counts[1]),
+            ]
+        )
+
+    def write_matrix(self, f):
+        """Write a TSV table of hopped pairs and near misses.
+
+        Rows are the sample for I1 and columns the sample for I2. Near
+        misses to each sample are given on the diagonal.
+        """
+        names = [s.name for s in self.samples]
+        num_samples = len(names)
+        f.write("I1/I2\t{0}\n".format("\t".join(names)))
+        for n, name in enumerate(names):
+            start = 2 + num_samples * (n + 1)
+            row = [self.counts[start + m] for m in range(num_samples)]
+            row[n] = self.counts[2 + n]
+            f.write("{0}\t{1}\n".format(name, "\t".join(map(str, row))))
+
+
+# Methods to look up barcodes, selected on the command line
+ASSIGNERS = {
+    "hash": BarcodeAssigner,
+    "hamming": HammingBarcodeAssigner,
+}
+
+
+def unassigned_counter(max_unassigned=None):
+    """Make a counter for unassigned barcodes.
+
+    The counter is exact, or if max_unassigned is given, keeps the
+    most common barcodes in a table of at most that size.
+    """
+    if max_unassigned is None:
+        return Counter()
+    return SpaceSavingCounter(max_unassigned)
+
+
+# Quality scores are Phred+33, from "!" to "~"
+PHRED_OFFSET = 33
+MAX_QUALITY = 93
+
+
+def mask_low_quality(seqs, quals, min_quality):
+    """Replace bases with a quality score below min_quality by "N".
+
+    The batch is masked in one pass: the joined quality strings are
+    translated to bit masks, which are combined with the joined
+    sequences as integers. If no base is below min_quality, seqs is
+    returned unchanged.
+    """
+    if not seqs:
+        return seqs
+    keep_table, n_table = _quality_tables(min_quality)
+    joined_quals = _join_bytes(quals)
+    n_mask = joined_quals.translate(n_table)
+    if b"N" not in n_mask:
+        return seqs
+    joined_seqs = _join_bytes(seqs)
+    if len(joined_seqs) != len(joined_quals):
+        raise ValueError("Index sequences and quality scores differ in length")
+    keep_mask = joined_quals.translate(keep_table)
+    masked = int.from_bytes(joined_seqs, "big") & int.from_bytes(keep_mask, "big")
+    masked |= int.from_bytes(n_mask, "big")
+    masked = masked.to_bytes(len(joined_seqs), "big").split(b"\n")
+    if isinstance(seqs[0], str):
+        return _decode_lines(masked)
+    return masked
+
+
+@functools.lru_cache()
+def _quality_tables(min_quality):
+    # Newlines are kept, as in _translation()
+    keep_table = bytearray(b"\xff" * 256)
+    n_table = bytearray(256)
+    for c in range(PHRED_OFFSET + min_quality):
+        if c != ord("\n"):
+            keep_table[c] = 0
+            n_table[c] = ord("N")
+    return bytes(keep_table), bytes(n_table)
+
+
+def _select(items, idxs):
+    return list(map(items.__getitem__, idxs))
+
+
+def _is_valid_table(table, num_samples):
+    if not (isinstance(table, tuple) and len(table) == 2):
+        return False
+    keys, sample_idxs = table
+    return (
+        isinstance(keys, list)
+        and isinstance(sample_idxs, list)
+        and len(keys) == len(sample_idxs)
+        and all(isinstance(n, int) and 0 <= n < num_samples for n in sample_idxs)
+    )
+
+
+def join_barcodes(*parts):
+    """Join the index sequences for each read into one str barcode."""
+    parts = [_decode_lines(part) for part in parts]
+    if len(parts) == 1:
+        return list(parts[0])
+    return list(map("".join, zip(*parts)))
+
+
+def _translation(mapping, default):
+    # Newlines are kept, to split the joined sequences afterwards
+    table = bytearray(default * 256)
+    table[ord("\n")] = ord("\n")
+    for old, new in mapping.items():
+        table[ord(old)] = ord(new)
+    return bytes(table)
+
+
+# Characters that are not bases become "x", so that int() rejects them
+_BASE_DIGITS = _translation({"A": "0", "C": "1", "G": "2", "T": "3", "N": "0"}, b"x")
+_N_BITS = _translation({"N": "1"}, b"0")
+
+
+def _masked_variants(seq, positions, mismatches):
+    """Copies of seq with each combination of the positions set to "N".
+
+    Up to mismatches positions are set at once, or all of them if
+    there are fewer.
+    """
+    positions = list(positions)
+    num_ns = min(len(positions), mismatches)
+    if num_ns == 1:
+        return [seq[:i] + "N" + seq[i + 1 :] for i in positions]
+    variants = []
+    for idxs in itertools.combinations(positions, num_ns):
+        bc = list(seq)
+        for i in idxs:
+            bc[i] = "N"
+        variants.append("".join(bc))
+    return variants
+
+
+def pack_barcodes(*parts):
+    """Encode barcodes as integers, two bits per base.
+
+    Parts are given as for BarcodeAssigner.assign_batch(). Positions
+    of "N" are kept as a bit mask above the bases, so that a barcode
+    of length L is encoded as (1 << 3L) | (N mask << 2L) | bases. The
+    top bit makes barcodes of different lengths distinct. Barcodes
+    with characters other than A, C, G, T and N are encoded as None.
+
+    Each part is converted in one pass over the joined sequences, as
+    long as its sequences are all the same length.
+    """
+    num_seqs = len(parts[0])
+    if num_seqs == 0:
+        return []
+    values = masks = None
+    total_length = 0
+    for part in parts:
+        lengths = set(map(len, part))
+        if len(lengths) > 1:
+            return _pack_each(parts)
+        length = lengths.pop()
+        joined = _join_bytes(part)
+        if length == 0:
+            part_values = [0] * num_seqs
+        else:
+            try:
+                part_values = map(
+                    int,
+                    joined.translate(_BASE_DIGITS).split(b"\n"),
+                    itertools.repeat(4),
+                )
+                part_values = list(part_values)
+            except ValueError:
+                return _pack_each(parts)
+        part_masks = None
+        if b"N" in joined:
+            part_masks = list(
+                map(int, joined.translate(_N_BITS).split(b"\n"), itertools.repeat(2))
+            )
+        if values is None:
+            values, masks = part_values, part_masks
+        else:
+            values = _shift_or(values, 2 * length, part_values)
+            if (masks is not None) or (part_masks is not None):
+                masks = _shift_or(
+                    masks or [0] * num_seqs, length, part_masks or [0] * num_seqs
+                )
+        total_length += length
+    keys = map(operator.or_, values, itertools.repeat(1 << (3 * total_length)))
+    if masks is not None:
+        masks = map(operator.lshift, masks, itertools.repeat(2 * total_length))
+        keys = map(operator.or_, keys, masks)
+    return list(keys)
+
+
+def _shift_or(highs, shift, lows):
+    highs = map(operator.lshift, highs, itertools.repeat(shift))
+    return list(map(operator.or_, highs, lows))
+
+
+def _pack_each(parts):
+    seqs = zip(*(_join_bytes(part).split(b"\n") for part in parts))
+    return [_pack_barcode(b"".join(seq)) for seq in seqs]
+
+
+def _pack_barcode(seq):
+    try:
+        value = int(seq.translate(_BASE_DIGITS), 4) if seq else 0
+    except ValueError:
+        return None
+    key = value | (1 << (3 * len(seq)))
+    if b"N" in seq:
+        key |= int(seq.translate(_N_BITS), 2) << (2 * len(seq))
+    return key
+
+
+def _join_bytes(seqs):
+    if seqs and isinstance(seqs[0], str):
+        return "\n".join(seqs).encode("latin-1", "replace")
+    return b"\n".join(seqs)
+
+
+def _segment_bounds(length, num_segments):
+    """Cut a sequence into segments of nearly equal length."""
+    num_segments = min(length, num_segments)
+    return [
+        (length * n // num_segments, length * (n + 1) // num_segments)
+        for n in range(num_segments)
+    ]
+
+
+def hamming_distance(seq1, seq2):
+    return sum(map(operator.ne, seq1, seq2))
+
 
 AMBIGUOUS_BASES = {
     "T": "T",
@@ -0,0 +1,281 @@
+import argparse
+import array
+import collections
+import os
+import struct
+import sys
+
+from . import __version__
+from .assigner import ASSIGNERS, MAX_QUALITY
+from .gzipio import COMPRESSION_FORMATS, DEFAULT_COMPRESSION_LEVEL
+from .main import open_maybe_gzip, open_output, open_text_input
+from .sample import SampleBarcode, load_sample_barcodes
+from .seqfile import SequenceFile, parse_fastq_batches, zip_batches
+from .writer import PairedFastqWriter, write_read_counts, write_unassigned_barcodes
+
+# Start of every assignment file, changed when the layout changes
+ASSIGNMENTS_MAGIC = b"DNABCAS1"
+
+# After the magic bytes: size of each sample ID in bytes, and size of
+# the list of samples that follows
+_HEADER = struct.Struct("<BI")
+
+# Sample ID for reads not assigned to any sample
+UNASSIGNED_ID = 0
+
+
+def write_assignments(seq_file, assigner, f):
+    """Assign reads to samples and save the sample ID for each read.
+
+    Only the files with barcodes are read. The output file starts with
+    the list of samples, followed by one sample ID per read: 0 for
+    unassigned reads, and n for the nth sample. IDs are stored as
+    unsigned bytes, or as 16-bit integers for more than 255 samples.
+    """
+    samples = assigner.samples
+    if len(samples) > 0xFFFF:
+        raise ValueError("At most %s samples can be saved" % 0xFFFF)
+    typecode = "B" if len(samples) <= 0xFF else "H"
+    sample_list = "".join("%s\t%s\n" % (s.name, s.barcode) for s in samples)
+    sample_list = sample_list.encode("utf-8")
+    f.write(ASSIGNMENTS_MAGIC)
+    f.write(_HEADER.pack(array.array(typecode).itemsize, len(sample_list)))
+    f.write(sample_list)
+
+    sample_ids = dict((s, n) for n, s in enumerate(samples, 1))
+    sample_ids[None] = UNASSIGNED_ID
+    for batch_samples in seq_file.assign(assigner):
+        ids = array.array(typecode, map(sample_ids.__getitem__, batch_samples))
+        if sys.byteorder == "big":
+            ids.byteswap()
+        f.write(ids.tobytes())
+    return assigner.read_counts
+
+
+def read_assignments_header(f):
+    """Read the list of samples from the start of an assignment file.
+
+    Returns the samples and the typecode of the array of sample IDs
+    that follows.
+    """
+    if f.read(len(ASSIGNMENTS_MAGIC)) != ASSIGNMENTS_MAGIC:
+        raise ValueError("Not a dnabc assignment file")
+    itemsize, list_size = _HEADER.unpack(f.read(_HEADER.size))
+    typecodes = dict((array.array(t).itemsize, t) for t in ["H", "B"])
+    if itemsize not in typecodes:
+        raise ValueError("Unknown sample ID size in assignment file: %s" % itemsize)
+    sample_list = f.read(list_size).decode("utf-8")
+    samples = [SampleBarcode(*line.split("\t")) for line in sample_list.splitlines()]
+    return samples, typecodes[itemsize]
+
+
+def split_reads(assignments_file, fwd, rev, writer):
+    """Write read pairs to the samples saved by write_assignments().
+
+    No barcodes are looked at; the nth read pair goes to the sample
+    with the nth ID in the assignment file. Returns the number of
+    reads for each sample.
+    """
+    samples, typecode = read_assignments_header(assignments_file)
+    itemsize = array.array(typecode).itemsize
+    id_samples = [None] + samples
+    counts = [0] * len(id_samples)
+    batches = zip_batches(parse_fastq_batches(fwd), parse_fastq_batches(rev))
+    for fwds, revs in batches:
+        data = assignments_file.read(len(fwds) * itemsize)
+        if len(data) < len(fwds) * itemsize:
+            raise ValueError("Assignment file has fewer reads than the FASTQ files")
+        ids = array.array(typecode, data)
+        if sys.byteorder == "big":
+            ids.byteswap()
+        for sample_id, n in collections.Counter(ids).items():
+            counts[sample_id] += n
+        writer.write_batch((fwds, revs), list(map(id_samples.__getitem__, ids)))
+    if assignments_file.read(1):
+        raise ValueError("Assignment file has more reads than the FASTQ files")
+    read_counts = collections.OrderedDict(
+        (s.name, n) for s, n in zip(samples, counts[1:])
+    )
+    read_counts["unassigned"] = counts[UNASSIGNED_ID]
+    return read_counts
+
+
+def assign_main(argv=None):
+    p = argparse.ArgumentParser(
+        description=(
+            "Assign reads to samples using only the index reads, and save "
+            "the sample for each read. The reads are written out later by "
+            "dnabc_split."
+        )
+    )
+    p.add_argument("barcode_file", help="Barcode file (TSV format)")
+    p.add_argument("output_file", help="Output file of sample assignments")
+    p.add_argument(
+        "--r1-fastq",
+        help=(
+            "Forward reads FASTQ file, needed to take the index reads from "
+            "the description lines if no index files are given"
+        ),
+    )
+    p.add_argument("--i1-fastq", help="Forward index FASTQ file")
+    p.add_argument("--i2-fastq", help="Reverse index FASTQ file")
+    p.add_argument(
+        "--revcomp", action="store_true", help="Reverse complement barcode sequences"
+    )
+    p.add_argument(
+        "--mismatches",
+        type=int,
+        default=0,
+        help="Maximum number of mismatches in barcode sequence (default: %(default)s)",
+    )
+    p.add_argument(
+        "--barcode-lookup",
+        choices=list(ASSIGNERS),
+        default="hash",
+        help="Method to find barcodes with mismatches (default: %(default)s)",
+    )
+    p.add_argument(
+        "--min-index-quality",
+        type=int,
+        help=(
+            "Replace bases in the index reads with a quality score below "
+            "this by N, and allow mismatches only at these bases"
+        ),
+    )
+    p.add_argument(
+        "--total-reads-file",
+        help=("Write TSV table of total read counts"),
+    )
+    p.add_argument(
+        "--unassigned-barcodes-file",
+        help=("Write TSV table of unassigned barcode sequences"),
+    )
+    p.add_argument(
+        "--max-unassigned-barcodes",
+        type=int,
+        help=(
+            "Track only the most common unassigned barcodes, in a table of "
+            "this many entries. Counts are exact unless more distinct "
+            "barcodes than this are seen (default: track all barcodes)"
+        ),
+    )
+    p.add_argument("-v", "--version", action="version", version=str(__version__))
+    args = p.parse_args(argv)
+
+    assigner_cls = ASSIGNERS[args.barcode_lookup]
+    if args.mismatches not in assigner_cls.allowed_mismatches:
+        p.error(
+            "argument --mismatches: with --barcode-lookup {0}, must be one of "
+            "{1}".format(args.barcode_lookup, assigner_cls.allowed_mismatches)
+        )
+    if (args.max_unassigned_barcodes is not None) and (
+        args.max_unassigned_barcodes < 100
+    ):
+        p.error("argument --max-unassigned-barcodes: must be 100 or more")
+    if (args.i1_fastq is None) and (args.r1_fastq is None):
+        p.error("either --i1-fastq or --r1-fastq is required")
+    if (args.i2_fastq is not None) and (args.i1_fastq is None):
+        p.error("--i2-fastq requires --i1-fastq")
+    if args.min_index_quality is not None:
+        if not (0 <= args.min_index_quality <= MAX_QUALITY):
+            p.error(
+                "argument --min-index-quality: must be from 0 to "
+                "{0}".format(MAX_QUALITY)
+            )
+        if args.i1_fastq is None:
+            p.error("argument --min-index-quality: needs --i1-fastq")
+        if args.barcode_lookup != "hash":
+            p.error("argument --min-index-quality: needs --barcode-lookup hash")
+
+    with open_text_input(args.barcode_file) as f:
+        samples = load_sample_barcodes(f)
+    assigner = assigner_cls(
+        samples,
+        mismatches=args.mismatches,
+        revcomp=args.revcomp,
+        max_unassigned=args.max_unassigned_barcodes,
+        min_quality=args.min_index_quality,
+    )
+
+    if args.i1_fastq:
+        # The forward and reverse reads are not needed
+        r1 = None
+    else:
+        r1 = open_maybe_gzip(args.r1_fastq)
+    i1 = open_maybe_gzip(args.i1_fastq, required=False)
+    i2 = open_maybe_gzip(args.i2_fastq, required=False)
+    seq_file = SequenceFile(r1, None, i1, i2)
+    with open(args.output_file, "wb") as f:
+        write_assignments(seq_file, assigner, f)
+    if args.min_index_quality is not None:
+        sys.stderr.write(
+            "dnabc: {rescued} reads rescued and {rejected} reads rejected "
+            "by index quality\n".format(**assigner.quality_counts)
+        )
+
+    if args.total_reads_file:
+        with open_output(args.total_reads_file) as f:
+            write_read_counts(f, assigner.read_counts)
+    if args.unassigned_barcodes_file:
+        with open_output(args.unassigned_barcodes_file) as f:
+            write_unassigned_barcodes(f, assigner.most_common_unassigned())
+
+
+def split_main(argv=None):
+    p = argparse.ArgumentParser(
+        description=(
+            "Write reads to sample files, using the sample assignments "
+            "saved by dnabc_assign."
+        )
+    )
+    p.add_argument("assignments_file", help="Sample assignments from dnabc_assign")
+    p.add_argument("r1_fastq", help="Forward reads FASTQ file")
+    p.add_argument("r2_fastq", help="Reverse reads FASTQ file")
+    p.add_argument(
+        "--output-dir",
+        default="demultiplexed_fastq",
+        help="Output sequence data directory (default: %(default)s)",
+    )
+    p.add_argument(
+        "--manifest-file",
+        help=("Write manifest file for QIIME2"),
+    )
+    p.add_argument(
+        "--total-reads-file",
+        help=("Write TSV table of total read counts"),
+    )
+    p.add_argument(
+        "--compress",
+        choices=COMPRESSION_FORMATS,
+        help="Compress output FASTQ files in gzip or BGZF format",
+    )
+    p.add_argument(
+        "--compress-level",
+        type=int,
+        default=DEFAULT_COMPRESSION_LEVEL,
+        choices=range(1, 10),
+        metavar="{1-9}",
+        help="Compression level for output files (default: %(default)s)",
+    )
+    p.add_argument("-v", "--version", action="version", version=str(__version__))
+    args = p.parse_args(argv)
+
+    r1 = open_maybe_gzip(args.r1_fastq)
+    r2 = open_maybe_gzip(args.r2_fastq)
+
+    if not os.path.exists(args.output_dir):
+        os.mkdir(args.output_dir)
+
+    writer = PairedFastqWriter(
+        args.output_dir, compress=args.compress, compress_level=args.compress_level
+    )
+    with open(args.assignments_file, "rb") as f:
+        read_counts = split_reads(f, r1, r2, writer)
+    writer.close()
+
+    if args.manifest_file:
+        with open_output(args.manifest_file) as f:
+            writer.write_qiime2_manifest(f)
+    if args.total_reads_file:
+        with open_output(args.total_reads_file) as f:
+            writer.write_read_counts(f, read_counts)
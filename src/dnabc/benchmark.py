@@ -0,0 +1,479 @@
+import argparse
+import collections
+import functools
+import gzip
+import json
+import os
+import platform
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from . import __version__
+from .assigner import ASSIGNERS, hamming_distance
+from .gzipio import open_input
+from .sample import load_sample_barcodes
+from .seqfile import SequenceFile, parse_fastq_batches, zip_batches
+from .writer import PairedFastqWriter
+
+# Input files for each layout of a sequencing run, in the order
+# accepted by SequenceFile(). MiSeq runs have one or two index files;
+# HiSeq runs have the barcode in the description line of each read.
+LAYOUTS = collections.OrderedDict(
+    [
+        ("index", ["R1", "R2", "I1"]),
+        ("dual", ["R1", "R2", "I1", "I2"]),
+        ("noindex", ["R1", "R2"]),
+    ]
+)
+
+# Benchmark stages, in the order they are run and reported
+STAGES = ["parse", "assign", "write", "demultiplex"]
+
+# Smallest number of differences between generated barcodes, so that
+# reads with one error are assigned with --mismatches 1
+MIN_BARCODE_DISTANCE = 3
+
+# Records written to a generated file at a time
+_GENERATE_BATCH_SIZE = 10000
+
+# Random bytes are turned into bases and quality scores by table lookup
+_BASES = bytes(b"ACGT"[n % 4] for n in range(256))
+_QUALS = bytes(b"FFFFF:,#"[n % 8] for n in range(256))
+
+
+def generate_run(
+    output_dir,
+    layout="index",
+    num_reads=100000,
+    num_barcodes=96,
+    barcode_length=8,
+    read_length=150,
+    error_rate=0.01,
+    compress=False,
+    seed=0,
+):
+    """Write a synthetic sequencing run, for use in benchmarks.
+
+    Each read comes from one of num_barcodes samples, chosen at random.
+    Every base of the barcode in each read is changed with probability
+    error_rate. The same arguments always give the same files.
+
+    Returns a dict with the barcode file and the FASTQ files for the
+    run, keyed by read (R1, R2, I1 and I2).
+    """
+    if layout not in LAYOUTS:
+        raise ValueError("Unknown layout: %s" % layout)
+    rng = random.Random(seed)
+    num_parts = 2 if layout == "dual" else 1
+    barcodes = _generate_barcodes(rng, num_barcodes, barcode_length * num_parts)
+    ext = ".fastq.gz" if compress else ".fastq"
+
+    run = collections.OrderedDict()
+    run["barcode_file"] = os.path.join(output_dir, "barcodes.tsv")
+    with open(run["barcode_file"], "w") as f:
+        f.write("SampleID\tBarcodeSequence\n")
+        for n, barcode in enumerate(barcodes):
+            f.write("Sample%s\t%s\n" % (n + 1, barcode.decode()))
+
+    reads = LAYOUTS[layout]
+    run["files"] = collections.OrderedDict(
+        (read, os.path.join(output_dir, "%s%s" % (read, ext))) for read in reads
+    )
+    fs = [_open_generated(fp, compress) for fp in run["files"].values()]
+    try:
+        for start in range(0, num_reads, _GENERATE_BATCH_SIZE):
+            size = min(_GENERATE_BATCH_SIZE, num_reads - start)
+            records = _generate_records(
+                rng, layout, start, size, barcodes, error_rate, read_length
+            )
+            for f, data in zip(fs, records):
+                f.write(data)
+    finally:
+        for f in fs:
+            f.close()
+    return run
+
+
+def _generate_barcodes(rng, num_barcodes, length):
+    barcodes = []
+    attempts = 0
+    while len(barcodes) < num_barcodes:
+        attempts += 1
+        if attempts > 1000 * num_barcodes:
+            raise ValueError(
+                "Could not find %s barcodes of length %s" % (num_barcodes, length)
+            )
+        barcode = _random_bytes(rng, length).translate(_BASES)
+        if all(
+            hamming_distance(barcode, other) >= MIN_BARCODE_DISTANCE
+            for other in barcodes
+        ):
+            barcodes.append(barcode)
+    return barcodes
+
+
+def _random_bytes(rng, n):
+    return rng.getrandbits(8 * n).to_bytes(n, "little")
+
+
+def _add_errors(rng, barcode, error_rate):
+    if not error_rate:
+        return barcode
+    seq = bytearray(barcode)
+    for n in range(len(seq)):
+        if rng.random() < error_rate:
+            seq[n] = rng.choice(b"ACGT".replace(seq[n : n + 1], b""))
+    return bytes(seq)
+
+
+def _generate_records(rng, layout, start, size, barcodes, error_rate, read_length):
+    # Sequences and qualities for the whole batch are drawn at once
+    seqs = _random_bytes(rng, 2 * size * read_length).translate(_BASES)
+    quals = _random_bytes(rng, 2 * size * read_length).translate(_QUALS)
+    outputs = [[] for _ in LAYOUTS[layout]]
+    # Dual index barcodes are split evenly between I1 and I2
+    barcode_length = len(barcodes[0]) // max(1, len(outputs) - 2)
+    for n in range(size):
+        barcode = _add_errors(rng, rng.choice(barcodes), error_rate)
+        desc = b"BENCH:1:FC:1:1101:%d:%d" % (start + n, n)
+        if layout == "noindex":
+            desc += b" 1:N:0:%s" % barcode
+        else:
+            desc += b" 1:N:0:1"
+        for m in range(2):
+            pos = (2 * n + m) * read_length
+            seq = seqs[pos : pos + read_length]
+            qual = quals[pos : pos + read_length]
+            outputs[m].append(b"@%s\n%s\n+\n%s\n" % (desc, seq, qual))
+        for m in range(len(outputs) - 2):
+            part = barcode[m * barcode_length : (m + 1) * barcode_length]
+            qual = b"F" * barcode_length
+            outputs[m + 2].append(b"@%s\n%s\n+\n%s\n" % (desc, part, qual))
+    return [b"".join(output) for output in outputs]
+
+
+def _open_generated(fp, compress):
+    if compress:
+        # Fast compression, since the files are only used once
+        return gzip.open(fp, "wb", compresslevel=1)
+    return open(fp, "wb")
+
+
+def run_benchmark(
+    run, mismatches=0, revcomp=False, barcode_lookup="hash", output_dir=None
+):
+    """Time each stage of demultiplexing for a run from generate_run().
+
+    The stages are timed separately:
+
+    * parse: reading and parsing every input file.
+    * assign: finding the sample for each read, given its barcode.
+    * write: formatting reads and writing them to the sample files.
+    * demultiplex: all of the above, as done by dnabc.
+
+    Returns a dict of results, with the time and reads per second for
+    each stage and the peak memory used by the process.
+    """
+    with open(run["barcode_file"]) as f:
+        samples = load_sample_barcodes(f)
+    make_assigner = functools.partial(
+        ASSIGNERS[barcode_lookup], samples, mismatches=mismatches, revcomp=revcomp
+    )
+    fps = list(run["files"].values())
+    stage_times = collections.OrderedDict()
+
+    start = time.perf_counter()
+    num_reads = _parse_files(fps)
+    stage_times["parse"] = time.perf_counter() - start
+
+    # Barcodes are parsed before the timer starts
+    seq_file = _open_run(fps)
+    assigner = make_assigner()
+    stage_times["assign"] = _time_assign(seq_file, assigner)
+    _close_run(seq_file)
+
+    temp_dir = None
+    if output_dir is None:
+        output_dir = temp_dir = tempfile.mkdtemp(prefix="dnabc_benchmark_")
+    try:
+        seq_file = _open_run(fps)
+        assigner = make_assigner()
+        writer = _TimedWriter(PairedFastqWriter(output_dir))
+        start = time.perf_counter()
+        seq_file.demultiplex(assigner, writer)
+        writer.close()
+        stage_times["demultiplex"] = time.perf_counter() - start
+        stage_times["write"] = writer.seconds
+        _close_run(seq_file)
+    finally:
+        if temp_dir is not None:
+            shutil.rmtree(temp_dir)
+
+    stages = collections.OrderedDict()
+    for stage in STAGES:
+        seconds = stage_times[stage]
+        stages[stage] = {
+            "seconds": round(seconds, 6),
+            "reads_per_sec": round(num_reads / seconds) if seconds else None,
+        }
+    return collections.OrderedDict(
+        [
+            ("version", __version__),
+            ("python", platform.python_version()),
+            ("num_reads", num_reads),
+            ("assigned_reads", num_reads - assigner.read_counts["unassigned"]),
+            ("stages", stages),
+            ("peak_rss_kb", peak_rss_kb()),
+        ]
+    )
+
+
+def _parse_files(fps):
+    num_reads = None
+    for fp in fps:
+        f = open_input(fp)
+        try:
+            n = sum(len(batch) for batch in parse_fastq_batches(f))
+        finally:
+            f.close()
+        num_reads = n if num_reads is None else min(num_reads, n)
+    return num_reads
+
+
+def _open_run(fps):
+    # R1 and R2 come first, as SequenceFile() expects
+    return SequenceFile(*(open_input(fp) for fp in fps))
+
+
+def _close_run(seq_file):
+    for f in seq_file._input_files():
+        f.close()
+
+
+def _time_assign(seq_file, assigner):
+    input_files = seq_file._input_files()
+    parsers = [parse_fastq_batches(input_files[n]) for n in seq_file._barcode_files]
+    barcodes = [seq_file._get_barcodes(*batches) for batches in zip_batches(*parsers)]
+    start = time.perf_counter()
+    for parts in barcodes:
+        assigner.assign_batch(*parts)
+    return time.perf_counter() - start
+
+
+class _TimedWriter(object):
+    """Writer that keeps track of the time spent writing"""
+
+    def __init__(self, writer):
+        self._writer = writer
+        self.seconds = 0.0
+
+    def write_batch(self, batches, samples):
+        start = time.perf_counter()
+        self._writer.write_batch(batches, samples)
+        self.seconds += time.perf_counter() - start
+
+    def close(self):
+        start = time.perf_counter()
+        self._writer.close()
+        self.seconds += time.perf_counter() - start
+
+
+def peak_rss_kb():
+    """Largest amount of memory used by this process so far, in kB.
+
+    Returns None where this is not available.
+    """
+    try:
+        import resource
+    except ImportError:
+        return None
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Reported in bytes on macOS, and in kilobytes elsewhere
+    if sys.platform == "darwin":
+        rss //= 1024
+    return rss
+
+
+def compare_results(old, new):
+    """Compare the speed of each stage between two benchmark results.
+
+    Returns a list of (stage, old reads per second, new reads per
+    second, speedup), with a speedup above 1 if new is faster.
+    """
+    comparison = []
+    for stage in STAGES:
+        old_rate = old["stages"].get(stage, {}).get("reads_per_sec")
+        new_rate = new["stages"].get(stage, {}).get("reads_per_sec")
+        speedup = None
+        if old_rate and new_rate:
+            speedup = round(new_rate / old_rate, 3)
+        comparison.append((stage, old_rate, new_rate, speedup))
+    return comparison
+
+
+def format_results(results):
+    lines = ["Stage\tSeconds\tReadsPerSec"]
+    for stage, result in results["stages"].items():
+        lines.append(
+            "{0}\t{1:.3f}\t{2}".format(
+                stage, result["seconds"], result["reads_per_sec"]
+            )
+        )
+    lines.append("Peak RSS: {0} kB".format(results["peak_rss_kb"]))
+    return "\n".join(lines) + "\n"
+
+
+def format_comparison(comparison):
+    lines = ["Stage\tOldReadsPerSec\tNewReadsPerSec\tSpeedup"]
+    for row in comparison:
+        lines.append("\t".join(str(x) for x in row))
+    return "\n".join(lines) + "\n"
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(
+        description=(
+            "Measure the speed of dnabc on a synthetic sequencing run. The "
+            "parse, assign and write stages are timed separately."
+        )
+    )
+    p.add_argument(
+        "--layout",
+        choices=list(LAYOUTS),
+        default="index",
+        help=(
+            "Input files: R1, R2 and I1 (index), R1, R2, I1 and I2 (dual), "
+            "or R1 and R2 with barcodes in the read headers (noindex) "
+            "(default: %(default)s)"
+        ),
+    )
+    p.add_argument(
+        "--reads",
+        type=int,
+        default=100000,
+        help="Number of read pairs (default: %(default)s)",
+    )
+    p.add_argument(
+        "--barcodes",
+        type=int,
+        default=96,
+        help="Number of samples (default: %(default)s)",
+    )
+    p.add_argument(
+        "--read-length",
+        type=int,
+        default=150,
+        help="Length of R1 and R2 reads (default: %(default)s)",
+    )
+    p.add_argument(
+        "--error-rate",
+        type=float,
+        default=0.01,
+        help="Chance of an error at each barcode base (default: %(default)s)",
+    )
+    p.add_argument(
+        "--gzip", action="store_true", help="Compress the input files with gzip"
+    )
+    p.add_argument(
+        "--seed",
+        type=int,
+        default=0,
+        help="Seed for the random run (default: %(default)s)",
+    )
+    p.add_argument(
+        "--mismatches",
+        type=int,
+        default=0,
+        help="Maximum number of mismatches in barcode sequence (default: %(default)s)",
+    )
+    p.add_argument(
+        "--barcode-lookup",
+        choices=list(ASSIGNERS),
+        default="hash",
+        help="Method to find barcodes with mismatches (default: %(default)s)",
+    )
+    p.add_argument(
+        "--work-dir",
+        help=(
+            "Directory for the generated run and the output files, which "
+            "are kept. By default, a temporary directory is used"
+        ),
+    )
+    p.add_argument(
+        "--output-json",
+        help="Save the results as JSON, to compare later with --compare",
+    )
+    p.add_argument(
+        "--compare",
+        help="Compare the results to those saved with --output-json",
+    )
+    p.add_argument("-v", "--version", action="version", version=str(__version__))
+    args = p.parse_args(argv)
+
+    assigner_cls = ASSIGNERS[args.barcode_lookup]
+    if args.mismatches not in assigner_cls.allowed_mismatches:
+        p.error(
+            "argument --mismatches: with --barcode-lookup {0}, must be one of "
+            "{1}".format(args.barcode_lookup, assigner_cls.allowed_mismatches)
+        )
+    if args.reads < 1:
+        p.error("argument --reads: must be 1 or more")
+
+    work_dir = args.work_dir
+    if work_dir is None:
+        work_dir = tempfile.mkdtemp(prefix="dnabc_benchmark_")
+    elif not os.path.exists(work_dir):
+        os.mkdir(work_dir)
+    try:
+        run = generate_run(
+            work_dir,
+            layout=args.layout,
+            num_reads=args.reads,
+            num_barcodes=args.barcodes,
+            read_length=args.read_length,
+            error_rate=args.error_rate,
+            compress=args.gzip,
+            seed=args.seed,
+        )
+        # Output from an earlier run in the same directory is replaced
+        output_dir = os.path.join(work_dir, "output")
+        if os.path.exists(output_dir):
+            shutil.rmtree(output_dir)
+        os.mkdir(output_dir)
+        results = run_benchmark(
+            run,
+            mismatches=args.mismatches,
+            barcode_lookup=args.barcode_lookup,
+            output_dir=output_dir,
+        )
+    finally:
+        if args.work_dir is None:
+            shutil.rmtree(work_dir)
+    results["run"] = collections.OrderedDict(
+        [
+            ("layout", args.layout),
+            ("reads", args.reads),
+            ("barcodes", args.barcodes),
+            ("read_length", args.read_length),
+            ("error_rate", args.error_rate),
+            ("gzip", args.gzip),
+            ("seed", args.seed),
+            ("mismatches", args.mismatches),
+            ("barcode_lookup", args.barcode_lookup),
+        ]
+    )
+
+    sys.stdout.write(format_results(results))
+    if args.output_json:
+        with open(args.output_json, "w") as f:
+            json.dump(results, f, indent=2)
+            f.write("\n")
+    if args.compare:
+        with open(args.compare) as f:
+            old_results = json.load(f)
+        if old_results.get("run") != results["run"]:
+            sys.stderr.write("Warning: the runs being compared have other settings\n")
+        sys.stdout.write(format_comparison(compare_results(old_results, results)))
@@ -0,0 +1,455 @@
+import collections
+import concurrent.futures
+import gzip
+import io
+import mmap
+import os
+import queue
+import shutil
+import struct
+import sys
+import threading
+import zlib
+
+GZIP_MAGIC = b"\x1f\x8b"
+
+# Uncompressed bytes handed over by the background thread at a time
+DEFAULT_BLOCK_SIZE = 1 << 20
+
+# Blocks decoded ahead of the reader
+DEFAULT_QUEUE_SIZE = 16
+
+DEFAULT_THREADS = min(4, os.cpu_count() or 1)
+
+COMPRESSION_FORMATS = ["gzip", "bgzf"]
+
+DEFAULT_COMPRESSION_LEVEL = 6
+
+# Uncompressed bytes collected before compressing them as one job
+DEFAULT_COMPRESS_BUFFER_SIZE = 1 << 18
+
+# Compression jobs in flight per file before the writer waits
+MAX_PENDING_JOBS = 2
+
+# Largest amount of data that fits in one BGZF block
+BGZF_MAX_BLOCK_DATA = 0xFF00
+
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+# Bytes of a memory-mapped input file released from memory at a time,
+# after they have been read
+RELEASE_SIZE = 1 << 22
+
+# Header of a BGZF block, up to and including the BSIZE field
+_BGZF_HEADER = struct.Struct("<4BI2BH2BHH")
+_BGZF_HEADER_SIZE = _BGZF_HEADER.size
+
+
+def open_input(fp, threads=DEFAULT_THREADS, offset=0):
+    """Open a file for reading in binary mode, decompressing if needed.
+
+    Compressed input is detected from the file contents. A filepath
+    of "-" reads from standard input.
+
+    Reading starts at offset, which is a position in the file for
+    uncompressed files, and a virtual offset for BGZF files: the
+    position of a block in the file, shifted left by 16 bits, plus the
+    position in the uncompressed data of the block. Files in other
+    formats can only be read from the start. Uncompressed files are
+    read through a memory map.
+    """
+    if fp == "-":
+        f = sys.stdin.buffer
+    else:
+        f = open(fp, "rb")
+    header = f.peek(_BGZF_HEADER_SIZE)[:_BGZF_HEADER_SIZE]
+    if is_bgzf(header):
+        # Pipes can be read from the start, without seeking
+        if offset >> 16:
+            f.seek(offset >> 16)
+        raw = ThreadedReader(_read_bgzf(f, threads), closefd=f)
+    elif offset and (header.startswith(GZIP_MAGIC) or (fp == "-")):
+        f.close()
+        raise ValueError("Can not start reading %s at an offset" % fp)
+    elif header.startswith(GZIP_MAGIC):
+        raw = ThreadedReader(_read_gzip(f), closefd=f)
+    elif fp != "-":
+        return open_mapped(f, offset)
+    else:
+        return f
+    f = io.BufferedReader(raw, DEFAULT_BLOCK_SIZE)
+    if offset & 0xFFFF:
+        f.read(offset & 0xFFFF)
+    return f
+
+
+def open_mapped(f, offset=0):
+    """Read an uncompressed file through a memory map, if possible.
+
+    Files that can not be mapped, such as pipes and empty files, are
+    read as usual.
+    """
+    try:
+        return MappedFile(f, offset)
+    except (ValueError, OSError):
+        # Pipes can be read from the start, without seeking
+        if offset:
+            f.seek(offset)
+        return f
+
+
+class MappedFile(io.RawIOBase):
+    """Binary file object reading from a memory map of a file.
+
+    Each read is one slice of the map, copied from the page cache
+    without passing through a read buffer or a read() system call.
+    Pages before the last read are released as reading goes on, so
+    that the mapped file does not add to the memory used by the
+    process.
+    """
+
+    def __init__(self, f, offset=0):
+        self._map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._f = f
+        self._pos = offset
+        self._released = 0
+        if hasattr(self._map, "madvise"):
+            self._map.madvise(mmap.MADV_SEQUENTIAL)
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def read(self, size=-1):
+        start = self._pos
+        if (size is None) or (size < 0):
+            self._pos = len(self._map)
+        else:
+            self._pos = min(len(self._map), start + size)
+        self._release(start)
+        return self._map[start : self._pos]
+
+    def _release(self, pos):
+        # Only whole pages can be released
+        pos -= pos % mmap.PAGESIZE
+        if (pos - self._released >= RELEASE_SIZE) and hasattr(self._map, "madvise"):
+            self._map.madvise(mmap.MADV_DONTNEED, self._released, pos - self._released)
+            self._released = pos
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[: len(data)] = data
+        return len(data)
+
+    def seek(self, pos, whence=io.SEEK_SET):
+        if whence == io.SEEK_CUR:
+            pos += self._pos
+        elif whence == io.SEEK_END:
+            pos += len(self._map)
+        self._pos = max(0, pos)
+        return self._pos
+
+    def tell(self):
+        return self._pos
+
+    def fileno(self):
+        return self._f.fileno()
+
+    def close(self):
+        if not self.closed:
+            self._map.close()
+            self._f.close()
+        super(MappedFile, self).close()
+
+
+def input_progress(f):
+    """Fraction of an input file read so far, or None if not known.
+
+    For compressed files, this is the position in the compressed data,
+    which is read somewhat ahead of the decompressed data.
+    """
+    source = getattr(f, "raw", f)
+    if isinstance(source, ThreadedReader):
+        source = source._closefd
+    try:
+        size = os.fstat(source.fileno()).st_size
+        pos = source.tell()
+    except (AttributeError, OSError, ValueError):
+        return None
+    if not size:
+        return None
+    return min(1.0, pos / size)
+
+
+def is_bgzf(header):
+    """Check if bytes from the start of a file begin a BGZF block.
+
+    BGZF files are gzip files made of independent members, each of
+    which records its compressed size in the header.
+    """
+    if len(header) < _BGZF_HEADER_SIZE:
+        return False
+    id1, id2, cm, flg, _, _, _, xlen, si1, si2, slen, _ = _BGZF_HEADER.unpack(
+        header[:_BGZF_HEADER_SIZE]
+    )
+    return (
+        (id1, id2, cm) == (0x1F, 0x8B, 8)
+        and (flg & 4)
+        and (xlen >= 6)
+        and (si1, si2, slen) == (ord("B"), ord("C"), 2)
+    )
+
+
+class ThreadedReader(io.RawIOBase):
+    """Raw file object reading blocks produced in a background thread.
+
+    Blocks may be bytes or futures of bytes. The queue between the
+    thread and the reader is bounded, so that decompression runs ahead
+    of parsing by a fixed amount of memory.
+    """
+
+    def __init__(self, blocks, queue_size=DEFAULT_QUEUE_SIZE, closefd=None):
+        self._queue = queue.Queue(queue_size)
+        self._closefd = closefd
+        self._block = b""
+        self._pos = 0
+        self._eof = False
+        self._stopped = False
+        self._thread = threading.Thread(target=self._produce, args=(blocks,))
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _produce(self, blocks):
+        try:
+            for block in blocks:
+                if self._stopped:
+                    return
+                self._queue.put(block)
+        except Exception as e:
+            self._queue.put(e)
+        else:
+            self._queue.put(None)
+
+    def readable(self):
+        return True
+
+    def readinto(self, b):
+        while self._pos >= len(self._block):
+            if self._eof:
+                return 0
+            block = self._queue.get()
+            if block is None:
+                self._eof = True
+                return 0
+            if isinstance(block, Exception):
+                self._eof = True
+                raise block
+            if isinstance(block, concurrent.futures.Future):
+                block = block.result()
+            self._block = block
+            self._pos = 0
+        n = min(len(b), len(self._block) - self._pos)
+        b[:n] = self._block[self._pos : self._pos + n]
+        self._pos += n
+        return n
+
+    def close(self):
+        if not self.closed:
+            # Let the background thread finish, if it is waiting on us
+            self._stopped = True
+            while self._thread.is_alive():
+                try:
+                    self._queue.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            if (self._closefd is not None) and (self._closefd is not sys.stdin.buffer):
+                self._closefd.close()
+        super(ThreadedReader, self).close()
+
+
+def _read_gzip(f):
+    # The zlib module releases the GIL while inflating, so this runs
+    # alongside parsing in the main thread.
+    with gzip.GzipFile(fileobj=f, mode="rb") as g:
+        while True:
+            block = g.read(DEFAULT_BLOCK_SIZE)
+            if not block:
+                return
+            yield block
+
+
+def _read_bgzf(f, threads):
+    # Blocks are located from their headers without inflating them, so
+    # they can be decoded in parallel.
+    with concurrent.futures.ThreadPoolExecutor(threads) as executor:
+        for _, block in _bgzf_blocks(f):
+            yield executor.submit(_inflate_bgzf_block, block)
+
+
+def read_bgzf_blocks(f):
+    """Decompress a BGZF file, yielding the offset and data of each block."""
+    for offset, block in _bgzf_blocks(f):
+        yield offset, _inflate_bgzf_block(block)
+
+
+def _bgzf_blocks(f):
+    # Offsets in a pipe are counted from the start of reading
+    offset = f.tell() if f.seekable() else 0
+    while True:
+        header = f.read(12)
+        if not header:
+            return
+        if len(header) < 12 or not header.startswith(GZIP_MAGIC):
+            raise ValueError("Invalid BGZF block header")
+        xlen = struct.unpack("<H", header[10:12])[0]
+        extra = f.read(xlen)
+        bsize = _bgzf_block_size(extra)
+        if bsize is None:
+            raise ValueError("BGZF block has no size field")
+        rest = f.read(bsize + 1 - 12 - xlen)
+        if len(rest) < bsize + 1 - 12 - xlen:
+            raise ValueError("Truncated BGZF block")
+        yield offset, rest
+        offset += bsize + 1
+
+
+def _bgzf_block_size(extra):
+    pos = 0
+    while pos + 4 <= len(extra):
+        si1, si2, slen = struct.unpack("<BBH", extra[pos : pos + 4])
+        if (si1, si2, slen) == (ord("B"), ord("C"), 2):
+            return struct.unpack("<H", extra[pos + 4 : pos + 6])[0]
+        pos += 4 + slen
+    return None
+
+
+def _inflate_bgzf_block(block):
+    data = zlib.decompress(block[:-8], -15)
+    crc, isize = struct.unpack("<II", block[-8:])
+    if (zlib.crc32(data) != crc) or (len(data) != isize):
+        raise ValueError("BGZF block failed CRC check")
+    return data
+
+
+class CompressedWriter(object):
+    """File object that compresses its output on a shared thread pool.
+
+    Data is collected in a buffer, and each full buffer is compressed
+    as an independent gzip member (or a run of BGZF blocks) by the
+    executor. Compressed data is written to the file in order.
+    """
+
+    def __init__(
+        self,
+        fp,
+        executor,
+        fmt="gzip",
+        level=DEFAULT_COMPRESSION_LEVEL,
+        buffer_size=DEFAULT_COMPRESS_BUFFER_SIZE,
+        mode="wb",
+    ):
+        if fmt not in COMPRESSION_FORMATS:
+            raise ValueError("Unknown compression format: %s" % fmt)
+        self.name = fp
+        self.fmt = fmt
+        self.level = level
+        self.buffer_size = buffer_size
+        self._executor = executor
+        self._compress = bgzf_compress if fmt == "bgzf" else gzip_member
+        # In append mode, new data starts a new gzip member or BGZF block
+        self._f = open(fp, mode)
+        self._buf = bytearray()
+        self._pending = collections.deque()
+
+    def write(self, data):
+        self._buf += data
+        if len(self._buf) >= self.buffer_size:
+            self._submit()
+        return len(data)
+
+    def submit(self):
+        """Start compressing the buffered data, without waiting for it."""
+        if self._buf:
+            self._submit()
+
+    def _submit(self):
+        data = self._buf
+        self._buf = bytearray()
+        job = self._executor.submit(self._compress, data, self.level)
+        self._pending.append(job)
+        while self._pending and (
+            self._pending[0].done() or len(self._pending) > MAX_PENDING_JOBS
+        ):
+            self._f.write(self._pending.popleft().result())
+
+    def flush(self):
+        self.submit()
+        while self._pending:
+            self._f.write(self._pending.popleft().result())
+        self._f.flush()
+
+    def close(self, eof=True):
+        if not self._f.closed:
+            self.flush()
+            if eof and (self.fmt == "bgzf"):
+                self._f.write(BGZF_EOF)
+            self._f.close()
+
+
+def concatenate_files(srcs, dest):
+    """Join files into one, in order.
+
+    Gzip files can be joined directly, but BGZF files should have one
+    end-of-file marker, at the end. Markers at the end of the source
+    files are removed, and one is added to the result.
+    """
+    any_bgzf = False
+    with open(dest, "w+b") as f:
+        for src in srcs:
+            with open(src, "rb") as g:
+                is_bgzf_src = is_bgzf(g.peek(_BGZF_HEADER_SIZE)[:_BGZF_HEADER_SIZE])
+                shutil.copyfileobj(g, f)
+            if is_bgzf_src:
+                any_bgzf = True
+                f.seek(-len(BGZF_EOF), os.SEEK_END)
+                if f.read() == BGZF_EOF:
+                    f.seek(-len(BGZF_EOF), os.SEEK_END)
+                    f.truncate()
+        if any_bgzf:
+            f.write(BGZF_EOF)
+
+
+def gzip_member(data, level=DEFAULT_COMPRESSION_LEVEL):
+    """Compress data into one gzip member.
+
+    A gzip file may be made of several members, which are decompressed
+    as if they were one stream.
+    """
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    # No filename or modification time, for reproducible output
+    header = struct.pack("<4BI2B", 0x1F, 0x8B, 8, 0, 0, 0, 0xFF)
+    trailer = struct.pack("<II", zlib.crc32(data), len(data) & 0xFFFFFFFF)
+    return header + cdata + trailer
+
+
+def bgzf_compress(data, level=DEFAULT_COMPRESSION_LEVEL):
+    """Compress data of any size into a run of BGZF blocks."""
+    return b"".join(
+        bgzf_block(data[i : i + BGZF_MAX_BLOCK_DATA], level)
+        for i in range(0, len(data), BGZF_MAX_BLOCK_DATA)
+    )
+
+
+def bgzf_block(data, level=DEFAULT_COMPRESSION_LEVEL):
+    """Compress data, at most 64 kB, into one BGZF block."""
+    c = zlib.compressobj(level, zlib.DEFLATED, -15)
+    cdata = c.compress(data) + c.flush()
+    bsize = 12 + 6 + len(cdata) + 8 - 1
+    header = struct.pack(
+        "<4BI2BH2BHH", 0x1F, 0x8B, 8, 4, 0, 0, 0xFF, 6, 66, 67, 2, bsize
+    )
+    trailer = struct.pack("<II", zlib.crc32(data), len(data))
+    return header + cdata + trailer
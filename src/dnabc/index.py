@@ -0,0 +1,225 @@
+import argparse
+import bisect
+import os
+
+from . import __version__
+from .gzipio import GZIP_MAGIC, is_bgzf, open_input, read_bgzf_blocks
+from .seqfile import DEFAULT_BUFFER_SIZE, _lines_end
+
+# Index files are saved next to the FASTQ file, with this suffix
+INDEX_SUFFIX = ".dnabci"
+
+# Records between offsets saved in the index
+DEFAULT_INDEX_INTERVAL = 100000
+
+
+def index_filepath(fp):
+    return fp + INDEX_SUFFIX
+
+
+def build_index(fp, every=DEFAULT_INDEX_INTERVAL):
+    """Find the offset of every nth record in a FASTQ file.
+
+    Offsets are found for records 0, n, 2n and so on, in the form
+    accepted by gzipio.open_input(): positions in the file for
+    uncompressed files, and virtual offsets for BGZF files. Files
+    compressed with plain gzip can not be indexed.
+
+    Returns a list of (record number, offset) and the number of
+    records in the file.
+    """
+    with open(fp, "rb") as f:
+        header = f.peek(64)
+        if is_bgzf(header):
+            blocks = (
+                (block_offset << 16, data) for block_offset, data in read_bgzf_blocks(f)
+            )
+            return _index_blocks(blocks, every)
+        elif header.startswith(GZIP_MAGIC):
+            raise ValueError(
+                "Can not index %s: gzip files must be in BGZF format, as "
+                "written by bgzip or dnabc --compress bgzf" % fp
+            )
+        return _index_blocks(_plain_blocks(f), every)
+
+
+def _plain_blocks(f):
+    offset = 0
+    while True:
+        block = f.read(DEFAULT_BUFFER_SIZE)
+        if not block:
+            return
+        yield offset, block
+        offset += len(block)
+
+
+def _index_blocks(blocks, every):
+    offsets = []
+    # Records start after a multiple of 4 lines
+    next_line = 0
+    lines_seen = 0
+    last_block = b"\n"
+    for block_offset, block in blocks:
+        if not block:
+            continue
+        num_lines = block.count(b"\n")
+        while next_line <= lines_seen + num_lines:
+            pos = _lines_end(block, next_line - lines_seen, b"\n", num_lines)
+            offsets.append((next_line // 4, block_offset + pos))
+            next_line += 4 * every
+        lines_seen += num_lines
+        last_block = block
+    if not last_block.endswith(b"\n"):
+        lines_seen += 1
+    num_reads = lines_seen // 4
+    # No record starts at the end of the file
+    offsets = [(n, offset) for n, offset in offsets if n < num_reads]
+    return offsets, num_reads
+
+
+def write_index(f, offsets, num_reads, file_size):
+    f.write("# dnabc index: reads={0} size={1}\n".format(num_reads, file_size))
+    f.write("RecordNumber\tOffset\n")
+    for record_num, offset in offsets:
+        f.write("{0}\t{1}\n".format(record_num, offset))
+
+
+def read_index(f):
+    """Load an index file saved by write_index().
+
+    Returns the list of (record number, offset), the number of records
+    and the size of the indexed file.
+    """
+    info = f.readline()
+    if not info.startswith("# dnabc index:"):
+        raise ValueError("Not a dnabc index file")
+    fields = dict(x.split("=") for x in info.split(":", 1)[1].split())
+    f.readline()
+    offsets = []
+    for line in f:
+        record_num, offset = line.split("\t")
+        offsets.append((int(record_num), int(offset)))
+    return offsets, int(fields["reads"]), int(fields["size"])
+
+
+def parse_region(region):
+    """Parse a range of records, given as "start:end".
+
+    Records are numbered from 0, and the end is not included. Either
+    number may be left out, to start at the beginning or stop at the
+    end of the file.
+    """
+    start, sep, end = region.partition(":")
+    if not sep:
+        raise ValueError("Region must be given as start:end (got %s)" % region)
+    start = int(start) if start else 0
+    end = int(end) if end else None
+    if (start < 0) or ((end is not None) and (end < start)):
+        raise ValueError("Invalid region: %s" % region)
+    return start, end
+
+
+def open_records(fp, start=0, end=None):
+    """Open a FASTQ file to read the records from start up to end.
+
+    If the file has an index, reading starts from the closest indexed
+    record. Otherwise, records are skipped from the start of the file.
+    Indexes are not used if the file has changed size since indexing.
+    """
+    first_record, offset = 0, 0
+    idx_fp = index_filepath(fp)
+    if os.path.exists(idx_fp):
+        with open(idx_fp) as f:
+            offsets, _, file_size = read_index(f)
+        if file_size == os.path.getsize(fp):
+            record_nums = [record_num for record_num, _ in offsets]
+            n = bisect.bisect_right(record_nums, start) - 1
+            if n >= 0:
+                first_record, offset = offsets[n]
+    count = None if end is None else end - start
+    return RecordRange(open_input(fp, offset=offset), start - first_record, count)
+
+
+class RecordRange(object):
+    """Binary file object holding a range of records from a FASTQ file.
+
+    The first skip records of f are left out, and at most count
+    records are read after that.
+    """
+
+    def __init__(self, f, skip=0, count=None, buffer_size=DEFAULT_BUFFER_SIZE):
+        self._f = f
+        self._blocks = _record_range_blocks(f, skip, count, buffer_size)
+        self._buf = b""
+
+    def read(self, size=-1):
+        parts = [self._buf]
+        num_bytes = len(self._buf)
+        while (size < 0) or (num_bytes < size):
+            block = next(self._blocks, None)
+            if block is None:
+                break
+            parts.append(block)
+            num_bytes += len(block)
+        data = b"".join(parts)
+        if size < 0:
+            self._buf = b""
+            return data
+        self._buf = data[size:]
+        return data[:size]
+
+    def close(self):
+        self._f.close()
+
+
+def _record_range_blocks(f, skip, count, buffer_size):
+    skip_lines = 4 * skip
+    take_lines = None if count is None else 4 * count
+    while True:
+        block = f.read(buffer_size)
+        if not block:
+            return
+        if skip_lines:
+            num_lines = block.count(b"\n")
+            if num_lines < skip_lines:
+                skip_lines -= num_lines
+                continue
+            block = block[_lines_end(block, skip_lines, b"\n", num_lines) :]
+            skip_lines = 0
+        if take_lines is not None:
+            num_lines = block.count(b"\n")
+            if num_lines >= take_lines:
+                yield block[: _lines_end(block, take_lines, b"\n", num_lines)]
+                return
+            take_lines -= num_lines
+        yield block
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(
+        description=(
+            "Index FASTQ files, to read a range of records with dnabc "
+            "--region without reading the file from the start. Files must "
+            "be uncompressed or in BGZF format. The index is saved next to "
+            "each file, with a {0} suffix.".format(INDEX_SUFFIX)
+        )
+    )
+    p.add_argument("fastq_files", nargs="+", help="FASTQ files to index")
+    p.add_argument(
+        "--every",
+        type=int,
+        default=DEFAULT_INDEX_INTERVAL,
+        help="Number of records between indexed offsets (default: %(default)s)",
+    )
+    p.add_argument("-v", "--version", action="version", version=str(__version__))
+    args = p.parse_args(argv)
+    if args.every < 1:
+        p.error("argument --every: must be 1 or more")
+
+    for fp in args.fastq_files:
+        try:
+            offsets, num_reads = build_index(fp, args.every)
+        except ValueError as e:
+            p.error(str(e))
+        with open(index_filepath(fp), "w") as f:
+            write_index(f, offsets, num_reads, os.path.getsize(fp))
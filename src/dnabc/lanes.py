@@ -0,0 +1,339 @@
+import argparse
+import collections
+import multiprocessing
+import os
+import re
+import shutil
+import tempfile
+
+from . import __version__
+from .assigner import ASSIGNERS, unassigned_counter
+from .gzipio import (
+    COMPRESSION_FORMATS,
+    DEFAULT_COMPRESSION_LEVEL,
+    concatenate_files,
+    open_input,
+)
+from .main import open_output, open_text_input
+from .sample import build_sample_barcodes
+from .seqfile import SequenceFile
+from .split_samplelanes import parse_sample_sheet
+from .writer import (
+    PairedFastqWriter,
+    write_qiime2_manifest,
+    write_read_counts,
+    write_unassigned_barcodes,
+)
+
+# Files written by bcl2fastq, e.g. Undetermined_S0_L001_R1_001.fastq.gz
+LANE_FILE_RE = re.compile(r"_L(\d+)_([RI][12])_\d+\.f(?:ast)?q(?:\.gz)?$")
+
+# Input files for a lane, in the order accepted by SequenceFile()
+LANE_READS = ["R1", "R2", "I1", "I2"]
+
+
+def group_lane_files(fps):
+    """Group FASTQ files by lane, using the file names from bcl2fastq.
+
+    Returns a dict from lane number to a dict of files for the lane,
+    keyed by read (R1, R2, I1 or I2). Lanes are sorted by number.
+    """
+    lanes = {}
+    for fp in fps:
+        m = LANE_FILE_RE.search(os.path.basename(fp))
+        if m is None:
+            raise ValueError("Lane and read not found in file name: %s" % fp)
+        lane = int(m.group(1))
+        read = m.group(2)
+        lane_files = lanes.setdefault(lane, {})
+        if read in lane_files:
+            raise ValueError("More than one %s file for lane %s" % (read, lane))
+        lane_files[read] = fp
+    for lane, lane_files in lanes.items():
+        if ("R1" not in lane_files) or ("R2" not in lane_files):
+            raise ValueError("R1 and R2 files are needed for lane %s" % lane)
+        if ("I2" in lane_files) and ("I1" not in lane_files):
+            raise ValueError("I2 file given without I1 file for lane %s" % lane)
+    return collections.OrderedDict(sorted(lanes.items()))
+
+
+def load_lane_samples(f, lanes):
+    """Load SampleBarcode objects for each lane from a sample sheet."""
+    names_barcodes = dict((lane, []) for lane in lanes)
+    for lane, sample_name, barcode in parse_sample_sheet(f):
+        if lane is None:
+            # Without a Lane column, samples are in every lane
+            for lane_names_barcodes in names_barcodes.values():
+                lane_names_barcodes.append((sample_name, barcode))
+        elif lane.isdigit() and (int(lane) in names_barcodes):
+            names_barcodes[int(lane)].append((sample_name, barcode))
+    lane_samples = collections.OrderedDict()
+    for lane in lanes:
+        if not names_barcodes[lane]:
+            raise ValueError("No samples found for lane %s in sample sheet" % lane)
+        lane_samples[lane] = build_sample_barcodes(names_barcodes[lane])
+    return lane_samples
+
+
+def _demultiplex_lane(job):
+    lane_files, assigner, lane_dir, writer_options = job
+    inputs = [
+        open_input(lane_files[r]) if r in lane_files else None for r in LANE_READS
+    ]
+    writer = PairedFastqWriter(lane_dir, **writer_options)
+    assigner.reset_counts()
+    try:
+        SequenceFile(*inputs).demultiplex(assigner, writer)
+    finally:
+        writer.close()
+        for f in inputs:
+            if f is not None:
+                f.close()
+    outputs = writer.output_files()
+    return assigner.read_counts, assigner.unassigned_counts, outputs
+
+
+def demultiplex_lanes(
+    lane_files, lane_assigners, output_dir, merge=False, processes=1, **writer_options
+):
+    """Demultiplex several lanes at once, with one process per lane.
+
+    Each lane is written to a temporary directory in output_dir. When
+    all lanes are done, the output files are moved to output_dir with
+    the lane added to the sample name, or, if merge is True,
+    concatenated across lanes in lane order. Read counts are added to
+    the assigner for each lane.
+
+    Returns the final output files as (sample, (fp1, fp2)) pairs, like
+    the output_files() method of a writer.
+    """
+    lane_dirs = collections.OrderedDict(
+        (lane, tempfile.mkdtemp(prefix="lane%s_" % lane, dir=output_dir))
+        for lane in lane_files
+    )
+    jobs = [
+        (lane_files[lane], lane_assigners[lane], lane_dirs[lane], writer_options)
+        for lane in lane_files
+    ]
+    try:
+        if processes > 1:
+            with multiprocessing.Pool(min(processes, len(jobs))) as pool:
+                results = pool.map(_demultiplex_lane, jobs, chunksize=1)
+        else:
+            results = list(map(_demultiplex_lane, jobs))
+
+        # Output files from each lane to be joined into each final file
+        sources = collections.OrderedDict()
+        output_fps = collections.OrderedDict()
+        for lane, (read_counts, unassigned_counts, outputs) in zip(lane_files, results):
+            # The counts belong to a copy of the assigner, or were
+            # reset when the lane was demultiplexed in this process
+            assigner = lane_assigners[lane]
+            assigner.reset_counts()
+            assigner.merge_counts(read_counts, unassigned_counts)
+            for sample, fps in outputs:
+                name = sample.name
+                if not merge:
+                    name = "%s_L%03d" % (sample.name, lane)
+                if name not in output_fps:
+                    # Files are named as in the lane, e.g. Sample1_R1.fastq
+                    dests = tuple(
+                        os.path.join(
+                            output_dir, name + os.path.basename(fp)[len(sample.name) :]
+                        )
+                        for fp in fps
+                    )
+                    output_fps[name] = (sample._replace(name=name), dests)
+                for dest, src in zip(output_fps[name][1], fps):
+                    sources.setdefault(dest, []).append(src)
+        for dest, srcs in sources.items():
+            _join_files(srcs, dest)
+    finally:
+        for lane_dir in lane_dirs.values():
+            shutil.rmtree(lane_dir)
+    return list(output_fps.values())
+
+
+def _join_files(srcs, dest):
+    if len(srcs) == 1:
+        os.replace(srcs[0], dest)
+    else:
+        concatenate_files(srcs, dest)
+
+
+def combine_read_counts(lane_assigners):
+    """Add up read counts for each sample across lanes."""
+    read_counts = collections.OrderedDict()
+    for assigner in lane_assigners.values():
+        for sample_name, n in assigner.read_counts.items():
+            read_counts[sample_name] = read_counts.get(sample_name, 0) + n
+    # Keep unassigned reads at the end of the table
+    read_counts["unassigned"] = read_counts.pop("unassigned")
+    return read_counts
+
+
+def write_lane_read_counts(f, lane_assigners):
+    f.write("SampleID\tLane\tNumReads\n")
+    for lane, assigner in lane_assigners.items():
+        for sample_name, n in assigner.read_counts.items():
+            f.write("{0}\t{1}\t{2}\n".format(sample_name, lane, n))
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(
+        description=(
+            "Demultiplex all lanes of a sequencing run in one pass, using "
+            "the barcodes for each lane in the sample sheet."
+        )
+    )
+    p.add_argument("sample_sheet", help="Sample sheet (CSV format)")
+    p.add_argument(
+        "fastq_files",
+        nargs="+",
+        help=(
+            "FASTQ files for all lanes, named as by bcl2fastq, e.g. "
+            "Undetermined_S0_L001_R1_001.fastq.gz. Each lane needs R1 and "
+            "R2 files, and may have I1 and I2 files."
+        ),
+    )
+    p.add_argument(
+        "--output-dir",
+        default="demultiplexed_fastq",
+        help="Output sequence data directory (default: %(default)s)",
+    )
+    p.add_argument(
+        "--merge-lanes",
+        action="store_true",
+        help=(
+            "Write one pair of files per sample, with reads from all lanes. "
+            "By default, the lane is added to each file name, e.g. "
+            "Sample1_L001_R1.fastq"
+        ),
+    )
+    p.add_argument(
+        "--revcomp", action="store_true", help="Reverse complement barcode sequences"
+    )
+    p.add_argument(
+        "--mismatches",
+        type=int,
+        default=0,
+        help="Maximum number of mismatches in barcode sequence (default: %(default)s)",
+    )
+    p.add_argument(
+        "--barcode-lookup",
+        choices=list(ASSIGNERS),
+        default="hash",
+        help="Method to find barcodes with mismatches (default: %(default)s)",
+    )
+    p.add_argument(
+        "--manifest-file",
+        help=("Write manifest file for QIIME2"),
+    )
+    p.add_argument(
+        "--total-reads-file",
+        help=("Write TSV table of total read counts, summed over lanes"),
+    )
+    p.add_argument(
+        "--lane-reads-file",
+        help=("Write TSV table of read counts for each lane"),
+    )
+    p.add_argument(
+        "--unassigned-barcodes-file",
+        help=("Write TSV table of unassigned barcode sequences"),
+    )
+    p.add_argument(
+        "--max-unassigned-barcodes",
+        type=int,
+        help=(
+            "Track only the most common unassigned barcodes, in a table of "
+            "this many entries. Counts are exact unless more distinct "
+            "barcodes than this are seen (default: track all barcodes)"
+        ),
+    )
+    p.add_argument(
+        "--threads",
+        type=int,
+        help=(
+            "Number of lanes demultiplexed at once, each in its own process "
+            "(default: the number of lanes or CPUs, whichever is less)"
+        ),
+    )
+    p.add_argument(
+        "--compress",
+        choices=COMPRESSION_FORMATS,
+        help="Compress output FASTQ files in gzip or BGZF format",
+    )
+    p.add_argument(
+        "--compress-level",
+        type=int,
+        default=DEFAULT_COMPRESSION_LEVEL,
+        choices=range(1, 10),
+        metavar="{1-9}",
+        help="Compression level for output files (default: %(default)s)",
+    )
+    p.add_argument("-v", "--version", action="version", version=str(__version__))
+    args = p.parse_args(argv)
+
+    assigner_cls = ASSIGNERS[args.barcode_lookup]
+    if args.mismatches not in assigner_cls.allowed_mismatches:
+        p.error(
+            "argument --mismatches: with --barcode-lookup {0}, must be one of "
+            "{1}".format(args.barcode_lookup, assigner_cls.allowed_mismatches)
+        )
+
+    if (args.max_unassigned_barcodes is not None) and (
+        args.max_unassigned_barcodes < 100
+    ):
+        p.error("argument --max-unassigned-barcodes: must be 100 or more")
+    try:
+        lane_files = group_lane_files(args.fastq_files)
+    except ValueError as e:
+        p.error(str(e))
+    with open_text_input(args.sample_sheet) as f:
+        lane_samples = load_lane_samples(f, lane_files)
+
+    # Barcode problems in any lane are found before reading the data
+    lane_assigners = collections.OrderedDict(
+        (
+            lane,
+            assigner_cls(
+                samples,
+                mismatches=args.mismatches,
+                revcomp=args.revcomp,
+                max_unassigned=args.max_unassigned_barcodes,
+            ),
+        )
+        for lane, samples in lane_samples.items()
+    )
+
+    if not os.path.exists(args.output_dir):
+        os.mkdir(args.output_dir)
+
+    threads = args.threads
+    if threads is None:
+        threads = min(len(lane_files), os.cpu_count() or 1)
+    output_fps = demultiplex_lanes(
+        lane_files,
+        lane_assigners,
+        args.output_dir,
+        merge=args.merge_lanes,
+        processes=threads,
+        compress=args.compress,
+        compress_level=args.compress_level,
+    )
+
+    if args.manifest_file:
+        with open_output(args.manifest_file) as f:
+            write_qiime2_manifest(f, output_fps)
+    if args.total_reads_file:
+        with open_output(args.total_reads_file) as f:
+            write_read_counts(f, combine_read_counts(lane_assigners))
+    if args.lane_reads_file:
+        with open_output(args.lane_reads_file) as f:
+            write_lane_read_counts(f, lane_assigners)
+    if args.unassigned_barcodes_file:
+        unassigned_counts = unassigned_counter(args.max_unassigned_barcodes)
+        for assigner in lane_assigners.values():
+            unassigned_counts.update(assigner.unassigned_counts)
+        with open_output(args.unassigned_barcodes_file) as f:
+            write_unassigned_barcodes(f, unassigned_counts.most_common(100))
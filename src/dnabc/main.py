@@ -1,12 +1,27 @@
 import argparse
-import gzip
+import contextlib
+import functools
+import gc
+import json
 import os
+import re
+import sys
 
 from . import __version__
-from .writer import PairedFastqWriter
+from .writer import DEFAULT_BUFFER_MEMORY, PairedFastqWriter
 from .sample import load_sample_barcodes
-from .seqfile import SequenceFile
-from .assigner import BarcodeAssigner
+from .seqfile import SequenceFile, barcode_field_regex, parse_fastq
+from .assigner import ASSIGNERS, MAX_QUALITY, DualIndexBarcodeAssigner
+from .parallel import demultiplex_parallel
+from .gzipio import (
+    COMPRESSION_FORMATS,
+    DEFAULT_COMPRESSION_LEVEL,
+    input_progress,
+    open_input,
+)
+from .index import open_records, parse_region
+from .stats import DemultiplexStats
+from .probe import DEFAULT_PROBE_READS, probe_barcodes
 
 
 def main(argv=None):
@@ -31,6 +46,24 @@ def main(argv=None):
             "to the barcode sequences."
         ),
     )
+    barcode_header = p.add_mutually_exclusive_group()
+    barcode_header.add_argument(
+        "--barcode-regex",
+        help=(
+            "Regular expression to find the barcode in the description "
+            "lines of the forward reads, if there are no index files. The "
+            "first group in the expression is taken as the barcode. By "
+            "default, the barcode follows the final colon"
+        ),
+    )
+    barcode_header.add_argument(
+        "--barcode-field",
+        type=int,
+        help=(
+            "Take the barcode from this field of the description lines, "
+            "counting fields separated by colons from 1"
+        ),
+    )
     p.add_argument(
         "--output-dir",
         default="demultiplexed_fastq",
@@ -43,9 +76,68 @@ def main(argv=None):
         "--mismatches",
         type=int,
         default=0,
-        choices=BarcodeAssigner.allowed_mismatches,
         help=(
-            "Maximum number of mismatches in barcode sequence " "(default: %(default)s)"
+            "Maximum number of mismatches in barcode sequence. Up to {0} "
+            "mismatches are allowed with the hash lookup method, and up to "
+            "{1} with the hamming method (default: %(default)s)"
+        ).format(
+            max(ASSIGNERS["hash"].allowed_mismatches),
+            max(ASSIGNERS["hamming"].allowed_mismatches),
+        ),
+    )
+    p.add_argument(
+        "--mismatches-i1",
+        type=int,
+        help=(
+            "Maximum number of mismatches in the forward index read. With "
+            "--mismatches-i1 or --mismatches-i2, each index read is looked "
+            "up separately, and pairs of indexes from different samples "
+            "are counted as hopped (default: --mismatches)"
+        ),
+    )
+    p.add_argument(
+        "--mismatches-i2",
+        type=int,
+        help=(
+            "Maximum number of mismatches in the reverse index read "
+            "(default: --mismatches)"
+        ),
+    )
+    p.add_argument(
+        "--barcode-lookup",
+        choices=list(ASSIGNERS),
+        default="hash",
+        help=(
+            "Method to find barcodes with mismatches. The hash method lists "
+            "every sequence with errors in a table. The hamming method "
+            "compares reads to the barcodes that share part of their "
+            "sequence, which uses less memory for 2 or more mismatches "
+            "(default: %(default)s)"
+        ),
+    )
+    p.add_argument(
+        "--min-index-quality",
+        type=int,
+        help=(
+            "Replace bases in the index reads with a quality score below "
+            "this by N, and allow mismatches only at these bases. Needs "
+            "index files and the hash lookup method"
+        ),
+    )
+    p.add_argument(
+        "--packed-barcodes",
+        action="store_true",
+        help=(
+            "Store barcodes in the lookup table as integers, two bits per "
+            "base. This makes the table smaller, at some cost in speed"
+        ),
+    )
+    p.add_argument(
+        "--barcode-cache-dir",
+        help=(
+            "Directory to save the table of barcodes with mismatches. Later "
+            "runs with the same barcodes and options load the table from "
+            "here instead of building it again"
         ),
     )
     p.add_argument(
@@ -60,42 +152,359 @@ def main(argv=None):
         "--unassigned-barcodes-file",
         help=("Write TSV table of unassigned barcode sequences"),
     )
+    p.add_argument(
+        "--unassigned-matrix-file",
+        help=(
+            "Sort unassigned reads into hopped index pairs, barcodes with N, "
+            "near misses to a sample and unknown barcodes, and write a TSV "
+            "matrix of hopped pairs between samples, with near misses on "
+            "the diagonal"
+        ),
+    )
+    p.add_argument(
+        "--hopped-pairs-file",
+        help=(
+            "Write TSV table of index pairs from different samples, with "
+            "--mismatches-i1 or --mismatches-i2"
+        ),
+    )
+    p.add_argument(
+        "--threads",
+        type=int,
+        default=1,
+        help=(
+            "Number of worker processes used to assign barcodes and "
+            "format reads (default: %(default)s)"
+        ),
+    )
+    p.add_argument(
+        "--compress",
+        choices=COMPRESSION_FORMATS,
+        help="Compress output FASTQ files in gzip or BGZF format",
+    )
+    p.add_argument(
+        "--compress-level",
+        type=int,
+        default=DEFAULT_COMPRESSION_LEVEL,
+        choices=range(1, 10),
+        metavar="{1-9}",
+        help="Compression level for output files (default: %(default)s)",
+    )
+    p.add_argument(
+        "--max-open-files",
+        type=int,
+        help=(
+            "Maximum number of output files open at once. Files are closed "
+            "and reopened as needed to stay under this limit (default: "
+            "based on the system limit for open files)"
+        ),
+    )
+    p.add_argument(
+        "--write-buffer-mb",
+        type=int,
+        default=DEFAULT_BUFFER_MEMORY >> 20,
+        help=(
+            "Memory used to buffer output for all samples, in megabytes "
+            "(default: %(default)s)"
+        ),
+    )
+    p.add_argument(
+        "--region",
+        type=region_arg,
+        help=(
+            "Demultiplex only the reads from start up to end, given as "
+            "start:end and counting from 0. Files indexed with dnabc_index "
+            "are read starting near the first read"
+        ),
+    )
+    p.add_argument(
+        "--max-unassigned-barcodes",
+        type=int,
+        help=(
+            "Track only the most common unassigned barcodes, in a table of "
+            "this many entries. Counts are exact unless more distinct "
+            "barcodes than this are seen (default: track all barcodes)"
+        ),
+    )
+    p.add_argument(
+        "--progress",
+        type=float,
+        metavar="SECONDS",
+        help=(
+            "Print the number of reads processed, speed, time left and "
+            "fraction unassigned to standard error every SECONDS seconds"
+        ),
+    )
+    p.add_argument(
+        "--stats-json",
+        help=(
+            "Write JSON report of time spent reading, assigning and writing "
+            "reads, and the reads and bytes written for each sample"
+        ),
+    )
+    p.add_argument(
+        "--probe",
+        choices=["check", "auto"],
+        help=(
+            "Before demultiplexing, match the barcodes to the first index "
+            "reads with every combination of reverse complementing and "
+            "swapping I1 and I2. If another combination matches many more "
+            "reads, stop with an error (check) or use it instead (auto)"
+        ),
+    )
+    p.add_argument(
+        "--probe-reads",
+        type=int,
+        default=DEFAULT_PROBE_READS,
+        help="Number of reads to match with --probe (default: %(default)s)",
+    )
     p.add_argument("-v", "--version", action="version", version=str(__version__))
     args = p.parse_args(argv)
 
-    with open(args.barcode_file) as f:
+    assigner_cls = ASSIGNERS[args.barcode_lookup]
+    if (args.max_unassigned_barcodes is not None) and (
+        args.max_unassigned_barcodes < 100
+    ):
+        p.error("argument --max-unassigned-barcodes: must be 100 or more")
+    if (args.max_open_files is not None) and (args.max_open_files < 2):
+        # Both files for a sample are written at once
+        p.error("argument --max-open-files: must be 2 or more")
+    if (args.progress is not None) and (args.progress <= 0):
+        p.error("argument --progress: must be more than 0")
+    if args.min_index_quality is not None:
+        if not (0 <= args.min_index_quality <= MAX_QUALITY):
+            p.error(
+                "argument --min-index-quality: must be from 0 to "
+                "{0}".format(MAX_QUALITY)
+            )
+        if args.i1_fastq is None:
+            p.error("argument --min-index-quality: needs --i1-fastq")
+        if args.barcode_lookup != "hash":
+            p.error("argument --min-index-quality: needs --barcode-lookup hash")
+    separate_mismatches = (args.mismatches_i1 is not None) or (
+        args.mismatches_i2 is not None
+    )
+    if separate_mismatches:
+        if args.i2_fastq is None:
+            p.error("arguments --mismatches-i1/--mismatches-i2: need --i2-fastq")
+        if args.barcode_lookup != "hash":
+            p.error("arguments --mismatches-i1/--mismatches-i2: need the hash lookup")
+        if args.packed_barcodes or (args.min_index_quality is not None):
+            p.error(
+                "arguments --mismatches-i1/--mismatches-i2: not allowed with "
+                "--packed-barcodes or --min-index-quality"
+            )
+        if args.mismatches_i1 is None:
+            args.mismatches_i1 = args.mismatches
+        if args.mismatches_i2 is None:
+            args.mismatches_i2 = args.mismatches
+        allowed_mismatches = DualIndexBarcodeAssigner.allowed_mismatches
+        if not (
+            (args.mismatches_i1 in allowed_mismatches)
+            and (args.mismatches_i2 in allowed_mismatches)
+        ):
+            p.error(
+                "arguments --mismatches-i1/--mismatches-i2: must be one of "
+                "{0}".format(allowed_mismatches)
+            )
+    elif args.hopped_pairs_file:
+        p.error(
+            "argument --hopped-pairs-file: needs --mismatches-i1 or --mismatches-i2"
+        )
+    if args.probe is not None:
+        if args.probe_reads < 1:
+            p.error("argument --probe-reads: must be 1 or more")
+        if "-" in (args.r1_fastq, args.i1_fastq, args.i2_fastq):
+            p.error("argument --probe: input files can not be read from stdin")
+    if args.mismatches not in assigner_cls.allowed_mismatches:
+        p.error(
+            "argument --mismatches: with --barcode-lookup {0}, must be one of "
+            "{1}".format(args.barcode_lookup, assigner_cls.allowed_mismatches)
+        )
+
+    barcode_regex = args.barcode_regex
+    if args.barcode_field is not None:
+        if args.barcode_field < 1:
+            p.error("argument --barcode-field: must be 1 or more")
+        barcode_regex = barcode_field_regex(args.barcode_field)
+    if barcode_regex is not None:
+        try:
+            num_groups = re.compile(barcode_regex).groups
+        except re.error as e:
+            p.error("argument --barcode-regex: {0}".format(e))
+        if num_groups < 1:
+            p.error("argument --barcode-regex: needs a group for the barcode")
+
+    with open_text_input(args.barcode_file) as f:
         samples = load_sample_barcodes(f)
 
-    r1 = open_maybe_gzip(args.r1_fastq)
-    r2 = open_maybe_gzip(args.r2_fastq)
-    i1 = open_maybe_gzip(args.i1_fastq, required=False)
-    i2 = open_maybe_gzip(args.i2_fastq, required=False)
+    revcomp = args.revcomp
+    if args.probe is not None:
+        try:
+            samples, revcomp = probe_orientation(args, samples, barcode_regex)
+        except ValueError as e:
+            p.error("argument --probe: {0}".format(e))
+
+    r1 = open_maybe_gzip(args.r1_fastq, region=args.region)
+    r2 = open_maybe_gzip(args.r2_fastq, region=args.region)
+    i1 = open_maybe_gzip(args.i1_fastq, required=False, region=args.region)
+    i2 = open_maybe_gzip(args.i2_fastq, required=False, region=args.region)
+
+    if separate_mismatches:
+        # The tables for each index are small, and are not cached
+        assigner = DualIndexBarcodeAssigner(
+            samples,
+            mismatches_i1=args.mismatches_i1,
+            mismatches_i2=args.mismatches_i2,
+            revcomp=revcomp,
+            i1_length=read_length(args.i1_fastq, args.region),
+            max_unassigned=args.max_unassigned_barcodes,
+            classify_unassigned=bool(args.unassigned_matrix_file),
+        )
+    else:
+        assigner = assigner_cls(
+            samples,
+            mismatches=args.mismatches,
+            revcomp=revcomp,
+            packed=args.packed_barcodes,
+            cache_dir=args.barcode_cache_dir,
+            max_unassigned=args.max_unassigned_barcodes,
+            min_quality=args.min_index_quality,
+            classify_unassigned=bool(args.unassigned_matrix_file),
+        )
 
     if not os.path.exists(args.output_dir):
         os.mkdir(args.output_dir)
 
-    writer = PairedFastqWriter(args.output_dir)
-    assigner = BarcodeAssigner(
-        samples, mismatches=args.mismatches, revcomp=args.revcomp
+    writer = PairedFastqWriter(
+        args.output_dir,
+        compress=args.compress,
+        compress_level=args.compress_level,
+        max_open_files=args.max_open_files,
+        buffer_memory=args.write_buffer_mb << 20,
     )
-    seq_file = SequenceFile(r1, r2, i1, i2)
-    seq_file.demultiplex(assigner, writer)
+
+    # The barcode table lives for the whole run. Move it out of the
+    # garbage collector's view, so collections triggered by the many
+    # short-lived reads do not traverse it.
+    gc.freeze()
+
+    stats = DemultiplexStats(
+        progress_file=sys.stderr if args.progress else None,
+        progress_interval=args.progress,
+        input_progress=functools.partial(input_progress, r1),
+    )
+    seq_file = SequenceFile(r1, r2, i1, i2, barcode_regex=barcode_regex)
+    if args.threads > 1:
+        demultiplex_parallel(seq_file, assigner, writer, args.threads, stats=stats)
+    else:
+        seq_file.demultiplex(assigner, writer, stats=stats)
+    writer.close()
+    if args.progress:
+        sys.stderr.write(stats.format_progress())
+    quality_counts = None
+    if args.min_index_quality is not None:
+        quality_counts = assigner.quality_counts
+        sys.stderr.write(
+            "dnabc: {rescued} reads rescued and {rejected} reads rejected "
+            "by index quality\n".format(**quality_counts)
+        )
+    hopped_reads = None
+    if separate_mismatches:
+        hopped_reads = sum(assigner.hopped_counts.values())
+        sys.stderr.write(
+            "dnabc: {0} reads with index pairs from different "
+            "samples\n".format(hopped_reads)
+        )
+
+    if args.stats_json:
+        with open_output(args.stats_json) as f:
+            report = stats.report(
+                assigner.read_counts,
+                writer,
+                quality_counts,
+                hopped_reads,
+                assigner.unassigned_classes,
+            )
+            json.dump(report, f, indent=2)
+            f.write("\n")
 
     if args.manifest_file:
-        with open(args.manifest_file, "w") as f:
+        with open_output(args.manifest_file) as f:
             writer.write_qiime2_manifest(f)
     if args.total_reads_file:
-        with open(args.total_reads_file, "w") as f:
+        with open_output(args.total_reads_file) as f:
             writer.write_read_counts(f, assigner.read_counts)
     if args.unassigned_barcodes_file:
-        with open(args.unassigned_barcodes_file, "w") as f:
+        with open_output(args.unassigned_barcodes_file) as f:
             writer.write_unassigned_barcodes(f, assigner.most_common_unassigned())
+    if args.unassigned_matrix_file:
+        with open_output(args.unassigned_matrix_file) as f:
+            assigner.unassigned_classes.write_matrix(f)
+    if args.hopped_pairs_file:
+        with open_output(args.hopped_pairs_file) as f:
+            writer.write_unassigned_barcodes(f, assigner.most_common_hopped())
+
+
+def probe_orientation(args, samples, barcode_regex):
+    # The files with barcodes are opened again for the probe, so that
+    # demultiplexing starts from the first read
+    barcode_fps = [args.i1_fastq, args.i2_fastq] if args.i1_fastq else [args.r1_fastq]
+    fs = [open_maybe_gzip(fp, required=False, region=args.region) for fp in barcode_fps]
+    try:
+        if args.i1_fastq:
+            seq_file = SequenceFile(None, None, *fs)
+        else:
+            seq_file = SequenceFile(fs[0], None, barcode_regex=barcode_regex)
+        return probe_barcodes(
+            samples,
+            seq_file,
+            args.revcomp,
+            num_reads=args.probe_reads,
+            auto=(args.probe == "auto"),
+            log_file=sys.stderr,
+        )
+    finally:
+        for f in fs:
+            if f is not None:
+                f.close()
+
+
+def read_length(fp, region=None):
+    """Length of the first read in a FASTQ file, if it can be read twice."""
+    if fp == "-":
+        return None
+    f = open_maybe_gzip(fp, region=region)
+    try:
+        for _, seq, _ in parse_fastq(f):
+            return len(seq)
+    finally:
+        f.close()
 
 
-def open_maybe_gzip(fp, required=True):
+def open_maybe_gzip(fp, required=True, region=None):
     if (fp is None) and (not required):
         return None
-    elif fp.endswith(".gz"):
-        return gzip.open(fp, "rt")
+    elif region is not None:
+        return open_records(fp, *region)
     else:
-        return open(fp, "rt")
+        return open_input(fp)
+
+
+def region_arg(region):
+    try:
+        return parse_region(region)
+    except ValueError as e:
+        raise argparse.ArgumentTypeError(str(e))
+
+
+def open_text_input(fp):
+    if fp == "-":
+        return contextlib.nullcontext(sys.stdin)
+    return open(fp)
+
+
+def open_output(fp):
+    if fp == "-":
+        return contextlib.nullcontext(sys.stdout)
+    return open(fp, "w")
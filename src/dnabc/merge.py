@@ -0,0 +1,121 @@
+import argparse
+import collections
+import os
+
+from . import __version__
+from .gzipio import concatenate_files
+from .main import open_output
+from .writer import write_read_counts, write_unassigned_barcodes
+
+
+def merge_output_dirs(input_dirs, output_dir):
+    """Join output files of the same name from several directories.
+
+    Files are joined in the order of input_dirs, so that demultiplexing
+    consecutive regions of the input gives the same output as one run.
+    Returns the filepaths written.
+    """
+    sources = collections.OrderedDict()
+    for input_dir in input_dirs:
+        for fn in sorted(os.listdir(input_dir)):
+            sources.setdefault(fn, []).append(os.path.join(input_dir, fn))
+    output_fps = []
+    for fn, srcs in sources.items():
+        output_fp = os.path.join(output_dir, fn)
+        concatenate_files(srcs, output_fp)
+        output_fps.append(output_fp)
+    return output_fps
+
+
+def merge_read_counts(fs):
+    """Add up tables of read counts written by dnabc."""
+    read_counts = collections.OrderedDict()
+    for f in fs:
+        for sample_name, n in _parse_count_table(f):
+            read_counts[sample_name] = read_counts.get(sample_name, 0) + n
+    if "unassigned" in read_counts:
+        read_counts["unassigned"] = read_counts.pop("unassigned")
+    return read_counts
+
+
+def merge_unassigned_barcodes(fs):
+    """Add up tables of unassigned barcodes written by dnabc.
+
+    Each table holds only the most common barcodes, so the counts for
+    barcodes left out of some tables will be too low.
+    """
+    barcode_counts = collections.Counter()
+    for f in fs:
+        for barcode, n in _parse_count_table(f):
+            barcode_counts[barcode] += n
+    return barcode_counts
+
+
+def _parse_count_table(f):
+    # Skip the header line
+    next(f, None)
+    for line in f:
+        line = line.rstrip("\n")
+        if line:
+            name, n = line.split("\t")
+            yield name, int(n)
+
+
+def main(argv=None):
+    p = argparse.ArgumentParser(
+        description=(
+            "Merge the output of dnabc runs on consecutive regions of the "
+            "same input files, made with --region."
+        )
+    )
+    p.add_argument(
+        "input_dirs",
+        nargs="+",
+        help="Output directories of each region, in order",
+    )
+    p.add_argument(
+        "--output-dir",
+        default="demultiplexed_fastq",
+        help="Output sequence data directory (default: %(default)s)",
+    )
+    p.add_argument(
+        "--total-reads-files",
+        nargs="+",
+        default=[],
+        help="Tables of total read counts for each region",
+    )
+    p.add_argument(
+        "--total-reads-file",
+        help="Write TSV table of total read counts, summed over regions",
+    )
+    p.add_argument(
+        "--unassigned-barcodes-files",
+        nargs="+",
+        default=[],
+        help="Tables of unassigned barcode sequences for each region",
+    )
+    p.add_argument(
+        "--unassigned-barcodes-file",
+        help="Write TSV table of unassigned barcode sequences, summed over regions",
+    )
+    p.add_argument("-v", "--version", action="version", version=str(__version__))
+    args = p.parse_args(argv)
+
+    if not os.path.exists(args.output_dir):
+        os.mkdir(args.output_dir)
+    merge_output_dirs(args.input_dirs, args.output_dir)
+
+    if args.total_reads_file:
+        fs = [open(fp) for fp in args.total_reads_files]
+        read_counts = merge_read_counts(fs)
+        for f in fs:
+            f.close()
+        with open_output(args.total_reads_file) as f:
+            write_read_counts(f, read_counts)
+    if args.unassigned_barcodes_file:
+        fs = [open(fp) for fp in args.unassigned_barcodes_files]
+        barcode_counts = merge_unassigned_barcodes(fs)
+        for f in fs:
+            f.close()
+        with open_output(args.unassigned_barcodes_file) as f:
+            write_unassigned_barcodes(f, barcode_counts.most_common(100))
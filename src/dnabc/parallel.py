@@ -0,0 +1,132 @@
+import collections
+import io
+import multiprocessing
+import time
+
+from .writer import _group_by_sample
+
+# Reads per chunk sent to a worker process
+DEFAULT_CHUNK_SIZE = 20000
+
+# Chunks queued per worker before the reader waits for results
+CHUNKS_PER_WORKER = 2
+
+_worker_state = None
+
+
+class _CollectingWriter(object):
+    """Writer that keeps formatted read pairs in memory, grouped by sample"""
+
+    def __init__(self, writer_cls):
+        self.writer_cls = writer_cls
+        self.outputs = collections.OrderedDict()
+
+    def write_batch(self, batchpair, samples):
+        r1s, r2s = (self.writer_cls._format_batch(batch) for batch in batchpair)
+        for sample, idxs in _group_by_sample(samples).items():
+            data1, data2 = self.outputs.setdefault(sample.name, ([], []))
+            data1.append(b"".join(map(r1s.__getitem__, idxs)))
+            data2.append(b"".join(map(r2s.__getitem__, idxs)))
+
+    def formatted(self):
+        """Output for each sample, in the form taken by write_formatted()."""
+        return [
+            (sample_name, (b"".join(data1), b"".join(data2)))
+            for sample_name, (data1, data2) in self.outputs.items()
+        ]
+
+
+def _init_worker(seq_file_cls, seq_file_options, assigner, writer_cls):
+    global _worker_state
+    # Unassigned barcodes in a chunk are counted exactly, and added to
+    # the bounded table in the main process like a batch of reads.
+    # Merging bounded tables from every chunk would add up their error
+    # floors instead.
+    assigner.max_unassigned = None
+    _worker_state = (seq_file_cls, seq_file_options, assigner, writer_cls)
+
+
+def _demultiplex_chunk(chunk, offsets):
+    seq_file_cls, seq_file_options, assigner, writer_cls = _worker_state
+    assigner.reset_counts()
+    collector = _CollectingWriter(writer_cls)
+    seq_file = seq_file_cls(*(_as_file(data) for data in chunk), **seq_file_options)
+    seq_file.demultiplex(assigner, collector, offsets=offsets)
+    return (
+        collector.formatted(),
+        assigner.read_counts,
+        assigner.unassigned_counts,
+        assigner.quality_counts,
+        assigner.hopped_counts,
+        _class_counts(assigner),
+    )
+
+
+def _class_counts(assigner):
+    if assigner.unassigned_classes is None:
+        return None
+    return assigner.unassigned_classes.counts
+
+
+def _as_file(data):
+    if isinstance(data, str):
+        return io.StringIO(data)
+    return io.BytesIO(data)
+
+
+def demultiplex_parallel(
+    seq_file, assigner, writer, threads, chunk_size=DEFAULT_CHUNK_SIZE, stats=None
+):
+    """Demultiplex using a pool of worker processes.
+
+    The input files are read and cut into chunks in this process.
+    Workers assign barcodes and format the output for each chunk.
+    Results are written in the original order of the chunks, so the
+    output is identical to that of seq_file.demultiplex().
+
+    If stats is given, the time spent reading the input, waiting for
+    the workers and writing the output is added to it.
+    """
+    samples = dict((s.name, s) for s in assigner.samples)
+    initargs = (type(seq_file), seq_file._options(), assigner, type(writer))
+    clock = time.perf_counter
+    with multiprocessing.Pool(threads, _init_worker, initargs) as pool:
+        pending = collections.deque()
+        chunks = seq_file.chunks(chunk_size)
+        # Position of the next chunk in each input file, for errors
+        offsets = [0] * len(seq_file._input_files())
+        read_seconds = 0.0
+        while True:
+            start = clock()
+            chunk = next(chunks, None)
+            read_seconds += clock() - start
+            if chunk is not None:
+                pending.append(pool.apply_async(_demultiplex_chunk, (chunk, offsets)))
+                offsets = [offset + len(data) for offset, data in zip(offsets, chunk)]
+                if len(pending) < threads * CHUNKS_PER_WORKER:
+                    continue
+            elif not pending:
+                break
+            start = clock()
+            result = pending.popleft().get()
+            received = clock()
+            _write_chunk_result(result, samples, assigner, writer)
+            if stats is not None:
+                read_counts = result[1]
+                stats.add_batch(
+                    sum(read_counts.values()),
+                    read_counts["unassigned"],
+                    parse=read_seconds,
+                    workers=received - start,
+                    write=clock() - received,
+                )
+                read_seconds = 0.0
+    return assigner.read_counts
+
+
+def _write_chunk_result(result, samples, assigner, writer):
+    # The outputs are followed by the counts from the worker's assigner
+    outputs, counts = result[0], result[1:]
+    for sample_name, data in outputs:
+        writer.write_formatted(data, samples[sample_name])
+    assigner.merge_counts(*counts)
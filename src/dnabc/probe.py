@@ -0,0 +1,186 @@
+import collections
+import itertools
+
+from .assigner import join_barcodes, reverse_complement
+
+# Index reads used to check the orientation of the barcodes
+DEFAULT_PROBE_READS = 100000
+
+Orientation = collections.namedtuple(
+    "Orientation", ["swap", "revcomp_i1", "revcomp_i2"]
+)
+
+
+def given_orientation(revcomp, dual):
+    """Orientation used by an assigner with the revcomp option.
+
+    Reverse complementing the joined I1 and I2 barcode is the same as
+    reverse complementing each index and swapping them.
+    """
+    return Orientation(revcomp and dual, revcomp, revcomp and dual)
+
+
+def orientations(dual):
+    """Orientations to try, for one or two index reads."""
+    if not dual:
+        return [Orientation(False, False, False), Orientation(False, True, False)]
+    return [Orientation(*x) for x in itertools.product([False, True], repeat=3)]
+
+
+def describe_orientation(orientation, dual):
+    if not dual:
+        return "reverse complemented" if orientation.revcomp_i1 else "as given"
+    changes = []
+    if orientation.swap:
+        changes.append("I1 and I2 swapped")
+    if orientation.revcomp_i1:
+        changes.append("I1 reverse complemented")
+    if orientation.revcomp_i2:
+        changes.append("I2 reverse complemented")
+    return ", ".join(changes) or "as given"
+
+
+def orient_barcode(barcode, orientation, index_lengths):
+    """The barcode as it would appear in the index reads.
+
+    For two index reads, the barcode is split into I1 and I2 by the
+    length of each read. If the barcode is swapped, the I2 sequence
+    comes first. Returns None if the barcode can not be split.
+    """
+    if len(index_lengths) == 1:
+        i1, i2 = barcode, ""
+    elif len(barcode) != sum(index_lengths):
+        # Only the whole barcode can be reverse complemented
+        if orientation == given_orientation(False, True):
+            return barcode
+        elif orientation == given_orientation(True, True):
+            return reverse_complement(barcode)
+        return None
+    elif orientation.swap:
+        i2, i1 = barcode[: index_lengths[1]], barcode[index_lengths[1] :]
+    else:
+        i1, i2 = barcode[: index_lengths[0]], barcode[index_lengths[0] :]
+    if orientation.revcomp_i1:
+        i1 = reverse_complement(i1)
+    if orientation.revcomp_i2:
+        i2 = reverse_complement(i2)
+    return i1 + i2
+
+
+def orient_samples(samples, orientation, index_lengths):
+    """Samples with their barcodes as they would appear in the reads."""
+    return [
+        s._replace(barcode=orient_barcode(s.barcode, orientation, index_lengths))
+        for s in samples
+    ]
+
+
+def read_barcodes(seq_file, num_reads=DEFAULT_PROBE_READS):
+    """Count the barcodes for the first reads in a sequence file.
+
+    Returns the count of each barcode, and the length of each index
+    read, or None if there are no reads.
+    """
+    barcode_counts = collections.Counter()
+    index_lengths = None
+    remaining = num_reads
+    for parts in seq_file.barcode_batches():
+        parts = [part[:remaining] for part in parts]
+        if not parts[0]:
+            break
+        if index_lengths is None:
+            index_lengths = tuple(len(part[0]) for part in parts)
+        barcode_counts.update(join_barcodes(*parts))
+        remaining -= len(parts[0])
+        if remaining <= 0:
+            break
+    return barcode_counts, index_lengths
+
+
+def probe_orientations(samples, barcode_counts, index_lengths):
+    """Count the reads matching the barcodes in each orientation.
+
+    Barcodes are matched exactly. Orientations that can not be applied
+    to every barcode are left out. Returns a list of orientations and
+    read counts, from the most to the fewest reads.
+    """
+    results = []
+    for orientation in orientations(len(index_lengths) == 2):
+        barcodes = set(
+            orient_barcode(s.barcode, orientation, index_lengths) for s in samples
+        )
+        if None in barcodes:
+            continue
+        count = sum(barcode_counts.get(bc, 0) for bc in barcodes)
+        results.append((orientation, count))
+    results.sort(key=_result_count, reverse=True)
+    return results
+
+
+def _result_count(result):
+    return result[1]
+
+
+def best_orientation(results, given, min_ratio=2):
+    """Pick the orientation with the most reads.
+
+    The given orientation is kept unless another one matches at least
+    min_ratio times as many reads.
+    """
+    given_count = dict(results)[given]
+    orientation, count = results[0]
+    if (count > 0) and (count >= min_ratio * given_count):
+        return orientation
+    return given
+
+
+def format_probe(results, num_reads, dual):
+    lines = ["dnabc: barcodes matched in the first {0} reads\n".format(num_reads)]
+    for orientation, count in results:
+        lines.append(
+            "dnabc:   {0:6.1%} {1}\n".format(
+                count / num_reads if num_reads else 0,
+                describe_orientation(orientation, dual),
+            )
+        )
+    return "".join(lines)
+
+
+def probe_barcodes(
+    samples,
+    seq_file,
+    revcomp,
+    num_reads=DEFAULT_PROBE_READS,
+    auto=False,
+    log_file=None,
+):
+    """Check the orientation of the barcodes against the first reads.
+
+    Every combination of reverse complementing and swapping the index
+    reads is tried. If another orientation matches many more reads than
+    the one given by revcomp, a ValueError is raised, or with auto, the
+    samples are returned with their barcodes in that orientation, to
+    be used without revcomp. Returns the samples and revcomp option.
+    """
+    barcode_counts, index_lengths = read_barcodes(seq_file, num_reads)
+    if index_lengths is None:
+        return samples, revcomp
+    dual = len(index_lengths) == 2
+    results = probe_orientations(samples, barcode_counts, index_lengths)
+    if log_file is not None:
+        log_file.write(format_probe(results, sum(barcode_counts.values()), dual))
+    given = given_orientation(revcomp, dual)
+    best = best_orientation(results, given)
+    if best == given:
+        return samples, revcomp
+    if not auto:
+        counts = dict(results)
+        raise ValueError(
+            "Barcodes match {0} reads with {1}, but only {2} reads with {3}".format(
+                counts[best],
+                describe_orientation(best, dual),
+                counts[given],
+                describe_orientation(given, dual),
+            )
+        )
+    return orient_samples(samples, best, index_lengths), False
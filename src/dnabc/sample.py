@@ -5,8 +5,13 @@ SampleBarcode = collections.namedtuple("SampleBarcode", ["name", "barcode"])
 
 def load_sample_barcodes(f):
     """Load SampleBarcode objects from barcode file."""
+    return build_sample_barcodes(parse_barcode_file(f))
+
+
+def build_sample_barcodes(names_barcodes):
+    """Create SampleBarcode objects from sample names and barcodes."""
     sample_bcs = []
-    for name, nonstandard_barcode in parse_barcode_file(f):
+    for name, nonstandard_barcode in names_barcodes:
         barcode = standardize_barcode(nonstandard_barcode)
         sample_bcs.append(SampleBarcode(name, barcode))
 
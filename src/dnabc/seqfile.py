@@ -1,14 +1,153 @@
+import io
+import re
+import time
+
+# Bytes (or characters, for text files) read from an input file at a time
+DEFAULT_BUFFER_SIZE = 1 << 20
+
+
 # Factory function for SequenceFile classes
-def SequenceFile(fwd, rev, fwd_idx=None, rev_idx=None):
+def SequenceFile(fwd, rev, fwd_idx=None, rev_idx=None, barcode_regex=None):
     if fwd_idx and rev_idx:
         return DualIndexFastqSequenceFile(fwd, rev, fwd_idx, rev_idx)
     elif fwd_idx:
         return IndexFastqSequenceFile(fwd, rev, fwd_idx)
     else:
-        return NoIndexFastqSequenceFile(fwd, rev)
+        return NoIndexFastqSequenceFile(fwd, rev, barcode_regex=barcode_regex)
+
+
+class _SequenceFile(object):
+    """Base class for sequence files"""
+
+    def _input_files(self):
+        """Input files, in the order accepted by the constructor."""
+        raise NotImplementedError()
+
+    def _options(self):
+        """Keyword arguments to create a copy with other input files."""
+        return {}
+
+    # Positions of the files with barcodes, in the list of input files
+    _barcode_files = ()
+
+    def _get_barcodes(self, *batches):
+        """Index sequences for a batch of reads, as parts for the assigner.
+
+        Batches are given for the files in _barcode_files. The assigner
+        joins the sequences for each read from every part.
+        """
+        raise NotImplementedError()
+
+    def _get_barcode_quals(self, *batches):
+        """Quality strings for the index sequences, or None if unknown."""
+        return None
+
+    def _assign_batch(self, assigner, batches):
+        parts = self._get_barcodes(*batches)
+        # Qualities are only looked up for assigners that use them
+        if getattr(assigner, "min_quality", None) is None:
+            return assigner.assign_batch(*parts)
+        quals = self._get_barcode_quals(*batches)
+        return assigner.assign_batch(*parts, quals=quals)
+
+    def demultiplex(self, assigner, writer, stats=None, offsets=None):
+        """Assign reads to samples and write them out.
+
+        If stats is given, the time spent reading, assigning and
+        writing each batch is added to it. If the input files are
+        chunks of larger files, offsets gives the position of each
+        chunk in its file, so that errors report the position in the
+        file.
+        """
+        # Writers without write_batch() are given one read pair at a time
+        write_batch = getattr(writer, "write_batch", None)
+        clock = time.perf_counter
+        batches_iter = self._batches(offsets)
+        while True:
+            start = clock()
+            batches = next(batches_iter, None)
+            if batches is None:
+                break
+            parsed = clock()
+            fwds, revs = batches[0], batches[1]
+            barcode_batches = [batches[n] for n in self._barcode_files]
+            samples = self._assign_batch(assigner, barcode_batches)
+            assigned = clock()
+            if write_batch is not None:
+                write_batch((fwds, revs), samples)
+            else:
+                for sample, fwd, rev in zip(samples, fwds.reads(), revs.reads()):
+                    writer.write((fwd, rev), sample)
+            if stats is not None:
+                stats.add_batch(
+                    len(samples),
+                    samples.count(None),
+                    parse=parsed - start,
+                    assign=assigned - parsed,
+                    write=clock() - assigned,
+                )
+        return assigner.read_counts
+
+    def assign(self, assigner):
+        """Assign reads to samples, reading only the files with barcodes.
+
+        Yields the list of samples for each batch of reads.
+        """
+        input_files = self._input_files()
+        parsers = [parse_fastq_batches(input_files[n]) for n in self._barcode_files]
+        for batches in zip_batches(*parsers):
+            yield self._assign_batch(assigner, batches)
+
+    def assigned_batches(self, assigner):
+        """Assign reads to samples, without writing them.
+
+        Yields the forward reads, reverse reads and list of samples for
+        each batch of reads.
+        """
+        for batches in self._batches():
+            barcode_batches = [batches[n] for n in self._barcode_files]
+            samples = self._assign_batch(assigner, barcode_batches)
+            yield batches[0], batches[1], samples
+
+    def barcode_batches(self):
+        """Index sequences for each batch of reads, as parts for the assigner.
+
+        Only the files with barcodes are read.
+        """
+        input_files = self._input_files()
+        parsers = [parse_fastq_batches(input_files[n]) for n in self._barcode_files]
+        for batches in zip_batches(*parsers):
+            yield self._get_barcodes(*batches)
 
+    def _batches(self, offsets=None):
+        input_files = self._input_files()
+        if offsets is None:
+            offsets = [0] * len(input_files)
+        parsers = [
+            parse_fastq_batches(f, offset=offset)
+            for f, offset in zip(input_files, offsets)
+        ]
+        return zip_batches(*parsers)
 
-class IndexFastqSequenceFile(object):
+    def chunks(self, n):
+        """Cut the input files into record-aligned chunks of n reads.
+
+        Each chunk is a list holding the contents of every input file,
+        in the order accepted by the constructor.
+        """
+        cutters = [cut_records(f, n) for f in self._input_files()]
+        for chunk in zip(*cutters):
+            # Truncate to the shortest file, as zip() does
+            newline = "\n" if isinstance(chunk[0], str) else b"\n"
+            num_reads = min(block.count(newline) // 4 for block in chunk)
+            if num_reads < n:
+                chunk = [
+                    block[: _records_end(block, num_reads, newline)] for block in chunk
+                ]
+            yield chunk
+
+
+class IndexFastqSequenceFile(_SequenceFile):
     """Illumina data, 3 file format: forward, reverse, index.
 
     This format is used by the MiSeq but not supported by newer HiSeq
@@ -20,18 +159,21 @@ class IndexFastqSequenceFile(object):
         self.reverse_file = rev
         self.index_file = idx
 
-    def demultiplex(self, assigner, writer):
-        idxs = (FastqRead(x) for x in parse_fastq(self.index_file))
-        fwds = (FastqRead(x) for x in parse_fastq(self.forward_file))
-        revs = (FastqRead(x) for x in parse_fastq(self.reverse_file))
-        for idx, fwd, rev in zip(idxs, fwds, revs):
-            bc = idx.seq
-            sample = assigner.assign(bc)
-            writer.write((fwd, rev), sample)
-        return assigner.read_counts
+    def _input_files(self):
+        return [self.forward_file, self.reverse_file, self.index_file]
+
+    _barcode_files = (2,)
 
+    @staticmethod
+    def _get_barcodes(idxs):
+        return (idxs.seqs,)
 
-class DualIndexFastqSequenceFile(object):
+    @staticmethod
+    def _get_barcode_quals(idxs):
+        return (idxs.quals,)
+
+
+class DualIndexFastqSequenceFile(_SequenceFile):
     """Illumina data, 4 file format: forward, reverse, fwd index, rev index.
 
     This format is used by the MiSeq
@@ -43,37 +185,66 @@ class DualIndexFastqSequenceFile(object):
         self.forward_index_file = fwd_idx
         self.reverse_index_file = rev_idx
 
-    def demultiplex(self, assigner, writer):
-        fwd_idxs = (FastqRead(x) for x in parse_fastq(self.forward_index_file))
-        rev_idxs = (FastqRead(x) for x in parse_fastq(self.reverse_index_file))
-        fwds = (FastqRead(x) for x in parse_fastq(self.forward_file))
-        revs = (FastqRead(x) for x in parse_fastq(self.reverse_file))
-        for fidx, ridx, fwd, rev in zip(fwd_idxs, rev_idxs, fwds, revs):
-            bc = fidx.seq + ridx.seq
-            sample = assigner.assign(bc)
-            writer.write((fwd, rev), sample)
-        return assigner.read_counts
+    def _input_files(self):
+        return [
+            self.forward_file,
+            self.reverse_file,
+            self.forward_index_file,
+            self.reverse_index_file,
+        ]
+
+    _barcode_files = (2, 3)
 
+    @staticmethod
+    def _get_barcodes(fidxs, ridxs):
+        return (fidxs.seqs, ridxs.seqs)
 
-class NoIndexFastqSequenceFile(object):
+    @staticmethod
+    def _get_barcode_quals(fidxs, ridxs):
+        return (fidxs.quals, ridxs.quals)
+
+
+class NoIndexFastqSequenceFile(_SequenceFile):
     """Illumina data, 2 file format: forward, reverse.
 
     This format is used by the newer HiSeq machines.  Barcodes are
     found in the description lines of each read.
+
+    By default, the barcode is the text after the final colon. Other
+    header layouts are handled with barcode_regex, a regular expression
+    whose first group matches the barcode.
     """
 
-    def __init__(self, fwd, rev):
+    def __init__(self, fwd, rev, barcode_regex=None):
         self.forward_file = fwd
         self.reverse_file = rev
+        self.barcode_regex = barcode_regex
+        self._patterns = {}
 
-    def demultiplex(self, assigner, writer):
-        fwds = (FastqRead(x) for x in parse_fastq(self.forward_file))
-        revs = (FastqRead(x) for x in parse_fastq(self.reverse_file))
-        for fwd, rev in zip(fwds, revs):
-            bc = self._parse_barcode(fwd.desc)
-            sample = assigner.assign(bc)
-            writer.write((fwd, rev), sample)
-        return assigner.read_counts
+    def _input_files(self):
+        return [self.forward_file, self.reverse_file]
+
+    def _options(self):
+        return {"barcode_regex": self.barcode_regex}
+
+    _barcode_files = (0,)
+
+    def _get_barcodes(self, fwds):
+        if not fwds.descs:
+            return ([],)
+        newline = "\n" if isinstance(fwds.descs[0], str) else b"\n"
+        pattern = self._patterns.get(newline)
+        if pattern is None:
+            pattern = self._patterns[newline] = _batch_barcode_pattern(
+                self.barcode_regex, newline
+            )
+        barcodes = _extract_barcodes(fwds.descs, pattern, newline)
+        if barcodes is None:
+            parse_barcode = self._parse_barcode
+            if self.barcode_regex is not None:
+                parse_barcode = self._barcode_parser(pattern)
+            barcodes = [parse_barcode(desc) for desc in fwds.descs]
+        return (barcodes,)
 
     @staticmethod
     def _parse_barcode(desc):
@@ -85,13 +256,76 @@ class NoIndexFastqSequenceFile(object):
         """
         # We simply grab anything past the final colon.
         # Newlines were removed by the FASTQ parsing function.
+        if isinstance(desc, bytes):
+            _, _, barcode_seq = desc.rpartition(b":")
+            return barcode_seq.translate(None, b"+-")
         _, _, barcode_seq = desc.rpartition(":")
         barcode_seq = barcode_seq.replace("+", "")
         barcode_seq = barcode_seq.replace("-", "")
         return barcode_seq
 
+    @staticmethod
+    def _barcode_parser(pattern):
+        def parse_barcode(desc):
+            m = pattern.match(desc)
+            if m is None:
+                raise ValueError("Barcode not found in description: %s" % desc)
+            return _remove_barcode_separators(m.group(1))
+
+        return parse_barcode
+
+
+def barcode_field_regex(n):
+    """Regular expression for the nth colon-separated field, from 1."""
+    if n < 1:
+        raise ValueError("Barcode field must be 1 or more (got %s)" % n)
+    return "(?:[^:\n]*:){%s}([^:\n]*)" % (n - 1)
+
+
+def _batch_barcode_pattern(barcode_regex, newline):
+    # Patterns are matched against the description lines of a batch,
+    # joined by newlines, finding one barcode per line. Each match
+    # consumes the rest of its line.
+    if barcode_regex is None:
+        # Text after the final colon
+        pattern = "^[^\n]*:([^:\n]*)$"
+    else:
+        pattern = "^[^\n]*?(?:%s)[^\n]*" % barcode_regex
+    if isinstance(newline, bytes):
+        pattern = pattern.encode()
+    pattern = re.compile(pattern, re.MULTILINE)
+    if pattern.groups < 1:
+        raise ValueError("Barcode regex must have a group for the barcode")
+    return pattern
+
+
+def _extract_barcodes(descs, pattern, newline):
+    """Find the barcodes for a batch of descriptions in one pass.
+
+    Returns None if a barcode is not found for every description, so
+    that the descriptions can be parsed one by one.
+    """
+    barcodes = pattern.findall(newline.join(descs))
+    if pattern.groups > 1:
+        barcodes = [groups[0] for groups in barcodes]
+    if len(barcodes) != len(descs):
+        return None
+    joined = _remove_barcode_separators(newline.join(barcodes))
+    return joined.split(newline)
+
+
+def _remove_barcode_separators(barcode):
+    # Dual index barcodes are separated by "+" or "-"
+    if isinstance(barcode, bytes):
+        return barcode.translate(None, b"+-")
+    return barcode.replace("+", "").replace("-", "")
+
 
 class FastqRead(object):
+    # Reads are created for every record, so we avoid a per-instance
+    # __dict__. The fields refer to the strings held by a FastqBatch.
+    __slots__ = ("desc", "seq", "qual")
+
     def __init__(self, read):
         self.desc, self.seq, self.qual = read
 
@@ -99,16 +333,236 @@ class FastqRead(object):
         return (self.desc, self.seq, self.qual)
 
 
-def _grouper(iterable, n):
-    "Collect data into fixed-length chunks or blocks"
-    # grouper('ABCDEFG', 3) --> ABC DEF
-    args = [iter(iterable)] * n
-    return zip(*args)
+class FastqBatch(object):
+    """Consecutive FASTQ records, held as parallel lists of fields.
+
+    Fields are bytes for binary input files and str for text files.
+    """
+
+    __slots__ = ("descs", "seqs", "quals")
+
+    def __init__(self, descs, seqs, quals):
+        self.descs = descs
+        self.seqs = seqs
+        self.quals = quals
+
+    def __len__(self):
+        return len(self.seqs)
+
+    def __iter__(self):
+        return zip(self.descs, self.seqs, self.quals)
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return (self.descs[key], self.seqs[key], self.quals[key])
+        return FastqBatch(self.descs[key], self.seqs[key], self.quals[key])
+
+    def reads(self):
+        return map(FastqRead, self)
+
+    def select(self, idxs):
+        """Batch of the records at the given positions."""
+        return FastqBatch(
+            list(map(self.descs.__getitem__, idxs)),
+            list(map(self.seqs.__getitem__, idxs)),
+            list(map(self.quals.__getitem__, idxs)),
+        )
+
+
+def parse_fastq_batches(f, buffer_size=DEFAULT_BUFFER_SIZE, offset=0):
+    """Parse FASTQ records in batches, reading large blocks of the file.
+
+    Records are found by splitting each block at newlines. Incomplete
+    records at the end of a block are carried over to the next one.
+    For binary files that can seek, such as memory-mapped files, the
+    incomplete records are read again at the start of the next block,
+    instead of being copied into it.
+
+    Errors give the position of the bad record, counted from offset.
+    """
+    buf = f.read(buffer_size)
+    newline = "\n" if isinstance(buf, str) else b"\n"
+    seekable = isinstance(buf, bytes) and _is_seekable(f)
+    # Reads from a seekable file only come up short at the end
+    eof = len(buf) < buffer_size
+    while buf:
+        more = (not eof) if seekable else f.read(buffer_size)
+        lines = buf.split(newline)
+        # The last item is a partial line, or is empty if the block
+        # ends with a newline
+        tail = lines.pop()
+        if more:
+            num_lines = len(lines) - (len(lines) % 4)
+            rest_size = len(tail) + sum(len(x) + 1 for x in lines[num_lines:])
+            del lines[num_lines:]
+            if not seekable:
+                buf = buf[len(buf) - rest_size :] + more
+            elif num_lines:
+                f.seek(-rest_size, io.SEEK_CUR)
+                buf = f.read(buffer_size)
+                eof = len(buf) < buffer_size
+            else:
+                # No complete record in the block
+                more = f.read(buffer_size)
+                eof = len(more) < buffer_size
+                buf += more
+        else:
+            # No newline at the end of the file
+            if tail:
+                lines.append(tail)
+            # Blank lines after the last record are ignored
+            while (len(lines) % 4) and not lines[-1].strip():
+                lines.pop()
+            if len(lines) % 4:
+                record_offset = offset + _lines_size(lines[: -(len(lines) % 4)])
+                raise ValueError("Truncated FASTQ record at offset %s" % record_offset)
+            buf = buf[:0]
+        if lines:
+            yield _make_batch(lines, offset)
+            offset += _lines_size(lines)
+
+
+def _is_seekable(f):
+    try:
+        return f.seekable()
+    except (AttributeError, ValueError):
+        return False
+
+
+def cut_records(f, n, buffer_size=DEFAULT_BUFFER_SIZE):
+    """Cut a FASTQ file into blocks of n records, without parsing them.
+
+    The last block may hold fewer than n records.
+    """
+    buf = f.read(buffer_size)
+    newline = "\n" if isinstance(buf, str) else b"\n"
+    num_lines = buf.count(newline)
+    eof = not buf
+    while buf:
+        parts = [buf]
+        while (num_lines < 4 * n) and not eof:
+            more = f.read(buffer_size)
+            parts.append(more)
+            num_lines += more.count(newline)
+            eof = not more
+        buf = buf[:0].join(parts)
+        if eof and not buf.endswith(newline):
+            buf += newline
+            num_lines += 1
+        num_reads = min(n, num_lines // 4)
+        if num_reads == 0:
+            # Incomplete record or blank lines at the end of the file,
+            # which are handled by the parser
+            yield buf
+            return
+        end = _records_end(buf, num_reads, newline, num_lines)
+        yield buf[:end]
+        buf = buf[end:]
+        num_lines -= 4 * num_reads
+        if not (buf or eof):
+            # The block ended on a record boundary, but the file goes on
+            buf = f.read(buffer_size)
+            num_lines = buf.count(newline)
+            eof = not buf
+
+
+def _records_end(buf, num_reads, newline, total_lines=None):
+    """Find the position after the first num_reads records in buf."""
+    return _lines_end(buf, 4 * num_reads, newline, total_lines)
+
+
+def _lines_end(buf, num_lines, newline, total_lines=None):
+    """Find the position after the first num_lines lines in buf."""
+    if num_lines == 0:
+        return 0
+    # Guess the position from the average line length in buf, then
+    # move one line at a time to correct the guess.
+    if total_lines is None:
+        total_lines = buf.count(newline)
+    pos = len(buf) * num_lines // total_lines
+    lines_before = buf.count(newline, 0, pos)
+    for _ in range(lines_before - num_lines):
+        pos = buf.rfind(newline, 0, pos)
+    if lines_before >= num_lines:
+        return buf.rfind(newline, 0, pos) + 1
+    for _ in range(num_lines - lines_before):
+        pos = buf.find(newline, pos) + 1
+    return pos
+
+
+def _lines_size(lines):
+    return sum(map(len, lines)) + len(lines)
+
+
+def _make_batch(lines, offset):
+    """Make a batch from the lines of whole records.
+
+    Whitespace, including carriage returns, is stripped from the end of
+    each description, sequence and quality line.
+    """
+    if isinstance(lines[0], str):
+        newline, at, plus, spaces = "\n", "@", "+", _SPACES
+    else:
+        newline, at, plus, spaces = b"\n", b"@", b"+", _SPACES_BYTES
+    descs = lines[0::4]
+    seqs = lines[1::4]
+    plus_lines = lines[2::4]
+    quals = lines[3::4]
+    # Count the lines starting with "@" or "+" without a loop in Python
+    joined_descs = newline + newline.join(descs) + newline
+    num_at = joined_descs.count(newline + at)
+    num_plus = (newline + newline.join(plus_lines)).count(newline + plus)
+    if not (num_at == num_plus == len(descs)):
+        for n, (desc, plus_line) in enumerate(zip(descs, plus_lines)):
+            if not (desc.startswith(at) and plus_line.startswith(plus)):
+                record_offset = offset + _lines_size(lines[: 4 * n])
+                raise ValueError("Malformed FASTQ record at offset %s" % record_offset)
+    # Looking for single characters is much faster than for a character
+    # followed by a newline, so that is only done if one is found
+    found = [c for c in spaces if c in joined_descs]
+    if any((c + newline) in joined_descs for c in found):
+        descs = [desc[1:].rstrip() for desc in descs]
+    else:
+        descs = [desc[1:] for desc in descs]
+    # Sequence and quality lines hold no whitespace, other than at the
+    # end, so they are only stripped if some is found
+    joined_seqs = newline.join(seqs)
+    joined_quals = newline.join(quals)
+    if any((c in joined_seqs) or (c in joined_quals) for c in spaces):
+        seqs = [x.rstrip() for x in seqs]
+        quals = [x.rstrip() for x in quals]
+    return FastqBatch(descs, seqs, quals)
+
+
+# Whitespace removed from the end of descriptions, as by str.rstrip()
+_SPACES = " \t\r\x0b\x0c"
+_SPACES_BYTES = [c.encode() for c in _SPACES]
+
+
+def zip_batches(*batch_iters):
+    """Align batches from several files to the same number of records.
+
+    As with zip(), iteration stops at the end of the shortest file.
+    """
+    pending = [None] * len(batch_iters)
+    while True:
+        for n, batch_iter in enumerate(batch_iters):
+            while not pending[n]:
+                pending[n] = next(batch_iter, None)
+                if pending[n] is None:
+                    return
+        num_reads = min(map(len, pending))
+        yield tuple(batch[:num_reads] for batch in pending)
+        pending = [batch[num_reads:] for batch in pending]
+
+
+def _decode_lines(lines):
+    """Convert a list of bytes to a list of str, in one pass."""
+    if not lines or isinstance(lines[0], str):
+        return lines
+    return b"\n".join(lines).decode("latin-1").split("\n")
 
 
 def parse_fastq(f):
-    for desc, seq, _, qual in _grouper(f, 4):
-        desc = desc.rstrip()[1:]
-        seq = seq.rstrip()
-        qual = qual.rstrip()
-        yield desc, seq, qual
+    for batch in parse_fastq_batches(f):
+        yield from batch
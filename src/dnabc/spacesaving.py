@@ -0,0 +1,115 @@
+import collections
+import heapq
+
+
+class SpaceSavingCounter(object):
+    """Approximate counts of the most common items, in bounded memory.
+
+    Follows the Space-Saving algorithm, with items dropped in bulk:
+    when the table grows to twice its capacity, it is cut down to at
+    most capacity items, those with the highest counts. An item that
+    is not in the table may have been dropped before, with a count of
+    up to the floor, the highest count dropped so far. New items
+    therefore start from the floor.
+
+    The count for an item is never too low, and is too high by at most
+    the error recorded for it. Until the table is first cut down,
+    every count is exact. Counters from several processes can be
+    combined with update(), keeping the same guarantees.
+    """
+
+    def __init__(self, capacity):
+        if capacity < 1:
+            raise ValueError("Capacity must be 1 or more (got %s)" % capacity)
+        self.capacity = capacity
+        self._counts = {}
+        self._errors = {}
+        self.floor = 0
+
+    def __len__(self):
+        return len(self._counts)
+
+    def __contains__(self, item):
+        return item in self._counts
+
+    def __getitem__(self, item):
+        return self._counts.get(item, 0)
+
+    def items(self):
+        return self._counts.items()
+
+    def error(self, item):
+        """Largest amount by which the count for item may be too high."""
+        return self._errors.get(item, self.floor)
+
+    def is_exact(self):
+        """True if no item has been dropped, so every count is exact."""
+        return self.floor == 0
+
+    def update(self, items):
+        """Add counts from another counter, a mapping, or a list of items."""
+        if isinstance(items, SpaceSavingCounter):
+            self._merge(items)
+            return
+        if not hasattr(items, "items"):
+            items = collections.Counter(items)
+        counts = self._counts
+        errors = self._errors
+        floor = self.floor
+        for item, n in items.items():
+            count = counts.get(item)
+            if count is None:
+                counts[item] = floor + n
+                errors[item] = floor
+            else:
+                counts[item] = count + n
+        if len(counts) >= 2 * self.capacity:
+            self._cut()
+
+    def _cut(self):
+        # Keep the items with the highest counts. Items tied with the
+        # highest count dropped are dropped as well.
+        if len(self._counts) <= self.capacity:
+            return
+        counts = sorted(self._counts.values(), reverse=True)
+        highest_dropped = counts[self.capacity]
+        self._counts = dict(
+            (item, n) for item, n in self._counts.items() if n > highest_dropped
+        )
+        self._errors = dict((item, self._errors[item]) for item in self._counts)
+        self.floor = max(self.floor, highest_dropped)
+
+    def _merge(self, other):
+        # An item missing from one counter may have been dropped from
+        # it, with a count of up to that counter's floor.
+        counts = {}
+        errors = {}
+        items = list(self._counts)
+        items.extend(item for item in other._counts if item not in self._counts)
+        for item in items:
+            count = 0
+            error = 0
+            for c in (self, other):
+                if item in c._counts:
+                    count += c._counts[item]
+                    error += c._errors[item]
+                else:
+                    count += c.floor
+                    error += c.floor
+            counts[item] = count
+            errors[item] = error
+        self._counts = counts
+        self._errors = errors
+        self.floor += other.floor
+        if len(counts) > self.capacity:
+            self._cut()
+
+    def most_common(self, n=None):
+        """List the n most common items and their counts, as Counter does."""
+        if n is None:
+            return sorted(self._counts.items(), key=_item_count, reverse=True)
+        return heapq.nlargest(n, self._counts.items(), key=_item_count)
+
+
+def _item_count(item_count):
+    return item_count[1]
@@ -1,6 +1,14 @@
 import csv
 import argparse
 
+from .assigner import BarcodeAssigner
+from .sample import build_sample_barcodes
+
+# Column names in the [Data] section of a sample sheet, in lowercase
+LANE_COLUMN = "lane"
+SAMPLE_COLUMNS = ["sample_id", "sample_name"]
+INDEX_COLUMNS = ["index", "index2"]
+
 
 def get_args(argv):
     parser = argparse.ArgumentParser(
@@ -12,20 +20,156 @@ def get_args(argv):
         type=argparse.FileType("r"),
         help="sample-sheet file",
     )
-    parser.add_argument("--lane", required=True, help="Lane number")
     parser.add_argument(
-        "--output", required=True, type=argparse.FileType("w"), help="output file"
+        "--lane",
+        action="append",
+        help=(
+            "Lane number. Can be given more than once; by default, all lanes "
+            "in the sample sheet are used with --output-pattern"
+        ),
+    )
+    parser.add_argument("--output", type=argparse.FileType("w"), help="output file")
+    parser.add_argument(
+        "--output-pattern",
+        help=(
+            "Output file for each lane, with {lane} in place of the lane "
+            "number, e.g. barcodes_L{lane}.tsv"
+        ),
+    )
+    parser.add_argument(
+        "--barcode-cache-dir",
+        help=(
+            "Also save the table of barcodes with mismatches for each lane "
+            "in this directory, for use with dnabc --barcode-cache-dir"
+        ),
+    )
+    parser.add_argument(
+        "--mismatches",
+        type=int,
+        default=0,
+        choices=BarcodeAssigner.allowed_mismatches,
+        help="Mismatches for the saved barcode tables (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--revcomp",
+        action="store_true",
+        help="Reverse complement barcodes in the saved barcode tables",
     )
     args = parser.parse_args(argv)
+    if (args.output is None) == (args.output_pattern is None):
+        parser.error("one of --output or --output-pattern is required")
+    if args.output and ((args.lane is None) or len(args.lane) != 1):
+        parser.error("--output requires exactly one --lane")
+    if args.output_pattern and ("{lane}" not in args.output_pattern):
+        parser.error("--output-pattern must contain {lane}")
     return args
 
 
+def parse_sample_sheet(f):
+    """Parse (lane, sample name, barcode) for each sample in a sample sheet.
+
+    Illumina sample sheets list samples in a [Data] section, starting
+    with a row of column names. The Lane, Sample_ID (or Sample_Name),
+    index and index2 columns are found by name, and the two index
+    sequences are joined. If there is no Lane column, the lane is
+    None. Other sections are skipped.
+
+    Sheets without sections or column names are read by position: the
+    lane is in the second column, the sample name in the third, and the
+    barcode in the fifth.
+    """
+    reader = csv.reader(f, delimiter=",")
+    in_other_section = False
+    columns = None
+    for row in reader:
+        first_cell = row[0].strip() if row else ""
+        if first_cell.startswith("["):
+            in_other_section = first_cell.lower() != "[data]"
+            # The first row of a [Data] section names the columns
+            columns = None if in_other_section else []
+            continue
+        if in_other_section or not any(cell.strip() for cell in row):
+            continue
+        if (columns == []) or ((columns is None) and _is_header(row)):
+            columns = _find_columns(row)
+        elif columns:
+            lane_col, sample_col, index_cols, num_columns = columns
+            # Trailing empty cells may be left out
+            cells = row + [""] * (num_columns - len(row))
+            lane = cells[lane_col].strip() if lane_col is not None else None
+            barcode = "".join(cells[n] for n in index_cols)
+            yield lane, cells[sample_col].replace(" ", ""), barcode.replace("-", "")
+        elif len(row) > 4:
+            yield row[1].strip(), row[2].replace(" ", ""), row[4].replace("-", "")
+
+
+def _is_header(row):
+    names = [cell.strip().lower() for cell in row]
+    return LANE_COLUMN in names and any(c in names for c in SAMPLE_COLUMNS)
+
+
+def _find_columns(row):
+    names = [cell.strip().lower() for cell in row]
+    lane_col = names.index(LANE_COLUMN) if LANE_COLUMN in names else None
+    sample_cols = [names.index(c) for c in SAMPLE_COLUMNS if c in names]
+    index_cols = [names.index(c) for c in INDEX_COLUMNS if c in names]
+    if not (sample_cols and index_cols):
+        raise ValueError(
+            "Sample sheet needs columns named Sample_ID (or Sample_Name) and "
+            "index, found: %s" % row
+        )
+    return lane_col, sample_cols[0], index_cols, len(row)
+
+
+def _barcode_writer(f):
+    # The header line is expected by dnabc when loading barcodes
+    w = csv.writer(f, delimiter="\t")
+    w.writerow(["SampleID", "BarcodeSequence"])
+    return w
+
+
 def main(argv=None):
     args = get_args(argv)
-    reader = csv.reader(args.sample_sheet, delimiter=",")
-    w = csv.writer(args.output, delimiter="\t")
-    for row in reader:
-        if row[1] == args.lane:
-            w.writerow([row[2].replace(" ", ""), row[4].replace("-", "")])
+    if args.output:
+        lane_files = {args.lane[0].strip(): args.output}
+    else:
+        lane_files = {}
+        for lane in args.lane or []:
+            lane_files[lane.strip()] = open(args.output_pattern.format(lane=lane), "w")
+    writers = {}
+    lane_samples = {}
+    for lane, f in lane_files.items():
+        writers[lane] = _barcode_writer(f)
+        lane_samples[lane] = []
+
+    # Samples for every lane are written in one pass over the sheet
+    for lane, sample_name, barcode in parse_sample_sheet(args.sample_sheet):
+        if lane is None:
+            if not args.lane:
+                raise ValueError("Sample sheet has no Lane column, use --lane")
+            lanes = list(writers)
+        elif lane in writers:
+            lanes = [lane]
+        elif args.lane or not lane.isdigit():
+            continue
+        else:
+            f = open(args.output_pattern.format(lane=lane), "w")
+            lane_files[lane] = f
+            writers[lane] = _barcode_writer(f)
+            lane_samples[lane] = []
+            lanes = [lane]
+        for lane in lanes:
+            writers[lane].writerow([sample_name, barcode])
+            lane_samples[lane].append((sample_name, barcode))
     args.sample_sheet.close()
-    args.output.close()
+    for f in lane_files.values():
+        f.close()
+
+    if args.barcode_cache_dir:
+        for names_barcodes in lane_samples.values():
+            BarcodeAssigner(
+                build_sample_barcodes(names_barcodes),
+                mismatches=args.mismatches,
+                revcomp=args.revcomp,
+                cache_dir=args.barcode_cache_dir,
+            )
@@ -0,0 +1,124 @@
+import collections
+import datetime
+import os
+import time
+
+
+class DemultiplexStats(object):
+    """Time spent in each stage of demultiplexing, and progress so far.
+
+    The demultiplexing loop reports each batch of reads with
+    add_batch(), along with the seconds spent in each stage. If a
+    progress_file is given, a line of progress is written to it every
+    progress_interval seconds. The fraction of the input read so far,
+    used to estimate the time left, is found by calling input_progress.
+    """
+
+    def __init__(self, progress_file=None, progress_interval=60, input_progress=None):
+        self.progress_file = progress_file
+        self.progress_interval = progress_interval
+        self.input_progress = input_progress
+        self.num_reads = 0
+        self.num_unassigned = 0
+        self.stage_seconds = collections.OrderedDict()
+        self._start = time.perf_counter()
+        self._next_progress = self._start + (progress_interval or 0)
+
+    def add_batch(self, num_reads, num_unassigned, **stage_seconds):
+        self.num_reads += num_reads
+        self.num_unassigned += num_unassigned
+        for stage, seconds in stage_seconds.items():
+            self.stage_seconds[stage] = self.stage_seconds.get(stage, 0.0) + seconds
+        if self.progress_file is not None:
+            now = time.perf_counter()
+            if now >= self._next_progress:
+                self.progress_file.write(self.format_progress(now))
+                self.progress_file.flush()
+                self._next_progress = now + self.progress_interval
+
+    def elapsed(self, now=None):
+        if now is None:
+            now = time.perf_counter()
+        return now - self._start
+
+    def format_progress(self, now=None):
+        elapsed = self.elapsed(now)
+        rate = self.num_reads / elapsed if elapsed else 0
+        parts = ["{0} reads".format(self.num_reads), "{0:.0f} reads/s".format(rate)]
+        fraction = self.input_progress() if self.input_progress else None
+        if fraction:
+            remaining = elapsed * (1 - fraction) / fraction
+            parts.append("{0:.1%} of input".format(fraction))
+            parts.append("ETA {0}".format(_format_seconds(remaining)))
+        if self.num_reads:
+            unassigned = self.num_unassigned / self.num_reads
+            parts.append("{0:.1%} unassigned".format(unassigned))
+        return "dnabc: {0}\n".format(", ".join(parts))
+
+    def report(
+        self,
+        read_counts,
+        writer,
+        quality_counts=None,
+        hopped_reads=None,
+        unassigned_classes=None,
+    ):
+        """Summary of the run, to be saved as JSON.
+
+        Should be called after the writer is closed, so that the size
+        of each output file is known. Counts of reads rescued or
+        rejected by index quality, of reads with hopped index pairs,
+        and of unassigned reads in each category of an
+        UnassignedClassifier are included if given.
+        """
+        elapsed = self.elapsed()
+        file_sizes = output_file_sizes(writer)
+        samples = []
+        for sample_name, n in read_counts.items():
+            if sample_name == "unassigned":
+                continue
+            samples.append(
+                collections.OrderedDict(
+                    [
+                        ("sample", sample_name),
+                        ("reads", n),
+                        ("bytes", file_sizes.get(sample_name, 0)),
+                    ]
+                )
+            )
+        stages = collections.OrderedDict(
+            (stage, round(seconds, 3)) for stage, seconds in self.stage_seconds.items()
+        )
+        report = collections.OrderedDict(
+            [
+                ("reads", self.num_reads),
+                ("unassigned_reads", read_counts.get("unassigned", 0)),
+                ("seconds", round(elapsed, 3)),
+                ("reads_per_sec", round(self.num_reads / elapsed) if elapsed else None),
+                ("stage_seconds", stages),
+                ("samples", samples),
+            ]
+        )
+        if quality_counts is not None:
+            report["index_quality"] = collections.OrderedDict(
+                (key, quality_counts[key]) for key in ("rescued", "rejected")
+            )
+        if hopped_reads is not None:
+            report["hopped_reads"] = hopped_reads
+        if unassigned_classes is not None:
+            report["unassigned_classes"] = unassigned_classes.totals()
+        return report
+
+
+def output_file_sizes(writer):
+    """Total size on disk of the output files for each sample."""
+    sizes = {}
+    for sample, fps in writer.output_files():
+        if isinstance(fps, str):
+            fps = [fps]
+        sizes[sample.name] = sum(os.path.getsize(fp) for fp in fps)
+    return sizes
+
+
+def _format_seconds(seconds):
+    return str(datetime.timedelta(seconds=round(seconds)))
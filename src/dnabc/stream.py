@@ -0,0 +1,55 @@
+import collections
+
+
+def demultiplex_batches(seq_file, assigner, unassigned=False):
+    """Assign reads to samples, yielding them instead of writing them.
+
+    For each batch of input reads, yields (sample, fwds, revs) for
+    every sample with reads in the batch, where fwds and revs are
+    FastqBatch objects holding the reads in their original order.
+    Fields are bytes for binary input files and str for text files.
+    If unassigned is true, unassigned reads are yielded as well, with
+    a sample of None. Read counts are kept by the assigner, as for
+    SequenceFile.demultiplex().
+    """
+    for fwds, revs, samples in seq_file.assigned_batches(assigner):
+        for item in sample_batches(fwds, revs, samples, unassigned):
+            yield item
+
+
+def sample_batches(fwds, revs, samples, unassigned=False):
+    """Split a batch of read pairs by sample.
+
+    Yields (sample, fwds, revs) for each sample, in the order in which
+    the samples first appear in the batch.
+    """
+    groups = collections.defaultdict(list)
+    for n, sample in enumerate(samples):
+        groups[sample].append(n)
+    if not unassigned:
+        groups.pop(None, None)
+    for sample, idxs in groups.items():
+        if len(idxs) == len(samples):
+            yield sample, fwds, revs
+        else:
+            yield sample, fwds.select(idxs), revs.select(idxs)
+
+
+class CallbackWriter(object):
+    """Writer that passes the reads for each sample to a function.
+
+    Can be given to SequenceFile.demultiplex() in place of a file
+    writer. The callback is called with (sample, fwds, revs) for every
+    sample in each batch of reads, as yielded by demultiplex_batches().
+    """
+
+    def __init__(self, callback, unassigned=False):
+        self.callback = callback
+        self.unassigned = unassigned
+
+    def write_batch(self, batchpair, samples):
+        fwds, revs = batchpair
+        for sample, sample_fwds, sample_revs in sample_batches(
+            fwds, revs, samples, self.unassigned
+        ):
+            self.callback(sample, sample_fwds, sample_revs)
@@ -0,0 +1,69 @@
+import hashlib
+import marshal
+import mmap
+import os
+import tempfile
+
+# Start of every cache file, changed when the layout changes
+CACHE_MAGIC = b"DNABCTB1"
+
+_DIGEST_SIZE = hashlib.sha256().digest_size
+_HEADER_SIZE = len(CACHE_MAGIC) + _DIGEST_SIZE
+
+
+def cache_filepath(cache_dir, *params):
+    """Path of the cache file for a table built from params.
+
+    Params must be values that marshal can serialize. The format
+    version of marshal is part of the key, because files written by
+    another Python version may not be readable.
+    """
+    key = marshal.dumps((marshal.version,) + params)
+    return os.path.join(cache_dir, "barcodes-%s.bin" % hashlib.sha256(key).hexdigest())
+
+
+def read_table(fp):
+    """Load a table saved by write_table(), or None if it is not usable.
+
+    The file is memory-mapped and its checksum verified before the
+    table is loaded, so a truncated or corrupt file is reported as
+    missing, to be rebuilt.
+    """
+    try:
+        with open(fp, "rb") as f:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                with memoryview(m) as view:
+                    if view[: len(CACHE_MAGIC)] != CACHE_MAGIC:
+                        return None
+                    payload = view[_HEADER_SIZE:]
+                    try:
+                        checksum = hashlib.sha256(payload).digest()
+                        if checksum != view[len(CACHE_MAGIC) : _HEADER_SIZE]:
+                            return None
+                        return marshal.loads(payload)
+                    finally:
+                        payload.release()
+    except (OSError, ValueError, EOFError, TypeError):
+        return None
+
+
+def write_table(fp, table):
+    """Save a table of marshal-compatible values to a cache file.
+
+    The file is written under a temporary name and then renamed, so
+    that other processes never see a partial file.
+    """
+    payload = marshal.dumps(table)
+    checksum = hashlib.sha256(payload).digest()
+    cache_dir = os.path.dirname(fp) or "."
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, temp_fp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(CACHE_MAGIC)
+            f.write(checksum)
+            f.write(payload)
+        os.replace(temp_fp, fp)
+    except BaseException:
+        os.unlink(temp_fp)
+        raise
@@ -1,5 +1,35 @@
+import collections
+import concurrent.futures
 import os.path
 
+from .gzipio import (
+    BGZF_EOF,
+    CompressedWriter,
+    DEFAULT_COMPRESSION_LEVEL,
+    DEFAULT_THREADS,
+)
+
+# Output for each file is collected in memory up to this size
+WRITE_BUFFER_SIZE = 1 << 18
+
+# Total memory for output buffers, across all files
+DEFAULT_BUFFER_MEMORY = 256 << 20
+
+# File descriptors kept free for input files and the Python runtime
+RESERVED_FILE_HANDLES = 64
+
+
+def default_max_open_files():
+    """Number of output files that can be open at once."""
+    try:
+        import resource
+    except ImportError:
+        return 256
+    soft_limit, _ = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft_limit == resource.RLIM_INFINITY:
+        return 4096
+    return max(2, soft_limit - RESERVED_FILE_HANDLES)
+
 
 def _get_sample_fp(self, sample):
     fn = "%s%s" % (sample.name, self.ext)
@@ -12,94 +42,284 @@ def _get_sample_paired_fp(self, sample):
     return (os.path.join(self.output_dir, fn1), os.path.join(self.output_dir, fn2))
 
 
+def write_qiime2_manifest(f, output_fps):
+    """Write a QIIME2 manifest for the output files of each sample.
+
+    output_fps holds (sample, filepath) or (sample, (fp1, fp2)) pairs,
+    as given by the output_files() method of a writer.
+    """
+    f.write("sample-id,absolute-filepath,direction\n")
+    for sample, fps in output_fps:
+        if isinstance(fps, str):
+            fps = (fps,)
+        for fp, direction in zip(fps, ("forward", "reverse")):
+            fp = os.path.abspath(fp)
+            f.write("{0},{1},{2}\n".format(sample.name, fp, direction))
+
+
+def write_read_counts(f, read_counts):
+    f.write("SampleID\tNumReads\n")
+    for sample_name, n in read_counts.items():
+        f.write("{0}\t{1}\n".format(sample_name, n))
+
+
+def write_unassigned_barcodes(f, barcode_counts):
+    f.write("Barcode\tNumReads\n")
+    for barcode, n in barcode_counts:
+        f.write("{0}\t{1}\n".format(barcode, n))
+
+
+def _group_by_sample(samples):
+    """Find the positions of the reads for each sample.
+
+    Unassigned reads, with a sample of None, are left out.
+    """
+    groups = collections.defaultdict(list)
+    for n, sample in enumerate(samples):
+        groups[sample].append(n)
+    groups.pop(None, None)
+    return groups
+
+
 class _SequenceWriter(object):
-    """Base class for writers"""
+    """Base class for writers
+
+    Output for each file is collected in a buffer and written in large
+    pieces. A buffer is written out when it reaches buffer_size, or when
+    the buffers for all files hold more than buffer_memory bytes. In
+    the latter case, the largest buffers are written first.
+
+    Only max_open_files files are kept open; when the limit is reached,
+    the least recently written file is closed, to be reopened in append
+    mode later.
+    """
+
+    buffer_size = WRITE_BUFFER_SIZE
 
-    def __init__(self, output_dir):
+    def __init__(
+        self,
+        output_dir,
+        compress=None,
+        compress_level=DEFAULT_COMPRESSION_LEVEL,
+        max_open_files=None,
+        buffer_memory=DEFAULT_BUFFER_MEMORY,
+    ):
         self.output_dir = output_dir
-        self._open_files = {}
+        self.compress = compress
+        self.compress_level = compress_level
+        if max_open_files is None:
+            max_open_files = default_max_open_files()
+        elif max_open_files < 1:
+            raise ValueError(
+                "Maximum number of open files must be 1 or more (got %s)"
+                % max_open_files
+            )
+        self.max_open_files = max_open_files
+        self.buffer_memory = buffer_memory
+        self._buffered_bytes = 0
+        # Output filepaths, in the order that samples were first written
+        self._output_fps = collections.OrderedDict()
+        self._buffers = {}
+        self._created_fps = set()
+        # Open files, from least to most recently used
+        self._open_files = collections.OrderedDict()
+        if compress:
+            self.ext = self.ext + ".gz"
+            self._executor = concurrent.futures.ThreadPoolExecutor(DEFAULT_THREADS)
+
+    def output_files(self):
+        """Output filepaths for each sample, in the order first written.
+
+        Returns a list of (sample, filepath) pairs, or (sample, (fp1,
+        fp2)) pairs for paired reads.
+        """
+        return list(self._output_fps.items())
 
     def write_qiime2_manifest(self, f):
-        f.write("sample-id,absolute-filepath,direction\n")
-        for sample, f1 in self._open_files.items():
-            fp1 = os.path.abspath(f1.name)
-            f.write("{0},{1},forward\n".format(sample.name, fp1))
+        write_qiime2_manifest(f, self.output_files())
 
     def write_read_counts(self, f, read_counts):
-        f.write("SampleID\tNumReads\n")
-        for sample_name, n in read_counts.items():
-            f.write("{0}\t{1}\n".format(sample_name, n))
+        write_read_counts(f, read_counts)
 
     def write_unassigned_barcodes(self, f, barcode_counts):
-        f.write("Barcode\tNumReads\n")
-        for barcode, n in barcode_counts:
-            f.write("{0}\t{1}\n".format(barcode, n))
+        write_unassigned_barcodes(f, barcode_counts)
 
-    def _get_output_file(self, sample):
-        f = self._open_files.get(sample)
-        if f is None:
+    def _get_sample_output_fp(self, sample):
+        fp = self._output_fps.get(sample)
+        if fp is None:
             fp = self._get_output_fp(sample)
-            f = self._open_filepath(fp)
-            self._open_files[sample] = f
+            self._output_fps[sample] = fp
+        return fp
+
+    def _append(self, fp, data):
+        buf = self._buffers.get(fp)
+        if buf is None:
+            buf = self._buffers[fp] = bytearray()
+        buf += data
+        self._buffered_bytes += len(data)
+        if len(buf) >= self.buffer_size:
+            self._flush(fp)
+        elif self._buffered_bytes > self.buffer_memory:
+            self._flush_largest()
+
+    def _flush(self, fp, release=False):
+        buf = self._buffers[fp]
+        if buf:
+            f = self._get_open_file(fp)
+            f.write(buf)
+            if release and self.compress:
+                # Otherwise the data would only move to the buffer of
+                # the compressor, outside of the budget
+                f.submit()
+            self._buffered_bytes -= len(buf)
+            buf.clear()
+
+    def _flush_largest(self):
+        # Free half of the budget, so that this happens rarely
+        by_size = sorted(self._buffers, key=lambda fp: len(self._buffers[fp]))
+        while by_size and (self._buffered_bytes > self.buffer_memory // 2):
+            self._flush(by_size.pop(), release=True)
+
+    def _get_open_file(self, fp):
+        f = self._open_files.get(fp)
+        if f is not None:
+            self._open_files.move_to_end(fp)
+            return f
+        if len(self._open_files) >= self.max_open_files:
+            _, lru_file = self._open_files.popitem(last=False)
+            self._close_file(lru_file, final=False)
+        # Files are created empty on first use, and appended to after
+        # being closed to stay within the limit.
+        if fp in self._created_fps:
+            f = self._open_filepath(fp, "ab")
+        else:
+            f = self._open_filepath(fp, "wb")
+            self._created_fps.add(fp)
+        self._open_files[fp] = f
         return f
 
-    def _open_filepath(self, fp):
-        return open(fp, "w")
+    def _open_filepath(self, fp, mode="wb"):
+        if self.compress:
+            return CompressedWriter(
+                fp, self._executor, self.compress, self.compress_level, mode=mode
+            )
+        return open(fp, mode)
+
+    def _close_file(self, f, final=True):
+        if self.compress:
+            # The BGZF end-of-file marker is only written once
+            f.close(eof=final)
+        else:
+            f.close()
 
     def write(self, read, sample):
         if sample is not None:
-            f = self._get_output_file(sample)
-            self._write_to_file(f, read)
+            self.write_formatted(self._format_read(read), sample)
+
+    def write_batch(self, batch, samples):
+        """Write a batch of reads, given the sample for each read.
+
+        The reads for each sample are joined and added to the output in
+        one piece, in their original order.
+        """
+        records = self._format_batch(batch)
+        for sample, idxs in _group_by_sample(samples).items():
+            self.write_formatted(b"".join(map(records.__getitem__, idxs)), sample)
+
+    @classmethod
+    def _format_batch(cls, batch):
+        return [cls._format_read(read) for read in batch.reads()]
+
+    @classmethod
+    def format_reads(cls, reads):
+        """Format reads for output with write_formatted()."""
+        return b"".join(cls._format_read(read) for read in reads)
+
+    def write_formatted(self, data, sample):
+        """Write the output of format_reads() for a sample."""
+        self._append(self._get_sample_output_fp(sample), data)
 
     def close(self):
+        for fp in self._buffers:
+            self._flush(fp)
         for f in self._open_files.values():
-            f.close()
+            self._close_file(f)
+        if self.compress == "bgzf":
+            # Files closed earlier to stay under the limit still need
+            # the end-of-file marker.
+            for fp in self._created_fps.difference(self._open_files):
+                with open(fp, "ab") as f:
+                    f.write(BGZF_EOF)
+        self._open_files.clear()
+        if self.compress:
+            self._executor.shutdown()
 
 
 class FastaWriter(_SequenceWriter):
     ext = ".fasta"
     _get_output_fp = _get_sample_fp
 
-    def _write_to_file(self, f, read):
-        f.write(">%s\n%s\n" % (read.desc, read.seq))
+    @staticmethod
+    def _format_read(read):
+        if isinstance(read.seq, str):
+            return (">%s\n%s\n" % (read.desc, read.seq)).encode()
+        return b">%s\n%s\n" % (read.desc, read.seq)
+
+    @classmethod
+    def _format_batch(cls, batch):
+        if batch.seqs and isinstance(batch.seqs[0], str):
+            return super(FastaWriter, cls)._format_batch(batch)
+        return list(map(b">%s\n%s\n".__mod__, zip(batch.descs, batch.seqs)))
 
 
 class FastqWriter(_SequenceWriter):
     ext = ".fastq"
     _get_output_fp = _get_sample_fp
 
-    def _open_filepath(self, fp):
-        return open(fp, "w")
+    @staticmethod
+    def _format_read(read):
+        if isinstance(read.seq, str):
+            return ("@%s\n%s\n+\n%s\n" % (read.desc, read.seq, read.qual)).encode()
+        return b"@%s\n%s\n+\n%s\n" % (read.desc, read.seq, read.qual)
 
-    def _write_to_file(self, f, read):
-        f.write("@%s\n%s\n+\n%s\n" % (read.desc, read.seq, read.qual))
+    @classmethod
+    def _format_batch(cls, batch):
+        if batch.seqs and isinstance(batch.seqs[0], str):
+            return super(FastqWriter, cls)._format_batch(batch)
+        # The records are rebuilt from their parsed lines in one pass,
+        # without a call per read. They are not sliced out of the input
+        # as byte ranges: that was slower to find than this format, and
+        # would keep the "+" lines, line endings and trailing spaces
+        # that the output has always normalized.
+        return list(map(b"@%s\n%s\n+\n%s\n".__mod__, batch))
 
 
 class PairedFastqWriter(FastqWriter):
     _get_output_fp = _get_sample_paired_fp
 
-    def _open_filepath(self, fps):
-        fp1, fp2 = fps
-        f1 = super(PairedFastqWriter, self)._open_filepath(fp1)
-        f2 = super(PairedFastqWriter, self)._open_filepath(fp2)
-        return (f1, f2)
+    def write(self, readpair, sample):
+        if sample is not None:
+            r1, r2 = readpair
+            fp1, fp2 = self._get_sample_output_fp(sample)
+            self._append(fp1, self._format_read(r1))
+            self._append(fp2, self._format_read(r2))
 
-    def _write_to_file(self, filepair, readpair):
-        f1, f2 = filepair
-        r1, r2 = readpair
-        super(PairedFastqWriter, self)._write_to_file(f1, r1)
-        super(PairedFastqWriter, self)._write_to_file(f2, r2)
+    def write_batch(self, batchpair, samples):
+        r1s, r2s = (self._format_batch(batch) for batch in batchpair)
+        for sample, idxs in _group_by_sample(samples).items():
+            data1 = b"".join(map(r1s.__getitem__, idxs))
+            data2 = b"".join(map(r2s.__getitem__, idxs))
+            self.write_formatted((data1, data2), sample)
 
-    def write_qiime2_manifest(self, f):
-        f.write("sample-id,absolute-filepath,direction\n")
-        for sample, filepair in self._open_files.items():
-            f1, f2 = filepair
-            fp1 = os.path.abspath(f1.name)
-            f.write("{0},{1},forward\n".format(sample.name, fp1))
-            fp2 = os.path.abspath(f2.name)
-            f.write("{0},{1},reverse\n".format(sample.name, fp2))
+    @classmethod
+    def format_reads(cls, readpairs):
+        r1s = [r1 for r1, _ in readpairs]
+        r2s = [r2 for _, r2 in readpairs]
+        format_reads = super(PairedFastqWriter, cls).format_reads
+        return (format_reads(r1s), format_reads(r2s))
 
-    def close(self):
-        for f1, f2 in self._open_files.values():
-            f1.close()
-            f2.close()
+    def write_formatted(self, datapair, sample):
+        fp1, fp2 = self._get_sample_output_fp(sample)
+        data1, data2 = datapair
+        self._append(fp1, data1)
+        self._append(fp2, data2)
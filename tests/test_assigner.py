@@ -1,9 +1,22 @@
 from collections import namedtuple, Counter
+import io
+import itertools
+import os
+import random
+import shutil
+import tempfile
 import unittest
 
 from src.dnabc.assigner import (
     BarcodeAssigner,
+    DualIndexBarcodeAssigner,
+    HammingBarcodeAssigner,
+    UnassignedClassifier,
     deambiguate,
+    hamming_distance,
+    join_barcodes,
+    mask_low_quality,
+    pack_barcodes,
     reverse_complement,
 )
 
@@ -61,6 +74,321 @@ class BarcodeAssignerTests(unittest.TestCase):
         barcode_counts = a.most_common_unassigned()
         self.assertEqual(list(barcode_counts), [("GGGGGG", 3), ("AAAAAA", 2)])
 
+    def test_assign_batch(self):
+        s1 = MockSample("S1", "ACGT")
+        s2 = MockSample("S2", "GGCCAA")
+        a = BarcodeAssigner([s1, s2], mismatches=1, revcomp=False)
+        obs = a.assign_batch([b"AC", b"GG", b"TT"], [b"NT", b"CCAA", b"TT"])
+        self.assertEqual(obs, [s1, s2, None])
+        self.assertEqual(a.read_counts, {"S1": 1, "S2": 1, "unassigned": 1})
+        self.assertEqual(a.unassigned_counts, Counter({"TTTT": 1}))
+
+    def test_max_unassigned(self):
+        s = MockSample("Abc", "ACCTGAC")
+        a = BarcodeAssigner([s], max_unassigned=2)
+        seqs = [b"GGGGGG"] * 3 + [b"AAAAAA"] * 2 + [b"CCCCCC", b"TTTTTT", b"GAGAGA"]
+        a.assign_batch(seqs)
+        self.assertEqual(a.read_counts, {"Abc": 0, "unassigned": 8})
+        self.assertEqual(a.most_common_unassigned(1), [("GGGGGG", 3)])
+        self.assertLessEqual(len(a.unassigned_counts), 2)
+        a.reset_counts()
+        self.assertEqual(len(a.unassigned_counts), 0)
+
+    def test_min_quality(self):
+        s = MockSample("Abc", "ACCTGAC")
+        # Only the barcode, and the barcode with one N, are in the table
+        a = BarcodeAssigner([s], mismatches=1, revcomp=False, min_quality=20)
+        self.assertEqual(len(a._barcodes), 8)
+        seqs = [b"ACCTGAC", b"ACGTGAC", b"ACGTGAC", b"ACGTGTC", b"ACCTGAC"]
+        quals = [b"IIIIIII", b"II#IIII", b"IIIIIII", b"II#II#I", b"II#II#I"]
+        # Mismatches at low-quality bases only, up to the limit. Exact
+        # matches are assigned, however many low-quality bases they have.
+        # The third read has its mismatch at a high-quality base, so it
+        # is rejected, though it is within the mismatches of the barcode.
+        self.assertEqual(a.assign_batch(seqs, quals=[quals]), [s, s, None, None, s])
+        self.assertEqual(a.read_counts, {"Abc": 3, "unassigned": 2})
+        self.assertEqual(a.quality_counts, {"rescued": 1, "rejected": 1})
+        self.assertEqual(a.unassigned_counts, Counter({"ACGTGAC": 1, "ACGTGTC": 1}))
+
+        packed = BarcodeAssigner(
+            [s], mismatches=1, revcomp=False, packed=True, min_quality=20
+        )
+        self.assertEqual(
+            packed.assign_batch(seqs, quals=[quals]), [s, s, None, None, s]
+        )
+        self.assertEqual(packed.quality_counts, a.quality_counts)
+
+    def test_min_quality_matching_bases(self):
+        s1 = MockSample("S1", "AAAAAAAA")
+        s2 = MockSample("S2", "AAAACCCC")
+        a = BarcodeAssigner([s1, s2], mismatches=1, revcomp=False, min_quality=20)
+        seqs = ["AAAAAAAA", "AAAAAAAG", "AAAACCAA"]
+        quals = ["########", "#####I##", "III###II"]
+        # Low-quality bases that match do not count as mismatches
+        self.assertEqual(a.assign_batch(seqs, quals=[quals]), [s1, s1, None])
+        self.assertEqual(a.quality_counts, {"rescued": 1, "rejected": 0})
+
+        s3 = MockSample("S3", "AACC")
+        s4 = MockSample("S4", "AAAA")
+        a = BarcodeAssigner([s3, s4], mismatches=1, revcomp=False, min_quality=20)
+        # The low-quality bases could be read as either barcode
+        self.assertEqual(a.assign_batch(["AACA"], quals=[["II##"]]), [None])
+        self.assertEqual(a.quality_counts, {"rescued": 0, "rejected": 1})
+        a = BarcodeAssigner([s3, s4], mismatches=0, revcomp=False, min_quality=20)
+        self.assertEqual(a.assign_batch(["AACC"], quals=[["####"]]), [s3])
+
+    def test_packed(self):
+        samples = [MockSample("S1", "ACGTAC"), MockSample("S2", "TTGGCA")]
+        a1 = BarcodeAssigner(samples, mismatches=1)
+        a2 = BarcodeAssigner(samples, mismatches=1, packed=True)
+        self.assertEqual(len(a2._barcodes), len(a1._barcodes))
+        seqs = ["".join(x) for x in itertools.product("ACGTN", repeat=3)]
+        fwds = [b"GTA" for _ in seqs] + [b"TGCC" for _ in seqs]
+        revs = [seq.encode() for seq in seqs] + [seq[:2].encode() for seq in seqs]
+        self.assertEqual(a2.assign_batch(fwds, revs), a1.assign_batch(fwds, revs))
+        self.assertEqual(a2.read_counts, a1.read_counts)
+        self.assertEqual(a2.unassigned_counts, a1.unassigned_counts)
+        self.assertEqual(a2.assign("GTACGN"), a1.assign("GTACGN"))
+
+    def test_cache_dir(self):
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        samples = [MockSample("S1", "ACGTAC"), MockSample("S2", "TTGGCA")]
+        a1 = BarcodeAssigner(samples, mismatches=1, cache_dir=cache_dir)
+        (cache_fn,) = os.listdir(cache_dir)
+        cache_fp = os.path.join(cache_dir, cache_fn)
+
+        a2 = BarcodeAssigner(samples, mismatches=1, cache_dir=cache_dir)
+        self.assertEqual(a2._barcodes, a1._barcodes)
+        self.assertIs(a2.assign("GTACGN"), samples[0])
+
+        # Corrupt files are rebuilt
+        with open(cache_fp, "r+b") as f:
+            f.seek(-1, os.SEEK_END)
+            f.write(b"X")
+        a3 = BarcodeAssigner(samples, mismatches=1, cache_dir=cache_dir)
+        self.assertEqual(a3._barcodes, a1._barcodes)
+        a4 = BarcodeAssigner(samples, mismatches=1, cache_dir=cache_dir)
+        self.assertEqual(a4._barcodes, a1._barcodes)
+
+        # Other settings use another file
+        a5 = BarcodeAssigner(samples, mismatches=0, cache_dir=cache_dir)
+        self.assertEqual(len(a5._barcodes), 2)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+
+class HammingBarcodeAssignerTests(unittest.TestCase):
+    def test_one_mismatch(self):
+        s = MockSample("Abc", "ACCTGAC")
+        a = HammingBarcodeAssigner([s], mismatches=1, revcomp=True)
+        self.assertEqual(a.assign("GTCAGGT"), s)
+        self.assertEqual(a.assign("GTCAAGT"), s)
+        self.assertEqual(a.assign("GTCANGT"), s)
+        self.assertEqual(a.assign("GTCAAAT"), None)
+        self.assertEqual(a.assign("GTCAGG"), None)
+        self.assertEqual(a.read_counts, {"Abc": 3, "unassigned": 2})
+        self.assertEqual(a.unassigned_counts, Counter({"GTCAAAT": 1, "GTCAGG": 1}))
+
+    def test_three_mismatches(self):
+        s1 = MockSample("S1", "AAAAAAAAAAAA")
+        s2 = MockSample("S2", "CCCCCCCCCCCC")
+        a = HammingBarcodeAssigner([s1, s2], mismatches=3, revcomp=False)
+        self.assertEqual(a.assign("AGAAAATAAANA"), s1)
+        self.assertEqual(a.assign("CCCCCCCCAAAC"), s2)
+        self.assertEqual(a.assign("CCCCCCCAAAAC"), None)
+
+    def test_short_barcodes(self):
+        # Barcodes shorter than (2 * mismatches + 1) can not be cut into
+        # enough segments, and are compared to each other directly
+        samples = [MockSample("S1", "AAAA"), MockSample("S2", "CCCC")]
+        self.assertRaises(
+            ValueError, HammingBarcodeAssigner, samples, mismatches=2, revcomp=False
+        )
+        samples = [MockSample("S1", "AAAAAAAA"), MockSample("S2", "CCCCCCCC")]
+        self.assertRaises(
+            ValueError, HammingBarcodeAssigner, samples, mismatches=4, revcomp=False
+        )
+        # Reads are compared to barcodes with no more bases than mismatches
+        s1 = MockSample("S1", "ACG")
+        s2 = MockSample("S2", "ACGTACGTAC")
+        a = HammingBarcodeAssigner([s1, s2], mismatches=3, revcomp=False)
+        self.assertEqual(a.assign("TGC"), s1)
+        self.assertEqual(a.assign("ACGTTTTTAC"), s2)
+
+    def test_ambiguous_barcodes(self):
+        # Same check as the hash table for 1 mismatch
+        rng = random.Random(0)
+        for _ in range(200):
+            bc1 = "".join(rng.choice("ACGT") for _ in range(5))
+            bc2 = "".join(rng.choice("ACGT") for _ in range(5))
+            if bc1 == bc2:
+                continue
+            samples = [MockSample("S1", bc1), MockSample("S2", bc2)]
+            try:
+                BarcodeAssigner(samples, mismatches=1)
+                hash_ok = True
+            except ValueError:
+                hash_ok = False
+            try:
+                HammingBarcodeAssigner(samples, mismatches=1)
+                hamming_ok = True
+            except ValueError:
+                hamming_ok = False
+            self.assertEqual(hamming_ok, hash_ok, (bc1, bc2))
+
+    def test_same_as_hash(self):
+        samples = [
+            MockSample("S1", "ACGTACGT"),
+            MockSample("S2", "TTGGCCAA"),
+            MockSample("S3", "GATCGATC"),
+        ]
+        a1 = BarcodeAssigner(samples, mismatches=1)
+        a2 = HammingBarcodeAssigner(samples, mismatches=1)
+        for seq in itertools.product("ACGTN", repeat=4):
+            for prefix in ["TTGG", "ACGT", "GATC"]:
+                bc = prefix + "".join(seq)
+                self.assertEqual(a2.assign(bc), a1.assign(bc), bc)
+        self.assertEqual(a2.read_counts, a1.read_counts)
+
+    def test_packed(self):
+        s = MockSample("Abc", "ACCTGAC")
+        a = HammingBarcodeAssigner([s], mismatches=1, revcomp=True, packed=True)
+        self.assertEqual(a.assign_batch(["GTCANGT", "GTCAAAT"]), [s, None])
+        self.assertEqual(a.assign("GTCANGT"), s)
+        self.assertEqual(a.unassigned_counts, Counter({"GTCAAAT": 1}))
+
+    def test_min_quality(self):
+        s = MockSample("Abc", "ACCTGAC")
+        self.assertRaises(ValueError, HammingBarcodeAssigner, [s], min_quality=20)
+
+
+class DualIndexBarcodeAssignerTests(unittest.TestCase):
+    def setUp(self):
+        # Samples S1 and S3 share the same I1 sequence
+        self.samples = [
+            MockSample("S1", "AAAACCCC"),
+            MockSample("S2", "GGGGTTTT"),
+            MockSample("S3", "AAAATTTT"),
+        ]
+
+    def test_assign_batch(self):
+        s1, s2, s3 = self.samples
+        a = DualIndexBarcodeAssigner(
+            self.samples, mismatches_i1=1, mismatches_i2=0, revcomp=False
+        )
+        obs = a.assign_batch(
+            [b"AAAA", b"AAAT", b"GGGG", b"ACGT", b"AAAA"],
+            [b"CCCC", b"TTTT", b"CCCC", b"CCCC", b"CCCA"],
+        )
+        self.assertEqual(obs, [s1, s3, None, None, None])
+        self.assertEqual(a.i1_length, 4)
+        self.assertEqual(a.read_counts, {"S1": 1, "S2": 0, "S3": 1, "unassigned": 3})
+        # Index pairs from different samples are counted separately
+        self.assertEqual(a.hopped_counts, Counter({"GGGG+CCCC": 1}))
+        self.assertEqual(
+            a.unassigned_counts,
+            Counter({"GGGGCCCC": 1, "ACGTCCCC": 1, "AAAACCCA": 1}),
+        )
+        self.assertEqual(a.assign("AANACCCC"), s1)
+
+    def test_classify_hopped(self):
+        a = DualIndexBarcodeAssigner(
+            self.samples,
+            mismatches_i1=1,
+            mismatches_i2=1,
+            revcomp=False,
+            classify_unassigned=True,
+        )
+        # Hopped pairs after correcting one error in each index
+        a.assign_batch([b"GGGA", b"GGGG", b"ACGT"], [b"CCCA", b"CCCC", b"ACGT"])
+        self.assertEqual(sum(a.hopped_counts.values()), 2)
+        self.assertEqual(a.unassigned_classes.totals()["hopped"], 2)
+        self.assertEqual(
+            a.unassigned_counts, Counter({"GGGACCCA": 1, "GGGGCCCC": 1, "ACGTACGT": 1})
+        )
+
+    def test_table_size(self):
+        a = DualIndexBarcodeAssigner(
+            self.samples, mismatches_i1=1, mismatches_i2=1, i1_length=4
+        )
+        # Each distinct index, 3 substitutions and one N for each base
+        self.assertEqual(len(a._i1_table), 2 * (1 + 4 * 4))
+        self.assertEqual(len(a._i2_table), 2 * (1 + 4 * 4))
+
+    def test_close_indexes(self):
+        samples = [MockSample("S1", "AAAACCCC"), MockSample("S2", "AAATGGGG")]
+        DualIndexBarcodeAssigner(samples, mismatches_i2=1, revcomp=False, i1_length=4)
+        self.assertRaises(ValueError, DualIndexBarcodeAssigner, samples, 1, 0, False, 4)
+        # Without i1_length, barcodes are split in half, before any reads
+        self.assertRaises(ValueError, DualIndexBarcodeAssigner, samples, 1, 0, False)
+        a = DualIndexBarcodeAssigner(samples)
+        self.assertRaises(ValueError, a.assign_batch, [b"AAAACCCC"])
+        self.assertRaises(ValueError, a.assign_batch, [b"AAAAC"], [b"CCC"])
+
+
+class UnassignedClassifierTests(unittest.TestCase):
+    def setUp(self):
+        self.samples = [
+            MockSample("S1", "AAAACCCC"),
+            MockSample("S2", "GGGGTTTT"),
+            MockSample("S3", "CCCCAAAA"),
+        ]
+        self.barcodes = [s.barcode for s in self.samples]
+        self.seqs = [
+            # Hopped pairs
+            "AAAATTTT",
+            "AAAATTTT",
+            "GGGGCCCC",
+            # With N
+            "ANAACCCC",
+            # Near miss to S1
+            "AAAACCTT",
+            # Unknown, including one as close to S1 as to S2
+            "AAGGCCTT",
+            "ACGTACGT",
+        ]
+
+    def test_add(self):
+        c = UnassignedClassifier(self.samples, self.barcodes, max_mismatches=2)
+        c.add(self.seqs, i1_length=4)
+        self.assertEqual(
+            c.totals(), {"hopped": 3, "n": 1, "near_miss": 1, "unknown": 2}
+        )
+        # Without the length of I1, pairs are not split
+        c = UnassignedClassifier(self.samples, self.barcodes, max_mismatches=2)
+        c.add(self.seqs)
+        self.assertEqual(
+            c.totals(), {"hopped": 0, "n": 1, "near_miss": 1, "unknown": 5}
+        )
+
+    def test_write_matrix(self):
+        c = UnassignedClassifier(self.samples, self.barcodes, max_mismatches=2)
+        c.add(self.seqs, i1_length=4)
+        other = UnassignedClassifier(self.samples, self.barcodes, max_mismatches=2)
+        other.add(["CCCCTTTT"], i1_length=4)
+        c.merge(other.counts)
+        f = io.StringIO()
+        c.write_matrix(f)
+        self.assertEqual(
+            f.getvalue(),
+            "I1/I2\tS1\tS2\tS3\n" "S1\t1\t2\t0\n" "S2\t1\t0\t0\n" "S3\t0\t1\t0\n",
+        )
+
+    def test_assigner(self):
+        s1, s2, _ = self.samples
+        a = BarcodeAssigner(self.samples, revcomp=False, classify_unassigned=True)
+        obs = a.assign_batch([b"AAAA", b"GGGG", b"GGGG"], [b"TTTT", b"TTTT", b"TTTA"])
+        self.assertEqual(obs, [None, s2, None])
+        self.assertEqual(
+            a.unassigned_classes.totals(),
+            {"hopped": 1, "n": 0, "near_miss": 1, "unknown": 0},
+        )
+        classes = a.unassigned_classes
+        a.reset_counts()
+        self.assertIs(a.unassigned_classes, classes)
+        self.assertEqual(sum(classes.counts.values()), 0)
+        self.assertIn("TTTA", {seq[-4:] for seq in classes._codes})
+
 
 class FunctionTests(unittest.TestCase):
     def test_deambiguate(self):
@@ -72,6 +400,43 @@ class FunctionTests(unittest.TestCase):
         exp = set(["AGA", "AGC", "AGG", "AGT"])
         self.assertEqual(obs, exp)
 
+    def test_hamming_distance(self):
+        self.assertEqual(hamming_distance("ACGT", "ACGT"), 0)
+        self.assertEqual(hamming_distance("ACGT", "ANGA"), 2)
+
+    def test_join_barcodes(self):
+        self.assertEqual(join_barcodes([b"AC", b"G"]), ["AC", "G"])
+        self.assertEqual(join_barcodes(["AC", "G"], [b"T", b"CA"]), ["ACT", "GCA"])
+
+    def test_mask_low_quality(self):
+        self.assertEqual(
+            mask_low_quality([b"ACGT", b"TTGG"], [b"I#II", b"IIII"], 20),
+            [b"ANGT", b"TTGG"],
+        )
+        self.assertEqual(
+            mask_low_quality(["ACGT", "TTGG"], ["I#II", "I5I#"], 20),
+            ["ANGT", "TTGN"],
+        )
+        seqs = ["ACGT", "TTGG"]
+        self.assertIs(mask_low_quality(seqs, ["IIII", "5555"], 20), seqs)
+
+    def test_pack_barcodes(self):
+        self.assertEqual(pack_barcodes(["ACGT"]), [(1 << 12) | 0b00011011])
+        self.assertEqual(pack_barcodes([b"AN"]), [(1 << 6) | (0b01 << 4)])
+        # Same keys if the barcodes are split differently
+        self.assertEqual(
+            pack_barcodes([b"AC", b"GTN"], [b"GTN", b"AC"]),
+            pack_barcodes([b"ACGTN", b"GTNAC"]),
+        )
+        self.assertEqual(
+            pack_barcodes([b"A", b"GTN"], [b"CGTN", b"AC"]),
+            pack_barcodes([b"ACGTN", b"GTNAC"]),
+        )
+        # Length is part of the key
+        self.assertNotEqual(pack_barcodes(["A"]), pack_barcodes(["AA"]))
+        self.assertEqual(pack_barcodes(["AC+T", "", "AC"]), [None, 1, 65])
+        self.assertEqual(pack_barcodes([]), [])
+
     def test_reverse_complement(self):
         self.assertEqual(reverse_complement("AGATC"), "GATCT")
         self.assertRaises(KeyError, reverse_complement, "ANCC")
@@ -0,0 +1,159 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.dnabc.assigner import BarcodeAssigner
+from src.dnabc.assignments import (
+    assign_main,
+    read_assignments_header,
+    split_main,
+    split_reads,
+    write_assignments,
+)
+from src.dnabc.sample import SampleBarcode
+from src.dnabc.seqfile import IndexFastqSequenceFile, NoIndexFastqSequenceFile
+from src.dnabc.writer import PairedFastqWriter
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(TEST_DIR, "data")
+
+
+def data_file(fn):
+    return open(os.path.join(DATA_DIR, fn), "rb")
+
+
+class AssignmentTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _demultiplex(self, output_dir, seq_file_cls, samples, fns, revcomp):
+        os.mkdir(os.path.join(self.temp_dir, output_dir))
+        writer = PairedFastqWriter(os.path.join(self.temp_dir, output_dir))
+        assigner = BarcodeAssigner(samples, mismatches=1, revcomp=revcomp)
+        seq_file_cls(*map(data_file, fns)).demultiplex(assigner, writer)
+        writer.close()
+        return assigner.read_counts
+
+    def _assign_and_split(self, output_dir, seq_file_cls, samples, fns, revcomp):
+        os.mkdir(os.path.join(self.temp_dir, output_dir))
+        assigner = BarcodeAssigner(samples, mismatches=1, revcomp=revcomp)
+        # Files without barcodes are not read
+        files = [
+            data_file(fn) if n >= 2 or not fns[2:] else None for n, fn in enumerate(fns)
+        ]
+        assignments = io.BytesIO()
+        write_assignments(seq_file_cls(*files), assigner, assignments)
+        assignments.seek(0)
+        writer = PairedFastqWriter(os.path.join(self.temp_dir, output_dir))
+        read_counts = split_reads(
+            assignments, data_file(fns[0]), data_file(fns[1]), writer
+        )
+        writer.close()
+        self.assertEqual(read_counts, assigner.read_counts)
+        return read_counts
+
+    def _assert_same_output(self, dir1, dir2):
+        fns = sorted(os.listdir(os.path.join(self.temp_dir, dir1)))
+        self.assertEqual(sorted(os.listdir(os.path.join(self.temp_dir, dir2))), fns)
+        for fn in fns:
+            with open(os.path.join(self.temp_dir, dir1, fn), "rb") as f1:
+                with open(os.path.join(self.temp_dir, dir2, fn), "rb") as f2:
+                    self.assertEqual(f1.read(), f2.read())
+
+    def test_index_files(self):
+        samples = [
+            SampleBarcode("SampleA", "AAAA"),
+            SampleBarcode("SampleB", "ACGTACGT"),
+        ]
+        fns = ["tiny_R1.fastq", "tiny_R2.fastq", "tiny_I1.fastq"]
+        args = (IndexFastqSequenceFile, samples, fns, False)
+        exp = self._demultiplex("direct", *args)
+        obs = self._assign_and_split("split", *args)
+        self.assertEqual(obs, exp)
+        self.assertEqual(obs["SampleB"], 1)
+        self._assert_same_output("direct", "split")
+
+    def test_no_index_files(self):
+        samples = [
+            SampleBarcode("SampleA", "CTTACTAGAGACTACA"),
+            SampleBarcode("SampleB", "GTTTCGCCCTAGTACA"),
+        ]
+        fns = ["med_R1.fastq", "med_R2.fastq"]
+        args = (NoIndexFastqSequenceFile, samples, fns, False)
+        exp = self._demultiplex("direct", *args)
+        obs = self._assign_and_split("split", *args)
+        self.assertEqual(obs, exp)
+        self._assert_same_output("direct", "split")
+
+    def test_header(self):
+        samples = [SampleBarcode("S%s" % n, "A" * n) for n in range(1, 300)]
+        assigner = BarcodeAssigner(samples, revcomp=False)
+        f = io.BytesIO()
+        write_assignments(
+            IndexFastqSequenceFile(None, None, data_file("tiny_I1.fastq")), assigner, f
+        )
+        f.seek(0)
+        obs_samples, typecode = read_assignments_header(f)
+        self.assertEqual(obs_samples, samples)
+        self.assertEqual(typecode, "H")
+        # Two bytes for each of 3 reads
+        self.assertEqual(len(f.read()), 6)
+
+        self.assertRaises(ValueError, read_assignments_header, io.BytesIO(b"ACGT"))
+
+    def test_read_number_mismatch(self):
+        samples = [SampleBarcode("SampleA", "ACGTACGT")]
+        assigner = BarcodeAssigner(samples, revcomp=False)
+        f = io.BytesIO()
+        seq_file = IndexFastqSequenceFile(None, None, data_file("tiny_I1.fastq"))
+        write_assignments(seq_file, assigner, f)
+        writer = PairedFastqWriter(self.temp_dir)
+        for data in [f.getvalue()[:-1], f.getvalue() + b"\0"]:
+            self.assertRaises(
+                ValueError,
+                split_reads,
+                io.BytesIO(data),
+                data_file("tiny_R1.fastq"),
+                data_file("tiny_R2.fastq"),
+                writer,
+            )
+
+    def test_main(self):
+        barcode_fp = os.path.join(self.temp_dir, "barcodes.txt")
+        with open(barcode_fp, "w") as f:
+            f.write("SampleID\tBarcodeSequence\nSampleA\tACGTACGT\n")
+        assignments_fp = os.path.join(self.temp_dir, "assignments.bin")
+        counts_fp = os.path.join(self.temp_dir, "counts.tsv")
+        assign_main(
+            [barcode_fp, assignments_fp]
+            + ["--i1-fastq", os.path.join(DATA_DIR, "tiny_I1.fastq")]
+            + ["--total-reads-file", counts_fp]
+        )
+        with open(counts_fp) as f:
+            self.assertEqual(
+                f.read(), "SampleID\tNumReads\nSampleA\t1\nunassigned\t2\n"
+            )
+
+        output_dir = os.path.join(self.temp_dir, "output")
+        split_main(
+            [assignments_fp]
+            + [os.path.join(DATA_DIR, "tiny_R1.fastq")]
+            + [os.path.join(DATA_DIR, "tiny_R2.fastq")]
+            + ["--output-dir", output_dir, "--total-reads-file", counts_fp]
+        )
+        self.assertEqual(
+            sorted(os.listdir(output_dir)), ["SampleA_R1.fastq", "SampleA_R2.fastq"]
+        )
+        with open(counts_fp) as f:
+            self.assertEqual(
+                f.read(), "SampleID\tNumReads\nSampleA\t1\nunassigned\t2\n"
+            )
+
+
+if __name__ == "__main__":
+    unittest.main()
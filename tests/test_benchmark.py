@@ -0,0 +1,87 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.dnabc.benchmark import (
+    LAYOUTS,
+    STAGES,
+    compare_results,
+    generate_run,
+    main,
+    run_benchmark,
+)
+from src.dnabc.gzipio import open_input
+from src.dnabc.seqfile import parse_fastq
+
+
+class BenchmarkTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _records(self, fp):
+        with open_input(fp) as f:
+            return list(parse_fastq(f))
+
+    def test_generate_run(self):
+        for layout, reads in LAYOUTS.items():
+            run_dir = os.path.join(self.temp_dir, layout)
+            os.mkdir(run_dir)
+            run = generate_run(run_dir, layout, num_reads=50, num_barcodes=4)
+            self.assertEqual(list(run["files"]), reads)
+            for fp in run["files"].values():
+                self.assertEqual(len(self._records(fp)), 50)
+        with open(run["barcode_file"]) as f:
+            self.assertEqual(len(f.readlines()), 5)
+
+    def test_generate_run_deterministic(self):
+        for seed, compress in [(1, False), (1, True), (2, False)]:
+            run_dir = os.path.join(self.temp_dir, "%s_%s" % (seed, compress))
+            os.mkdir(run_dir)
+            generate_run(run_dir, "dual", num_reads=20, seed=seed, compress=compress)
+        run1 = generate_run(self.temp_dir, "dual", num_reads=20, seed=1)
+        for fp in run1["files"].values():
+            fn = os.path.basename(fp)
+            self.assertEqual(
+                self._records(fp),
+                self._records(os.path.join(self.temp_dir, "1_False", fn)),
+            )
+            self.assertEqual(
+                self._records(fp),
+                self._records(os.path.join(self.temp_dir, "1_True", fn + ".gz")),
+            )
+            self.assertNotEqual(
+                self._records(fp),
+                self._records(os.path.join(self.temp_dir, "2_False", fn)),
+            )
+
+    def test_run_benchmark(self):
+        run = generate_run(self.temp_dir, "noindex", num_reads=100, error_rate=0)
+        results = run_benchmark(run)
+        self.assertEqual(list(results["stages"]), STAGES)
+        self.assertEqual(results["num_reads"], 100)
+        self.assertEqual(results["assigned_reads"], 100)
+
+    def test_compare_results(self):
+        old = {"stages": {"parse": {"reads_per_sec": 100}}}
+        new = {"stages": {"parse": {"reads_per_sec": 150}}}
+        comparison = compare_results(old, new)
+        self.assertEqual(comparison[0], ("parse", 100, 150, 1.5))
+        self.assertEqual(comparison[1], ("assign", None, None, None))
+
+    def test_main(self):
+        json_fp = os.path.join(self.temp_dir, "results.json")
+        work_dir = os.path.join(self.temp_dir, "work")
+        main(["--reads", "100", "--work-dir", work_dir, "--output-json", json_fp])
+        with open(json_fp) as f:
+            results = json.load(f)
+        self.assertEqual(results["run"]["reads"], 100)
+        self.assertEqual(results["run"]["layout"], "index")
+        self.assertTrue(os.path.exists(os.path.join(work_dir, "R1.fastq")))
+        # The same work directory can be used again
+        main(["--reads", "100", "--work-dir", work_dir, "--output-json", json_fp])
+        main(["--reads", "100", "--compare", json_fp])
@@ -0,0 +1,150 @@
+import concurrent.futures
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+
+from src.dnabc.gzipio import (
+    BGZF_EOF,
+    CompressedWriter,
+    MappedFile,
+    bgzf_block,
+    input_progress,
+    is_bgzf,
+    open_input,
+)
+
+CONTENTS = b"".join(b"@read%d\nACGTACGT\n+\nFFFFFFFF\n" % n for n in range(5000))
+
+
+class OpenInputTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, fn, data):
+        fp = os.path.join(self.temp_dir, fn)
+        with open(fp, "wb") as f:
+            f.write(data)
+        return fp
+
+    def _read(self, fp):
+        f = open_input(fp, threads=2)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_plain(self):
+        fp = self._write("a.fastq", CONTENTS)
+        self.assertEqual(self._read(fp), CONTENTS)
+
+    def test_plain_offset(self):
+        fp = self._write("a.fastq", CONTENTS)
+        f = open_input(fp, offset=1000)
+        self.assertIsInstance(f, MappedFile)
+        self.assertEqual(f.read(10), CONTENTS[1000:1010])
+        f.seek(-5, os.SEEK_CUR)
+        self.assertEqual(f.read(), CONTENTS[1005:])
+        self.assertEqual(f.read(), b"")
+        f.close()
+
+    def test_input_progress(self):
+        fp = self._write("a.fastq", CONTENTS)
+        with open_input(fp) as f:
+            self.assertEqual(input_progress(f), 0)
+            f.read(len(CONTENTS) // 4)
+            self.assertAlmostEqual(input_progress(f), 0.25, places=3)
+        # Compressed data is read ahead of the reader
+        fp = self._write("a.fastq.gz", gzip.compress(CONTENTS))
+        with open_input(fp) as f:
+            f.read()
+            self.assertEqual(input_progress(f), 1)
+        self.assertIsNone(input_progress(io.BytesIO(CONTENTS)))
+
+    def test_empty(self):
+        # Empty files can not be mapped
+        fp = self._write("a.fastq", b"")
+        self.assertEqual(self._read(fp), b"")
+
+    def test_gzip(self):
+        fp = self._write("a.fastq.gz", gzip.compress(CONTENTS))
+        self.assertEqual(self._read(fp), CONTENTS)
+
+    def test_multi_member_gzip(self):
+        data = gzip.compress(CONTENTS[:1000]) + gzip.compress(CONTENTS[1000:])
+        fp = self._write("a.fastq.gz", data)
+        self.assertEqual(self._read(fp), CONTENTS)
+
+    def test_bgzf(self):
+        blocks = [
+            bgzf_block(CONTENTS[i : i + 10000]) for i in range(0, len(CONTENTS), 10000)
+        ]
+        data = b"".join(blocks) + bgzf_block(b"")
+        self.assertTrue(is_bgzf(data))
+        self.assertFalse(is_bgzf(gzip.compress(CONTENTS)))
+        # BGZF files are also valid gzip files
+        self.assertEqual(gzip.decompress(data), CONTENTS)
+        fp = self._write("a.fastq.gz", data)
+        self.assertEqual(self._read(fp), CONTENTS)
+
+    def _read_fifo(self, data):
+        # Named pipes, as from process substitution, can not seek
+        fp = os.path.join(self.temp_dir, "fifo")
+        os.mkfifo(fp)
+
+        def write():
+            with open(fp, "wb") as f:
+                f.write(data)
+
+        # The writer is left blocked if reading fails
+        writer = threading.Thread(target=write, daemon=True)
+        writer.start()
+        data = self._read(fp)
+        writer.join(5)
+        return data
+
+    def test_pipe(self):
+        self.assertEqual(self._read_fifo(CONTENTS), CONTENTS)
+
+    def test_bgzf_pipe(self):
+        data = bgzf_block(CONTENTS[:10000]) + bgzf_block(CONTENTS[10000:])
+        self.assertEqual(self._read_fifo(data + BGZF_EOF), CONTENTS)
+
+    def test_corrupt_bgzf(self):
+        data = bytearray(bgzf_block(CONTENTS[:10000]))
+        data[-5] ^= 0xFF
+        fp = self._write("a.fastq.gz", bytes(data))
+        self.assertRaises(ValueError, self._read, fp)
+
+
+class CompressedWriterTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.executor = concurrent.futures.ThreadPoolExecutor(2)
+
+    def tearDown(self):
+        self.executor.shutdown()
+        shutil.rmtree(self.temp_dir)
+
+    def test_write(self):
+        for fmt in ["gzip", "bgzf"]:
+            fp = os.path.join(self.temp_dir, "a.fastq.gz")
+            f = CompressedWriter(fp, self.executor, fmt, buffer_size=1000)
+            for i in range(0, len(CONTENTS), 777):
+                f.write(CONTENTS[i : i + 777])
+            f.close()
+            with open(fp, "rb") as f:
+                data = f.read()
+            self.assertEqual(gzip.decompress(data), CONTENTS)
+            self.assertEqual(is_bgzf(data), fmt == "bgzf")
+            self.assertEqual(open_input(fp).read(), CONTENTS)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,158 @@
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.dnabc.gzipio import BGZF_EOF, bgzf_block
+from src.dnabc.index import (
+    build_index,
+    index_filepath,
+    main,
+    open_records,
+    parse_region,
+    read_index,
+    write_index,
+)
+from src.dnabc.merge import main as merge_main
+from src.dnabc.merge import merge_read_counts
+
+RECORDS = [b"@read%d\nACGTACGT\n+\nFFFFFFFF\n" % n for n in range(500)]
+CONTENTS = b"".join(RECORDS)
+
+
+class IndexTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, fn, data):
+        fp = os.path.join(self.temp_dir, fn)
+        with open(fp, "wb") as f:
+            f.write(data)
+        return fp
+
+    def _bgzf_fp(self):
+        # Small blocks, so records are split across blocks
+        blocks = [
+            bgzf_block(CONTENTS[i : i + 1000]) for i in range(0, len(CONTENTS), 1000)
+        ]
+        return self._write("reads.fastq.gz", b"".join(blocks) + BGZF_EOF)
+
+    def _read_records(self, fp, start, end):
+        f = open_records(fp, start, end)
+        try:
+            return f.read()
+        finally:
+            f.close()
+
+    def test_build_index_plain(self):
+        fp = self._write("reads.fastq", CONTENTS)
+        offsets, num_reads = build_index(fp, every=100)
+        self.assertEqual(num_reads, 500)
+        self.assertEqual([n for n, _ in offsets], [0, 100, 200, 300, 400])
+        for n, offset in offsets:
+            self.assertEqual(offset, len(b"".join(RECORDS[:n])))
+
+    def test_build_index_no_final_newline(self):
+        fp = self._write("reads.fastq", CONTENTS[:-1])
+        offsets, num_reads = build_index(fp, every=250)
+        self.assertEqual(num_reads, 500)
+        self.assertEqual([n for n, _ in offsets], [0, 250])
+
+    def test_build_index_gzip(self):
+        fp = self._write("reads.fastq.gz", gzip.compress(CONTENTS))
+        self.assertRaises(ValueError, build_index, fp)
+
+    def test_read_write_index(self):
+        f = io.StringIO()
+        write_index(f, [(0, 0), (10, 456)], 15, 789)
+        f.seek(0)
+        self.assertEqual(read_index(f), ([(0, 0), (10, 456)], 15, 789))
+
+    def test_open_records(self):
+        fp = self._write("reads.fastq", CONTENTS)
+        for start, end in [(0, None), (0, 1), (123, 321), (499, None), (300, 300)]:
+            self.assertEqual(
+                self._read_records(fp, start, end), b"".join(RECORDS[start:end])
+            )
+
+    def test_open_records_with_index(self):
+        for fp in [self._write("reads.fastq", CONTENTS), self._bgzf_fp()]:
+            main([fp, "--every", "37"])
+            self.assertTrue(os.path.exists(index_filepath(fp)))
+            for start, end in [(0, None), (37, 74), (123, 321), (499, None)]:
+                self.assertEqual(
+                    self._read_records(fp, start, end), b"".join(RECORDS[start:end])
+                )
+
+    def test_open_records_changed_file(self):
+        fp = self._write("reads.fastq", CONTENTS)
+        main([fp, "--every", "10"])
+        # The index is not used when the file is a different size
+        self._write("reads.fastq", b"".join(RECORDS[5:]))
+        self.assertEqual(self._read_records(fp, 0, 2), b"".join(RECORDS[5:7]))
+
+    def test_parse_region(self):
+        self.assertEqual(parse_region("10:20"), (10, 20))
+        self.assertEqual(parse_region(":20"), (0, 20))
+        self.assertEqual(parse_region("10:"), (10, None))
+        self.assertRaises(ValueError, parse_region, "10")
+        self.assertRaises(ValueError, parse_region, "20:10")
+        self.assertRaises(ValueError, parse_region, "a:b")
+
+
+class MergeTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _write(self, fp, data):
+        fp = os.path.join(self.temp_dir, fp)
+        if not os.path.exists(os.path.dirname(fp)):
+            os.mkdir(os.path.dirname(fp))
+        with open(fp, "w") as f:
+            f.write(data)
+        return fp
+
+    def test_merge_read_counts(self):
+        fs = [
+            io.StringIO("SampleID\tNumReads\nA\t1\nunassigned\t2\n"),
+            io.StringIO("SampleID\tNumReads\nA\t3\nB\t4\nunassigned\t5\n"),
+        ]
+        self.assertEqual(
+            list(merge_read_counts(fs).items()), [("A", 4), ("B", 4), ("unassigned", 7)]
+        )
+
+    def test_main(self):
+        self._write("region1/A_R1.fastq", "@a\n")
+        self._write("region1/B_R1.fastq", "@b\n")
+        self._write("region2/A_R1.fastq", "@c\n")
+        counts1 = self._write("counts1.tsv", "SampleID\tNumReads\nA\t1\nB\t1\n")
+        counts2 = self._write("counts2.tsv", "SampleID\tNumReads\nA\t1\nB\t0\n")
+        output_dir = os.path.join(self.temp_dir, "output")
+        counts_fp = os.path.join(self.temp_dir, "counts.tsv")
+        merge_main(
+            [
+                os.path.join(self.temp_dir, "region1"),
+                os.path.join(self.temp_dir, "region2"),
+                "--output-dir",
+                output_dir,
+                "--total-reads-files",
+                counts1,
+                counts2,
+                "--total-reads-file",
+                counts_fp,
+            ]
+        )
+        with open(os.path.join(output_dir, "A_R1.fastq")) as f:
+            self.assertEqual(f.read(), "@a\n@c\n")
+        with open(os.path.join(output_dir, "B_R1.fastq")) as f:
+            self.assertEqual(f.read(), "@b\n")
+        with open(counts_fp) as f:
+            self.assertEqual(f.read(), "SampleID\tNumReads\nA\t2\nB\t1\n")
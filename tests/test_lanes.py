@@ -0,0 +1,173 @@
+import gzip
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.dnabc.lanes import group_lane_files, load_lane_samples, main
+from src.dnabc.sample import SampleBarcode
+
+SAMPLE_SHEET = (
+    "[Data]\n"
+    "Sample_Project,Lane,Sample_ID,Sample_Name,index\n"
+    "P,1,SampleA,SampleA,AAGGAAGG\n"
+    "P,1,SampleB,SampleB,ACGTACGT\n"
+    "P,2,SampleA,SampleA,CCTTCCTT\n"
+)
+
+
+class LaneFunctionTests(unittest.TestCase):
+    def test_group_lane_files(self):
+        fps = [
+            "a/Undetermined_S0_L002_R1_001.fastq.gz",
+            "a/Undetermined_S0_L001_R2_001.fastq",
+            "a/Undetermined_S0_L001_R1_001.fastq",
+            "a/Undetermined_S0_L002_R2_001.fastq.gz",
+            "a/Undetermined_S0_L002_I1_001.fastq.gz",
+        ]
+        lanes = group_lane_files(fps)
+        self.assertEqual(list(lanes), [1, 2])
+        self.assertEqual(lanes[1], {"R1": fps[2], "R2": fps[1]})
+        self.assertEqual(lanes[2], {"R1": fps[0], "R2": fps[3], "I1": fps[4]})
+
+        self.assertRaises(ValueError, group_lane_files, ["reads.fastq"])
+        self.assertRaises(ValueError, group_lane_files, fps[:2])
+        self.assertRaises(ValueError, group_lane_files, fps + fps[:1])
+
+    def test_load_lane_samples(self):
+        obs = load_lane_samples(io.StringIO(SAMPLE_SHEET), [1, 2])
+        self.assertEqual(
+            obs,
+            {
+                1: [
+                    SampleBarcode("SampleA", "AAGGAAGG"),
+                    SampleBarcode("SampleB", "ACGTACGT"),
+                ],
+                2: [SampleBarcode("SampleA", "CCTTCCTT")],
+            },
+        )
+        self.assertRaises(
+            ValueError, load_lane_samples, io.StringIO(SAMPLE_SHEET), [1, 3]
+        )
+
+
+class LanesMainTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.fastq_fps = []
+        index_reads = {
+            1: ["ACGTACGT", "GGGGCGCT", "AAGGAAGG"],
+            2: ["CCTTCCTT", "ACGTACGT", "CCTTCCTT"],
+        }
+        for lane, idxs in index_reads.items():
+            for read in ["R1", "R2", "I1"]:
+                fp = os.path.join(
+                    self.temp_dir, "Undetermined_S0_L00%s_%s_001.fastq" % (lane, read)
+                )
+                with open(fp, "w") as f:
+                    for n, idx in enumerate(idxs):
+                        seq = idx if read == "I1" else "%sL%sN%s" % (read, lane, n)
+                        f.write("@r%s\n%s\n+\n%s\n" % (n, seq, "#" * len(seq)))
+                self.fastq_fps.append(fp)
+        self.sample_sheet_fp = os.path.join(self.temp_dir, "SampleSheet.csv")
+        with open(self.sample_sheet_fp, "w") as f:
+            f.write(SAMPLE_SHEET)
+        self.output_dir = os.path.join(self.temp_dir, "output")
+        self.total_reads_fp = os.path.join(self.temp_dir, "read_counts.tsv")
+        self.lane_reads_fp = os.path.join(self.temp_dir, "lane_counts.tsv")
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _main(self, *args):
+        main(
+            [self.sample_sheet_fp]
+            + self.fastq_fps
+            + ["--output-dir", self.output_dir]
+            + ["--total-reads-file", self.total_reads_fp]
+            + ["--lane-reads-file", self.lane_reads_fp]
+            + list(args)
+        )
+
+    def _read_output(self, fn):
+        fp = os.path.join(self.output_dir, fn)
+        if fn.endswith(".gz"):
+            with gzip.open(fp, "rt") as f:
+                return f.read()
+        with open(fp) as f:
+            return f.read()
+
+    def test_lane_suffix(self):
+        self._main("--threads", "2")
+        self.assertEqual(
+            sorted(os.listdir(self.output_dir)),
+            [
+                "SampleA_L001_R1.fastq",
+                "SampleA_L001_R2.fastq",
+                "SampleA_L002_R1.fastq",
+                "SampleA_L002_R2.fastq",
+                "SampleB_L001_R1.fastq",
+                "SampleB_L001_R2.fastq",
+            ],
+        )
+        self.assertEqual(
+            self._read_output("SampleA_L002_R1.fastq"),
+            "@r0\nR1L2N0\n+\n######\n@r2\nR1L2N2\n+\n######\n",
+        )
+        with open(self.total_reads_fp) as f:
+            self.assertEqual(
+                f.read(),
+                "SampleID\tNumReads\nSampleA\t3\nSampleB\t1\nunassigned\t2\n",
+            )
+        with open(self.lane_reads_fp) as f:
+            self.assertEqual(
+                f.read(),
+                "SampleID\tLane\tNumReads\n"
+                "SampleA\t1\t1\nSampleB\t1\t1\nunassigned\t1\t1\n"
+                "SampleA\t2\t2\nunassigned\t2\t1\n",
+            )
+
+    def test_merge_lanes(self):
+        for compress in ["gzip", "bgzf"]:
+            manifest_fp = os.path.join(self.temp_dir, "manifest.csv")
+            self._main(
+                "--merge-lanes",
+                "--threads",
+                "1",
+                "--compress",
+                compress,
+                "--manifest-file",
+                manifest_fp,
+            )
+            self.assertEqual(
+                sorted(os.listdir(self.output_dir)),
+                [
+                    "SampleA_R1.fastq.gz",
+                    "SampleA_R2.fastq.gz",
+                    "SampleB_R1.fastq.gz",
+                    "SampleB_R2.fastq.gz",
+                ],
+            )
+            self.assertEqual(
+                self._read_output("SampleA_R2.fastq.gz"),
+                "@r2\nR2L1N2\n+\n######\n"
+                "@r0\nR2L2N0\n+\n######\n@r2\nR2L2N2\n+\n######\n",
+            )
+            with open(manifest_fp) as f:
+                self.assertEqual(
+                    f.read(),
+                    "sample-id,absolute-filepath,direction\n"
+                    "SampleB,{1}_R1.fastq.gz,forward\n"
+                    "SampleB,{1}_R2.fastq.gz,reverse\n"
+                    "SampleA,{0}_R1.fastq.gz,forward\n"
+                    "SampleA,{0}_R2.fastq.gz,reverse\n".format(
+                        os.path.join(self.output_dir, "SampleA"),
+                        os.path.join(self.output_dir, "SampleB"),
+                    ),
+                )
+            shutil.rmtree(self.output_dir)
+
+
+if __name__ == "__main__":
+    unittest.main()
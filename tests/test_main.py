@@ -1,4 +1,7 @@
+import contextlib
 import gzip
+import io
+import json
 import os
 import shutil
 import tempfile
@@ -100,6 +103,139 @@ class FastqDemultiplexTests(unittest.TestCase):
             self.assertEqual(next(f), "Barcode\tNumReads\n")
             self.assertEqual(next(f), "GGGGCGCT\t1\n")
 
+    def test_max_open_files(self):
+        args = [self.barcode_fp, self.forward_fp, self.reverse_fp]
+        args += ["--i1-fastq", self.index_fp, "--output-dir", self.output_dir]
+        args += ["--revcomp", "--total-reads-file", self.total_reads_fp]
+        for max_open_files in ["0", "1"]:
+            with contextlib.redirect_stderr(io.StringIO()):
+                self.assertRaises(
+                    SystemExit, main, args + ["--max-open-files", max_open_files]
+                )
+        main(args + ["--max-open-files", "2"])
+        with open(self.total_reads_fp) as f:
+            self.assertEqual(
+                f.read(), "SampleID\tNumReads\nSampleA\t1\nSampleB\t1\nunassigned\t1\n"
+            )
+
+    def test_threads(self):
+        main(
+            [
+                self.barcode_fp,
+                self.forward_fp,
+                self.reverse_fp,
+                "--i1-fastq",
+                self.index_fp,
+                "--output-dir",
+                self.output_dir,
+                "--total-reads-file",
+                self.total_reads_fp,
+                "--revcomp",
+                "--threads",
+                "2",
+            ]
+        )
+        with open(os.path.join(self.output_dir, "SampleB_R1.fastq")) as f:
+            self.assertEqual(
+                f.read(), "@a\nGACTGCAGACGACTACGACGT\n+\n8A7T4C2G3CkAjThCeArG;\n"
+            )
+
+        with open(self.total_reads_fp) as f:
+            self.assertEqual(
+                f.read(),
+                "SampleID\tNumReads\nSampleA\t1\nSampleB\t1\nunassigned\t1\n",
+            )
+
+    def test_compress(self):
+        main(
+            [
+                self.barcode_fp,
+                self.forward_fp,
+                self.reverse_fp,
+                "--i1-fastq",
+                self.index_fp,
+                "--output-dir",
+                self.output_dir,
+                "--manifest-file",
+                self.manifest_fp,
+                "--revcomp",
+                "--compress",
+                "gzip",
+            ]
+        )
+        self.assertEqual(
+            set(os.listdir(self.output_dir)),
+            set(
+                (
+                    "SampleA_R1.fastq.gz",
+                    "SampleA_R2.fastq.gz",
+                    "SampleB_R1.fastq.gz",
+                    "SampleB_R2.fastq.gz",
+                )
+            ),
+        )
+        with gzip.open(os.path.join(self.output_dir, "SampleB_R1.fastq.gz"), "rt") as f:
+            self.assertEqual(
+                f.read(), "@a\nGACTGCAGACGACTACGACGT\n+\n8A7T4C2G3CkAjThCeArG;\n"
+            )
+        with open(self.manifest_fp) as f:
+            self.assertIn(".fastq.gz,forward", f.read())
+
+    def test_barcode_lookup(self):
+        args = [
+            self.barcode_fp,
+            self.forward_fp,
+            self.reverse_fp,
+            "--i1-fastq",
+            self.index_fp,
+            "--output-dir",
+            self.output_dir,
+            "--total-reads-file",
+            self.total_reads_fp,
+            "--revcomp",
+            "--mismatches",
+            "3",
+        ]
+        with contextlib.redirect_stderr(io.StringIO()):
+            self.assertRaises(SystemExit, main, args)
+
+        args[-1] = "1"
+        main(args + ["--barcode-lookup", "hamming"])
+        with open(self.total_reads_fp) as f:
+            self.assertEqual(
+                f.read(),
+                "SampleID\tNumReads\nSampleA\t1\nSampleB\t1\nunassigned\t1\n",
+            )
+
+        main(args + ["--packed-barcodes"])
+        with open(self.total_reads_fp) as f:
+            self.assertEqual(
+                f.read(),
+                "SampleID\tNumReads\nSampleA\t1\nSampleB\t1\nunassigned\t1\n",
+            )
+
+    def test_stdout(self):
+        out = io.StringIO()
+        with contextlib.redirect_stdout(out):
+            main(
+                [
+                    self.barcode_fp,
+                    self.forward_fp,
+                    self.reverse_fp,
+                    "--i1-fastq",
+                    self.index_fp,
+                    "--output-dir",
+                    self.output_dir,
+                    "--total-reads-file",
+                    "-",
+                    "--revcomp",
+                ]
+            )
+        self.assertEqual(
+            out.getvalue(),
+            "SampleID\tNumReads\nSampleA\t1\nSampleB\t1\nunassigned\t1\n",
+        )
+
     def test_gzipped(self):
         forward_gzip_fp = self.forward_fp + ".gz"
         with open(self.forward_fp, "rb") as f_in:
@@ -137,6 +273,193 @@ class FastqDemultiplexTests(unittest.TestCase):
             ),
         )
 
+    def test_stats_json(self):
+        stats_fp = os.path.join(self.temp_dir, "stats.json")
+        main(
+            [
+                self.barcode_fp,
+                self.forward_fp,
+                self.reverse_fp,
+                "--i1-fastq",
+                self.index_fp,
+                "--output-dir",
+                self.output_dir,
+                "--revcomp",
+                "--stats-json",
+                stats_fp,
+            ]
+        )
+        with open(stats_fp) as f:
+            stats = json.load(f)
+        self.assertEqual(stats["reads"], 3)
+        self.assertEqual(stats["unassigned_reads"], 1)
+        self.assertEqual(list(stats["stage_seconds"]), ["parse", "assign", "write"])
+        self.assertEqual(
+            [(s["sample"], s["reads"]) for s in stats["samples"]],
+            [("SampleA", 1), ("SampleB", 1)],
+        )
+        self.assertEqual(stats["samples"][0]["bytes"], 98)
+
+    def test_min_index_quality(self):
+        stats_fp = os.path.join(self.temp_dir, "stats.json")
+        main(
+            [
+                self.barcode_fp,
+                self.forward_fp,
+                self.reverse_fp,
+                "--i1-fastq",
+                self.index_fp,
+                "--output-dir",
+                self.output_dir,
+                "--revcomp",
+                "--min-index-quality",
+                "17",
+                "--stats-json",
+                stats_fp,
+            ]
+        )
+        with open(stats_fp) as f:
+            stats = json.load(f)
+        # The index read for SampleB has a base of quality 16, but
+        # matches exactly
+        self.assertEqual(stats["unassigned_reads"], 1)
+        self.assertEqual(stats["index_quality"], {"rescued": 0, "rejected": 0})
+
+    def test_mismatches_i1_i2(self):
+        with open(self.barcode_fp, "w") as f:
+            f.write("sample_name\tbarcode_seq\nSampleA\tAAAACCCC\nSampleB\tGGGGTTTT\n")
+        i1_fp = os.path.join(self.temp_dir, "I1.fastq")
+        with open(i1_fp, "w") as f:
+            f.write("@a\nGGGG\n+\nIIII\n@b\nAAAA\n+\nIIII\n@c\nAAAT\n+\nIIII\n")
+        i2_fp = os.path.join(self.temp_dir, "I2.fastq")
+        with open(i2_fp, "w") as f:
+            f.write("@a\nTTTT\n+\nIIII\n@b\nTTTT\n+\nIIII\n@c\nCCCC\n+\nIIII\n")
+        stats_fp = os.path.join(self.temp_dir, "stats.json")
+        hopped_fp = os.path.join(self.temp_dir, "hopped.tsv")
+        main(
+            [
+                self.barcode_fp,
+                self.forward_fp,
+                self.reverse_fp,
+                "--i1-fastq",
+                i1_fp,
+                "--i2-fastq",
+                i2_fp,
+                "--output-dir",
+                self.output_dir,
+                "--mismatches-i1",
+                "1",
+                "--total-reads-file",
+                self.total_reads_fp,
+                "--stats-json",
+                stats_fp,
+                "--hopped-pairs-file",
+                hopped_fp,
+            ]
+        )
+        with open(self.total_reads_fp) as f:
+            self.assertEqual(
+                f.read(),
+                "SampleID\tNumReads\nSampleA\t1\nSampleB\t1\nunassigned\t1\n",
+            )
+        with open(stats_fp) as f:
+            self.assertEqual(json.load(f)["hopped_reads"], 1)
+        with open(hopped_fp) as f:
+            self.assertEqual(f.read(), "Barcode\tNumReads\nAAAA+TTTT\t1\n")
+
+        # Indexes too close to each other are found before any output
+        with open(self.barcode_fp, "w") as f:
+            f.write("sample_name\tbarcode_seq\nSampleA\tAAAACCCC\nSampleB\tAAATTTTT\n")
+        output_dir = os.path.join(self.temp_dir, "output2")
+        args = [self.barcode_fp, self.forward_fp, self.reverse_fp]
+        args += ["--i1-fastq", i1_fp, "--i2-fastq", i2_fp]
+        args += ["--output-dir", output_dir, "--mismatches-i1", "1"]
+        self.assertRaises(ValueError, main, args)
+        self.assertFalse(os.path.exists(output_dir))
+
+    def test_unassigned_matrix(self):
+        with open(self.barcode_fp, "w") as f:
+            f.write("sample_name\tbarcode_seq\nSampleA\tGGGACGCT\nSampleB\tACGTACGT\n")
+        matrix_fp = os.path.join(self.temp_dir, "matrix.tsv")
+        main(
+            [
+                self.barcode_fp,
+                self.forward_fp,
+                self.reverse_fp,
+                "--i1-fastq",
+                self.index_fp,
+                "--output-dir",
+                self.output_dir,
+                "--unassigned-matrix-file",
+                matrix_fp,
+            ]
+        )
+        # The second index read has 1 mismatch with SampleA
+        with open(matrix_fp) as f:
+            self.assertEqual(
+                f.read(),
+                "I1/I2\tSampleA\tSampleB\nSampleA\t1\t0\nSampleB\t0\t0\n",
+            )
+
+    def test_probe(self):
+        args = [
+            self.barcode_fp,
+            self.forward_fp,
+            self.reverse_fp,
+            "--i1-fastq",
+            self.index_fp,
+            "--output-dir",
+            self.output_dir,
+            "--total-reads-file",
+            self.total_reads_fp,
+        ]
+        # The barcodes match the index reads after reverse complementing
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            self.assertRaises(SystemExit, main, args + ["--probe", "check"])
+        self.assertIn(
+            "error: argument --probe: Barcodes match 2 reads", stderr.getvalue()
+        )
+        stderr = io.StringIO()
+        with contextlib.redirect_stderr(stderr):
+            main(args + ["--probe", "auto"])
+        self.assertIn(" 66.7% reverse complemented\n", stderr.getvalue())
+        with open(self.total_reads_fp) as f:
+            self.assertEqual(
+                f.read(),
+                "SampleID\tNumReads\nSampleA\t1\nSampleB\t1\nunassigned\t1\n",
+            )
+
+    def test_region(self):
+        main(
+            [
+                self.barcode_fp,
+                self.forward_fp,
+                self.reverse_fp,
+                "--i1-fastq",
+                self.index_fp,
+                "--output-dir",
+                self.output_dir,
+                "--total-reads-file",
+                self.total_reads_fp,
+                "--revcomp",
+                "--region",
+                "1:3",
+            ]
+        )
+        self.assertEqual(
+            set(os.listdir(self.output_dir)),
+            set(("SampleA_R1.fastq", "SampleA_R2.fastq")),
+        )
+        with open(os.path.join(self.output_dir, "SampleA_R1.fastq")) as f:
+            self.assertEqual(
+                f.read(), "@c\nTCAGTACGTACGATACGTACG\n+\nkjafd;;;hjfasd82AHG99\n"
+            )
+        with open(self.total_reads_fp) as f:
+            self.assertEqual(
+                f.read(), "SampleID\tNumReads\nSampleA\t1\nSampleB\t0\nunassigned\t1\n"
+            )
+
 
 if __name__ == "__main__":
     unittest.main()
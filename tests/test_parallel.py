@@ -0,0 +1,187 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.dnabc.assigner import BarcodeAssigner
+from src.dnabc.parallel import _CollectingWriter, demultiplex_parallel
+from src.dnabc.sample import SampleBarcode
+from src.dnabc.seqfile import FastqBatch, NoIndexFastqSequenceFile
+from src.dnabc.spacesaving import SpaceSavingCounter
+from src.dnabc.writer import PairedFastqWriter
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(TEST_DIR, "data")
+
+
+class DemultiplexParallelTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.samples = [
+            SampleBarcode("SampleA", "CTTACTAGAGACTACA"),
+            SampleBarcode("SampleB", "GTTTCGCCCTAGTACA"),
+            SampleBarcode("SampleC", "TTCTTGACTCTTTCCC"),
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _demultiplex(
+        self,
+        output_dir,
+        threads,
+        barcode_regex=None,
+        fastq_prefix=os.path.join(DATA_DIR, "med"),
+        chunk_size=2,
+        **options,
+    ):
+        os.mkdir(output_dir)
+        seq_file = NoIndexFastqSequenceFile(
+            open(fastq_prefix + "_R1.fastq"),
+            open(fastq_prefix + "_R2.fastq"),
+            barcode_regex=barcode_regex,
+        )
+        writer = PairedFastqWriter(output_dir)
+        assigner = BarcodeAssigner(self.samples, mismatches=1, revcomp=False, **options)
+        if threads > 1:
+            demultiplex_parallel(
+                seq_file, assigner, writer, threads, chunk_size=chunk_size
+            )
+        else:
+            seq_file.demultiplex(assigner, writer)
+        writer.close()
+        return assigner
+
+    def test_demultiplex_parallel(self):
+        serial_dir = os.path.join(self.temp_dir, "serial")
+        serial = self._demultiplex(serial_dir, 1)
+        parallel_dir = os.path.join(self.temp_dir, "parallel")
+        # Options for the input files are passed to the workers
+        parallel = self._demultiplex(parallel_dir, 2, barcode_regex=":(\\w+)$")
+
+        self.assertEqual(parallel.read_counts, serial.read_counts)
+        self.assertEqual(
+            parallel.most_common_unassigned(), serial.most_common_unassigned()
+        )
+        self.assertEqual(
+            sorted(os.listdir(parallel_dir)), sorted(os.listdir(serial_dir))
+        )
+        for fn in os.listdir(serial_dir):
+            with open(os.path.join(serial_dir, fn)) as f:
+                serial_contents = f.read()
+            with open(os.path.join(parallel_dir, fn)) as f:
+                self.assertEqual(f.read(), serial_contents)
+
+    def test_max_unassigned(self):
+        serial = self._demultiplex(os.path.join(self.temp_dir, "serial"), 1)
+        parallel = self._demultiplex(
+            os.path.join(self.temp_dir, "parallel"), 2, max_unassigned=100
+        )
+        # Few enough barcodes that the counts are exact
+        self.assertTrue(parallel.unassigned_counts.is_exact())
+        self.assertEqual(parallel.read_counts, serial.read_counts)
+        self.assertEqual(
+            dict(parallel.most_common_unassigned()),
+            dict(serial.most_common_unassigned()),
+        )
+
+    def test_max_unassigned_bounded(self):
+        # Three common barcodes, and one only in the first half of the
+        # reads, among many that are seen once
+        prefix = os.path.join(self.temp_dir, "many")
+        barcodes = []
+        for n in range(600):
+            if (n % 10 == 1) and (n < 300):
+                barcodes.append("ACACACAC")
+            elif n % 4:
+                barcodes.append("".join("ACGT"[(n >> k) & 3] for k in range(0, 16, 2)))
+            else:
+                barcodes.append(["AAAAAAAA", "CCCCCCCC", "GGGGGGGG"][n % 3])
+        for read in ["R1", "R2"]:
+            with open("%s_%s.fastq" % (prefix, read), "w") as f:
+                for n, bc in enumerate(barcodes):
+                    f.write("@r%s 1:N:0:%s\nACGT\n+\nIIII\n" % (n, bc))
+        exact = self._demultiplex(
+            os.path.join(self.temp_dir, "exact"), 1, fastq_prefix=prefix
+        )
+        parallel = self._demultiplex(
+            os.path.join(self.temp_dir, "parallel"),
+            2,
+            fastq_prefix=prefix,
+            chunk_size=50,
+            max_unassigned=10,
+        )
+        counts = parallel.unassigned_counts
+        self.assertFalse(counts.is_exact())
+        self.assertEqual(
+            parallel.most_common_unassigned(3), exact.most_common_unassigned(3)
+        )
+        for bc, n in counts.items():
+            self.assertLessEqual(exact.unassigned_counts[bc], n)
+            self.assertLessEqual(n - counts.error(bc), exact.unassigned_counts[bc])
+        # Each chunk is added to the table like a batch of reads, so
+        # the error floors of the chunks do not add up
+        expected = SpaceSavingCounter(10)
+        for n in range(0, len(barcodes), 50):
+            expected.update(barcodes[n : n + 50])
+        self.assertEqual(dict(counts.items()), dict(expected.items()))
+        self.assertEqual(counts.floor, expected.floor)
+
+    def test_collecting_writer(self):
+        s1, s2, _ = self.samples
+        fwds = FastqBatch([b"a", b"b", b"c"], [b"AC", b"GT", b"TT"], [b"12"] * 3)
+        revs = FastqBatch([b"a", b"b", b"c"], [b"CC", b"GG", b"AA"], [b"34"] * 3)
+        collector = _CollectingWriter(PairedFastqWriter)
+        collector.write_batch((fwds, revs), [s2, None, s1])
+        collector.write_batch((fwds, revs), [s1, s1, None])
+        self.assertEqual(
+            collector.formatted(),
+            [
+                ("SampleB", (b"@a\nAC\n+\n12\n", b"@a\nCC\n+\n34\n")),
+                (
+                    "SampleA",
+                    (
+                        b"@c\nTT\n+\n12\n@a\nAC\n+\n12\n@b\nGT\n+\n12\n",
+                        b"@c\nAA\n+\n34\n@a\nCC\n+\n34\n@b\nGG\n+\n34\n",
+                    ),
+                ),
+            ],
+        )
+
+    def test_error_offset(self):
+        # The "+" line of the fourth record is missing
+        prefix = os.path.join(self.temp_dir, "bad")
+        for read in ["R1", "R2"]:
+            with open("%s_%s.fastq" % (prefix, read), "w") as f:
+                for n in range(6):
+                    plus = "-" if (n == 3) and (read == "R2") else "+"
+                    f.write("@r%s 1:N:0:AAAA\nACGT\n%s\nIIII\n" % (n, plus))
+        for threads, output_dir in [(1, "serial"), (2, "parallel")]:
+            with self.assertRaises(ValueError) as cm:
+                self._demultiplex(
+                    os.path.join(self.temp_dir, output_dir),
+                    threads,
+                    fastq_prefix=prefix,
+                )
+            self.assertEqual(
+                str(cm.exception), "Malformed FASTQ record at offset %s" % (3 * 27)
+            )
+
+    def test_classify_unassigned(self):
+        serial = self._demultiplex(
+            os.path.join(self.temp_dir, "serial"), 1, classify_unassigned=True
+        )
+        parallel = self._demultiplex(
+            os.path.join(self.temp_dir, "parallel"), 2, classify_unassigned=True
+        )
+        self.assertEqual(
+            parallel.unassigned_classes.counts, serial.unassigned_classes.counts
+        )
+        self.assertEqual(
+            sum(serial.unassigned_classes.totals().values()),
+            serial.read_counts["unassigned"],
+        )
+
+
+if __name__ == "__main__":
+    unittest.main()
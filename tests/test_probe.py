@@ -0,0 +1,116 @@
+import collections
+import io
+import unittest
+
+from src.dnabc.probe import (
+    Orientation,
+    best_orientation,
+    given_orientation,
+    orient_barcode,
+    probe_barcodes,
+    probe_orientations,
+    read_barcodes,
+)
+from src.dnabc.sample import SampleBarcode
+from src.dnabc.seqfile import SequenceFile
+
+
+def fastq(*seqs):
+    return io.StringIO(
+        "".join(
+            "@r{0}\n{1}\n+\n{2}\n".format(n, s, "I" * len(s))
+            for n, s in enumerate(seqs)
+        )
+    )
+
+
+class OrientationTests(unittest.TestCase):
+    def test_given_orientation(self):
+        # Reverse complementing the joined barcode swaps I1 and I2
+        rc = given_orientation(True, True)
+        self.assertEqual(orient_barcode("AACCG", rc, (3, 2)), "CGGTT")
+        self.assertEqual(orient_barcode("AACCG", rc, (5,)), "CGGTT")
+        as_given = given_orientation(False, True)
+        self.assertEqual(orient_barcode("AACCG", as_given, (3, 2)), "AACCG")
+
+    def test_orient_barcode(self):
+        self.assertEqual(
+            orient_barcode("AACCG", Orientation(True, False, False), (3, 2)), "CCGAA"
+        )
+        self.assertEqual(
+            orient_barcode("AACCG", Orientation(False, False, True), (3, 2)), "AACCG"
+        )
+        self.assertEqual(
+            orient_barcode("AACCG", Orientation(False, True, False), (3, 2)), "GTTCG"
+        )
+
+    def test_orient_barcode_unsplit(self):
+        # Barcodes that do not fit the index reads are only reverse
+        # complemented as a whole
+        self.assertEqual(
+            orient_barcode("AACCG", Orientation(True, True, True), (3, 3)), "CGGTT"
+        )
+        self.assertEqual(
+            orient_barcode("AACCG", Orientation(True, False, False), (3, 3)), None
+        )
+
+
+class ProbeTests(unittest.TestCase):
+    def setUp(self):
+        self.samples = [SampleBarcode("A", "ACGGCATT"), SampleBarcode("B", "TGACGGTA")]
+
+    def test_read_barcodes(self):
+        seq_file = SequenceFile(
+            None, None, fastq("AAAA", "GGGG", "CCCC"), fastq("CCCC", "TTTT", "AAAA")
+        )
+        barcode_counts, index_lengths = read_barcodes(seq_file, 2)
+        self.assertEqual(barcode_counts, {"AAAACCCC": 1, "GGGGTTTT": 1})
+        self.assertEqual(index_lengths, (4, 4))
+
+    def test_read_barcodes_empty(self):
+        seq_file = SequenceFile(None, None, fastq())
+        self.assertEqual(read_barcodes(seq_file), ({}, None))
+
+    def test_probe_orientations(self):
+        # I1 and I2 swapped, I2 reverse complemented
+        counts = collections.Counter({"CATTCCGT": 2, "GGTAGTCA": 1, "ACGGCATT": 1})
+        results = probe_orientations(self.samples, counts, (4, 4))
+        self.assertEqual(len(results), 8)
+        self.assertEqual(results[0], (Orientation(True, False, True), 3))
+        self.assertEqual(dict(results)[given_orientation(False, True)], 1)
+
+    def test_best_orientation(self):
+        given = given_orientation(False, False)
+        rc = given_orientation(True, False)
+        self.assertEqual(best_orientation([(rc, 20), (given, 10)], given), rc)
+        self.assertEqual(best_orientation([(rc, 19), (given, 10)], given), given)
+        self.assertEqual(best_orientation([(rc, 0), (given, 0)], given), given)
+
+    def test_probe_barcodes(self):
+        seqs = ["CATT", "CATT", "GGTA"], ["ACGG", "ACGG", "TGAC"]
+        log = io.StringIO()
+        samples, revcomp = probe_barcodes(
+            self.samples,
+            SequenceFile(None, None, fastq(*seqs[0]), fastq(*seqs[1])),
+            True,
+            auto=True,
+            log_file=log,
+        )
+        # The barcodes match with I1 and I2 swapped, without revcomp
+        self.assertFalse(revcomp)
+        self.assertEqual(
+            samples, [SampleBarcode("A", "CATTACGG"), SampleBarcode("B", "GGTATGAC")]
+        )
+        self.assertIn("100.0% I1 and I2 swapped\n", log.getvalue())
+        self.assertRaises(
+            ValueError,
+            probe_barcodes,
+            self.samples,
+            SequenceFile(None, None, fastq(*seqs[0]), fastq(*seqs[1])),
+            True,
+        )
+
+    def test_probe_barcodes_given(self):
+        seq_file = SequenceFile(fastq("AAAA"), None, fastq("GTCA", "GTCA", "GGTA"))
+        samples = [SampleBarcode("A", "TGAC"), SampleBarcode("B", "TACC")]
+        self.assertEqual(probe_barcodes(samples, seq_file, True), (samples, True))
@@ -1,12 +1,20 @@
 import collections
-from io import StringIO
+from io import BytesIO, StringIO
 import os.path
 import unittest
 
 from src.dnabc.seqfile import (
+    FastqBatch,
+    FastqRead,
     IndexFastqSequenceFile,
     NoIndexFastqSequenceFile,
+    _batch_barcode_pattern,
+    _extract_barcodes,
+    barcode_field_regex,
     parse_fastq,
+    cut_records,
+    parse_fastq_batches,
+    zip_batches,
 )
 from src.dnabc.assigner import BarcodeAssigner
 
@@ -51,6 +59,41 @@ class IndexFastqSequenceFileTests(unittest.TestCase):
         self.assertEqual(r2.seq, "GTNNNNNNNNNNNNNNNNNNN")
         self.assertEqual(r2.qual, "#####################")
 
+    def test_demultiplex_binary(self):
+        idx = open(os.path.join(DATA_DIR, "tiny_I1.fastq"), "rb")
+        fwd = open(os.path.join(DATA_DIR, "tiny_R1.fastq"), "rb")
+        rev = open(os.path.join(DATA_DIR, "tiny_R2.fastq"), "rb")
+        x = IndexFastqSequenceFile(fwd, rev, idx)
+        w = MockWriter()
+        s1 = MockSample("SampleS1", "GGGGCGCT")
+        a = BarcodeAssigner([s1], mismatches=0, revcomp=False)
+        x.demultiplex(a, w)
+
+        r1, r2 = w.written["SampleS1"][0]
+        self.assertEqual(r1.desc, b"b")
+        self.assertEqual(r1.seq, b"CAGTCAGACGCGCATCAGATC")
+        self.assertEqual(r2.qual, b"#####################")
+        self.assertEqual(a.unassigned_counts, {"ACGTACGT": 1, "CCTTCCTT": 1})
+
+    def test_demultiplex_min_quality(self):
+        def seq_file():
+            return IndexFastqSequenceFile(
+                open(os.path.join(DATA_DIR, "tiny_R1.fastq")),
+                open(os.path.join(DATA_DIR, "tiny_R2.fastq")),
+                open(os.path.join(DATA_DIR, "tiny_I1.fastq")),
+            )
+
+        # Mismatch with the second index read at a base of quality 16
+        s1 = MockSample("SampleS1", "GGAGCGCT")
+        w = MockWriter()
+        a = BarcodeAssigner([s1], mismatches=1, revcomp=False, min_quality=17)
+        seq_file().demultiplex(a, w)
+        self.assertEqual(w.written["SampleS1"][0][0].desc, "b")
+        self.assertEqual(a.quality_counts, {"rescued": 1, "rejected": 0})
+
+        a = BarcodeAssigner([s1], mismatches=1, revcomp=False, min_quality=16)
+        self.assertEqual(list(seq_file().assign(a)), [[None, None, None]])
+
 
 class NoIndexFastqSequenceFileTests(unittest.TestCase):
     def test_demultiplex(self):
@@ -76,6 +119,44 @@ class NoIndexFastqSequenceFileTests(unittest.TestCase):
             expected_rev_read = list(parse_fastq(f))[3]
         self.assertEqual(obs_rev_read.as_tuple(), expected_rev_read)
 
+    def test_get_barcodes(self):
+        descs = [
+            b"M1:47:000-ABC:1:1101:1:2 1:N:0:ACGT+TTGG",
+            b"M1:47:000-ABC:1:1101:1:2 1:N:0:CCAA-GGTT",
+        ]
+        batch = FastqBatch(descs, [b""] * 2, [b""] * 2)
+        x = NoIndexFastqSequenceFile(None, None)
+        self.assertEqual(x._get_barcodes(batch), ([b"ACGTTTGG", b"CCAAGGTT"],))
+        text_batch = FastqBatch([d.decode() for d in descs], [""] * 2, [""] * 2)
+        self.assertEqual(x._get_barcodes(text_batch), (["ACGTTTGG", "CCAAGGTT"],))
+
+        # Descriptions without a colon are taken as the barcode
+        batch = FastqBatch(descs + [b"AAAA"], [b""] * 3, [b""] * 3)
+        self.assertEqual(x._get_barcodes(batch), ([b"ACGTTTGG", b"CCAAGGTT", b"AAAA"],))
+
+    def test_barcode_regex(self):
+        descs = [
+            b"A1:5:FC:1:1:2:3:ACGTACGT 1:N:0:GGGG+CCCC",
+            b"A1:5:FC:1:1:2:3:TTTTAAAA 1:N:0:CCCC+GGGG",
+        ]
+        batch = FastqBatch(descs, [b""] * 2, [b""] * 2)
+        x = NoIndexFastqSequenceFile(None, None, barcode_regex=barcode_field_regex(8))
+        self.assertEqual(x._get_barcodes(batch), ([b"ACGTACGT 1", b"TTTTAAAA 1"],))
+        # Fields are found for the whole batch at once, without
+        # falling back to parsing the descriptions one by one
+        for n, expected in [
+            (1, [b"A1", b"A1"]),
+            (8, [b"ACGTACGT 1", b"TTTTAAAA 1"]),
+            (11, [b"GGGGCCCC", b"CCCCGGGG"]),
+        ]:
+            pattern = _batch_barcode_pattern(barcode_field_regex(n), b"\n")
+            self.assertEqual(_extract_barcodes(descs, pattern, b"\n"), expected)
+        x = NoIndexFastqSequenceFile(None, None, barcode_regex=r"^(?:\S+:){7}(\w+)")
+        self.assertEqual(x._get_barcodes(batch), ([b"ACGTACGT", b"TTTTAAAA"],))
+
+        batch = FastqBatch(descs + [b"nothing here"], [b""] * 3, [b""] * 3)
+        self.assertRaises(ValueError, x._get_barcodes, batch)
+
 
 class FunctionTests(unittest.TestCase):
     def test_parse_fastq(self):
@@ -88,6 +169,114 @@ class FunctionTests(unittest.TestCase):
         )
         self.assertRaises(StopIteration, next, obs)
 
+    def test_parse_fastq_batches(self):
+        # Small buffers split records across reads from the file
+        f = BytesIO(fastq1.encode())
+        batches = list(parse_fastq_batches(f, buffer_size=10))
+        self.assertEqual(
+            [record for batch in batches for record in batch],
+            [
+                (b"YesYes", b"AGGGCCTTGGTGGTTAG", b";234690GSDF092384"),
+                (b"Seq2:with spaces", b"GCTNNNNNNNNNNNNNNN", b"##################"),
+            ],
+        )
+
+    def test_parse_fastq_batches_unseekable(self):
+        # Pipes can not seek back, so partial records are carried over
+        f = BytesIO(fastq1.encode() * 3)
+        f.seekable = lambda: False
+        batches = list(parse_fastq_batches(f, buffer_size=50))
+        self.assertEqual(sum(map(len, batches)), 6)
+        self.assertEqual(batches[-1][-1][0], b"Seq2:with spaces")
+
+    def test_parse_fastq_batches_crlf(self):
+        f = BytesIO(fastq1.replace("\n", "\r\n").encode())
+        obs = [record for batch in parse_fastq_batches(f) for record in batch]
+        self.assertEqual(
+            obs[0], (b"YesYes", b"AGGGCCTTGGTGGTTAG", b";234690GSDF092384")
+        )
+
+    def test_parse_fastq_batches_crlf_later_record(self):
+        # Line endings are checked for every record, not just the first
+        f = BytesIO(fastq1.encode() + fastq1.replace("\n", "\r\n").encode())
+        obs = [record for batch in parse_fastq_batches(f) for record in batch]
+        self.assertEqual(obs[3], obs[1])
+
+    def test_parse_fastq_batches_trailing_spaces(self):
+        f = BytesIO(fastq1.replace("YesYes", "YesYes \t").encode())
+        obs = [record for batch in parse_fastq_batches(f) for record in batch]
+        self.assertEqual(obs[0][0], b"YesYes")
+        self.assertEqual(obs[1][0], b"Seq2:with spaces")
+
+    def test_parse_fastq_batches_trailing_spaces_seq_qual(self):
+        data = "@a\nACGT \n+\nIIII\t\n@b\nGGCC\n+\nJJJJ\n"
+        obs = [r for batch in parse_fastq_batches(StringIO(data)) for r in batch]
+        self.assertEqual([r[1:] for r in obs], [("ACGT", "IIII"), ("GGCC", "JJJJ")])
+        f = BytesIO(data.encode())
+        obs = [record for batch in parse_fastq_batches(f) for record in batch]
+        self.assertEqual([r[1:] for r in obs], [(b"ACGT", b"IIII"), (b"GGCC", b"JJJJ")])
+
+    def test_parse_fastq_batches_trailing_blank_lines(self):
+        for data in [fastq1 + "\n", fastq1 + "\n\n", fastq1 + "\r\n"]:
+            obs = [r for batch in parse_fastq_batches(StringIO(data)) for r in batch]
+            self.assertEqual(len(obs), 2)
+
+    def test_parse_fastq_batches_no_final_newline(self):
+        f = BytesIO(fastq1.rstrip().encode())
+        obs = [record for batch in parse_fastq_batches(f) for record in batch]
+        self.assertEqual(obs[1][2], b"##################")
+
+    def test_parse_fastq_batches_malformed(self):
+        f = BytesIO(fastq1.replace("\n+\n#", "\n-\n#").encode())
+        with self.assertRaisesRegex(ValueError, "offset 46"):
+            list(parse_fastq_batches(f))
+
+    def test_parse_fastq_batches_truncated(self):
+        f = BytesIO(fastq1.encode() + b"@Seq3\nACGT\n")
+        with self.assertRaisesRegex(ValueError, "offset 104"):
+            list(parse_fastq_batches(f))
+
+    def test_fastq_batch(self):
+        batch = FastqBatch([b"a", b"b"], [b"ACG", b"GGT"], [b"###", b"FFF"])
+        self.assertEqual(len(batch), 2)
+        self.assertEqual(batch[1], (b"b", b"GGT", b"FFF"))
+        self.assertEqual(list(batch[1:]), [(b"b", b"GGT", b"FFF")])
+        r1, r2 = batch.reads()
+        self.assertEqual(r2.as_tuple(), (b"b", b"GGT", b"FFF"))
+        # Fields refer to the same objects held by the batch
+        self.assertIs(r1.seq, batch.seqs[0])
+        self.assertFalse(hasattr(FastqRead((b"a", b"A", b"#")), "__dict__"))
+
+    def test_cut_records(self):
+        f = BytesIO(fastq1.encode() * 3)
+        blocks = list(cut_records(f, 2, buffer_size=7))
+        self.assertEqual(blocks, [fastq1.encode(), fastq1.encode(), fastq1.encode()])
+
+        f = BytesIO(fastq1.encode())
+        blocks = list(cut_records(f, 1))
+        self.assertEqual(len(blocks), 2)
+        self.assertEqual(
+            blocks[1], b"@Seq2:with spaces\nGCTNNNNNNNNNNNNNNN\n+\n##################\n"
+        )
+
+    def test_cut_records_buffer_boundary(self):
+        # The first read from the file ends exactly after two records
+        data = fastq1.encode() * 3
+        blocks = list(cut_records(BytesIO(data), 2, buffer_size=len(fastq1)))
+        self.assertEqual(blocks, [fastq1.encode()] * 3)
+        for buffer_size in range(1, 120):
+            blocks = list(cut_records(BytesIO(data), 1, buffer_size=buffer_size))
+            self.assertEqual(b"".join(blocks), data)
+            self.assertEqual(len(blocks), 6)
+
+    def test_zip_batches(self):
+        fwd = parse_fastq_batches(BytesIO(fastq1.encode()), buffer_size=50)
+        rev = parse_fastq_batches(BytesIO(fastq1.encode()))
+        batches = list(zip_batches(fwd, rev))
+        self.assertEqual([len(b) for b, _ in batches], [1, 1])
+        self.assertEqual([len(b) for _, b in batches], [1, 1])
+        self.assertEqual(batches[1][1].descs, [b"Seq2:with spaces"])
+
 
 fastq1 = """\
 @YesYes
@@ -0,0 +1,74 @@
+import collections
+import random
+import unittest
+
+from src.dnabc.spacesaving import SpaceSavingCounter
+
+
+def _stream(seed, n):
+    # A few common items among many rare ones
+    rng = random.Random(seed)
+    return [
+        "common%s" % rng.randrange(5) if rng.random() < 0.2 else str(rng.random())
+        for _ in range(n)
+    ]
+
+
+class SpaceSavingCounterTests(unittest.TestCase):
+    def test_exact_under_capacity(self):
+        c = SpaceSavingCounter(10)
+        c.update(["a", "b", "a"])
+        c.update({"c": 2, "a": 1})
+        self.assertTrue(c.is_exact())
+        self.assertEqual(c.most_common(), [("a", 3), ("c", 2), ("b", 1)])
+        self.assertEqual(c.most_common(1), [("a", 3)])
+        self.assertEqual(c["b"], 1)
+        self.assertEqual(c["d"], 0)
+        self.assertEqual(c.error("a"), 0)
+
+    def test_bounded(self):
+        items = _stream(0, 20000)
+        exact = collections.Counter(items)
+        c = SpaceSavingCounter(100)
+        for n in range(0, len(items), 1000):
+            c.update(items[n : n + 1000])
+            self.assertLess(len(c), 200)
+        self.assertFalse(c.is_exact())
+        self.assertEqual(
+            set(item for item, _ in c.most_common(5)),
+            set(item for item, _ in exact.most_common(5)),
+        )
+        for item, count in c.items():
+            # Counts are never too low, and too high by at most the error
+            self.assertGreaterEqual(count, exact[item])
+            self.assertLessEqual(count - c.error(item), exact[item])
+
+    def test_merge(self):
+        items1 = _stream(1, 10000)
+        items2 = _stream(2, 10000)
+        exact = collections.Counter(items1 + items2)
+        c1 = SpaceSavingCounter(100)
+        c1.update(items1)
+        c2 = SpaceSavingCounter(100)
+        c2.update(items2)
+        c1.update(c2)
+        self.assertLessEqual(len(c1), 100)
+        self.assertEqual(
+            set(item for item, _ in c1.most_common(5)),
+            set(item for item, _ in exact.most_common(5)),
+        )
+        for item, count in c1.items():
+            self.assertGreaterEqual(count, exact[item])
+            self.assertLessEqual(count - c1.error(item), exact[item])
+
+    def test_merge_exact(self):
+        c1 = SpaceSavingCounter(10)
+        c1.update(["a", "b"])
+        c2 = SpaceSavingCounter(10)
+        c2.update(["a", "c"])
+        c1.update(c2)
+        self.assertTrue(c1.is_exact())
+        self.assertEqual(c1.most_common(), [("a", 2), ("b", 1), ("c", 1)])
+
+    def test_capacity(self):
+        self.assertRaises(ValueError, SpaceSavingCounter, 0)
@@ -0,0 +1,100 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.dnabc.assigner import BarcodeAssigner
+from src.dnabc.sample import load_sample_barcodes
+from src.dnabc.split_samplelanes import main, parse_sample_sheet
+
+ILLUMINA_SHEET = (
+    "[Header]\n"
+    "IEMFileVersion,4\n"
+    "Lane,Not,Data\n"
+    "\n"
+    "[Data]\n"
+    "Lane,Sample_ID,Sample_Name,Sample_Plate,index,index2\n"
+    "1,S1,Sample 1,,ACGT,TTGG\n"
+    "2,S2,Sample 2,,GGCC,AATT\n"
+    "1,S3,Sample 3,,CCAA,GGTT\n"
+    ",,,,,\n"
+)
+
+POSITIONAL_SHEET = "Proj,1,S 1,x,ACGT-TTGG\nProj,2,S2,x,GGCC-AATT\nshort,row\n"
+
+
+class SampleSheetTests(unittest.TestCase):
+    def test_parse_data_section(self):
+        self.assertEqual(
+            list(parse_sample_sheet(io.StringIO(ILLUMINA_SHEET))),
+            [
+                ("1", "S1", "ACGTTTGG"),
+                ("2", "S2", "GGCCAATT"),
+                ("1", "S3", "CCAAGGTT"),
+            ],
+        )
+
+    def test_parse_no_lane_column(self):
+        sheet = "[Data]\nSample_Name,index\nA,ACGT\nB,TTGG\n"
+        self.assertEqual(
+            list(parse_sample_sheet(io.StringIO(sheet))),
+            [(None, "A", "ACGT"), (None, "B", "TTGG")],
+        )
+        sheet = "[Data]\nSample_Name,Barcode\nA,ACGT\n"
+        self.assertRaises(ValueError, list, parse_sample_sheet(io.StringIO(sheet)))
+
+    def test_parse_positional(self):
+        self.assertEqual(
+            list(parse_sample_sheet(io.StringIO(POSITIONAL_SHEET))),
+            [("1", "S1", "ACGTTTGG"), ("2", "S2", "GGCCAATT")],
+        )
+
+
+class SplitSampleLanesMainTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+        self.sheet_fp = os.path.join(self.temp_dir, "SampleSheet.csv")
+        with open(self.sheet_fp, "w") as f:
+            f.write(ILLUMINA_SHEET)
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def _read(self, fn):
+        with open(os.path.join(self.temp_dir, fn)) as f:
+            return f.read()
+
+    def test_one_lane(self):
+        output_fp = os.path.join(self.temp_dir, "lane2.tsv")
+        main(["--sample-sheet", self.sheet_fp, "--lane", "2", "--output", output_fp])
+        self.assertEqual(
+            self._read("lane2.tsv"), "SampleID\tBarcodeSequence\nS2\tGGCCAATT\n"
+        )
+
+    def test_all_lanes(self):
+        cache_dir = os.path.join(self.temp_dir, "cache")
+        pattern = os.path.join(self.temp_dir, "barcodes_L{lane}.tsv")
+        main(
+            ["--sample-sheet", self.sheet_fp, "--output-pattern", pattern]
+            + ["--barcode-cache-dir", cache_dir, "--mismatches", "1"]
+        )
+        self.assertEqual(
+            sorted(os.listdir(self.temp_dir)),
+            ["SampleSheet.csv", "barcodes_L1.tsv", "barcodes_L2.tsv", "cache"],
+        )
+        self.assertEqual(
+            self._read("barcodes_L1.tsv"),
+            "SampleID\tBarcodeSequence\nS1\tACGTTTGG\nS3\tCCAAGGTT\n",
+        )
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+        # The saved tables are found when the barcode files are loaded
+        with open(os.path.join(self.temp_dir, "barcodes_L2.tsv")) as f:
+            samples = load_sample_barcodes(f)
+        BarcodeAssigner(samples, mismatches=1, revcomp=False, cache_dir=cache_dir)
+        self.assertEqual(len(os.listdir(cache_dir)), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
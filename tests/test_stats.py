@@ -0,0 +1,63 @@
+import collections
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+from src.dnabc.stats import DemultiplexStats
+from src.dnabc.writer import PairedFastqWriter
+from src.dnabc.seqfile import FastqBatch
+
+MockSample = collections.namedtuple("MockSample", "name barcode")
+
+
+class DemultiplexStatsTests(unittest.TestCase):
+    def setUp(self):
+        self.temp_dir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.temp_dir)
+
+    def test_add_batch(self):
+        stats = DemultiplexStats()
+        stats.add_batch(10, 2, parse=1.0, assign=0.5, write=0.25)
+        stats.add_batch(5, 1, parse=1.0, assign=0.5, write=0.25)
+        self.assertEqual(stats.num_reads, 15)
+        self.assertEqual(stats.num_unassigned, 3)
+        self.assertEqual(
+            list(stats.stage_seconds.items()),
+            [("parse", 2.0), ("assign", 1.0), ("write", 0.5)],
+        )
+
+    def test_progress(self):
+        f = io.StringIO()
+        stats = DemultiplexStats(f, progress_interval=0, input_progress=lambda: 0.5)
+        stats.add_batch(10, 1)
+        line = f.getvalue()
+        self.assertRegex(line, r"^dnabc: 10 reads, \d+ reads/s, 50.0% of input, ")
+        self.assertTrue(line.endswith(", ETA 0:00:00, 10.0% unassigned\n"))
+
+    def test_progress_unknown_input(self):
+        stats = DemultiplexStats(input_progress=lambda: None)
+        self.assertNotIn("ETA", stats.format_progress())
+
+    def test_report(self):
+        s1 = MockSample("a", "ACGT")
+        writer = PairedFastqWriter(self.temp_dir)
+        batch = FastqBatch([b"r1", b"r2"], [b"ACGT", b"GGCC"], [b"FFFF", b"FFFF"])
+        writer.write_batch((batch, batch), [s1, None])
+        writer.close()
+        stats = DemultiplexStats()
+        stats.add_batch(2, 1, parse=0.1)
+        report = stats.report({"a": 1, "b": 0, "unassigned": 1}, writer)
+        self.assertEqual(report["reads"], 2)
+        self.assertEqual(report["unassigned_reads"], 1)
+        self.assertEqual(report["stage_seconds"], {"parse": 0.1})
+        self.assertEqual(
+            report["samples"],
+            [
+                {"sample": "a", "reads": 1, "bytes": 32},
+                {"sample": "b", "reads": 0, "bytes": 0},
+            ],
+        )
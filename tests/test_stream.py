@@ -0,0 +1,67 @@
+import collections
+import os.path
+import unittest
+
+from src.dnabc.assigner import BarcodeAssigner
+from src.dnabc.seqfile import FastqBatch, IndexFastqSequenceFile
+from src.dnabc.stream import CallbackWriter, demultiplex_batches, sample_batches
+
+MockSample = collections.namedtuple("MockSample", "name barcode")
+
+TEST_DIR = os.path.dirname(os.path.abspath(__file__))
+DATA_DIR = os.path.join(TEST_DIR, "data")
+
+
+class StreamTests(unittest.TestCase):
+    def setUp(self):
+        self.files = [
+            open(os.path.join(DATA_DIR, "tiny_%s.fastq" % read))
+            for read in ("R1", "R2", "I1")
+        ]
+        self.seq_file = IndexFastqSequenceFile(*self.files)
+        self.s1 = MockSample("SampleS1", "GGGGCGCT")
+        self.s2 = MockSample("SampleS2", "CCTTCCTT")
+        self.assigner = BarcodeAssigner([self.s1, self.s2], revcomp=False)
+
+    def tearDown(self):
+        for f in self.files:
+            f.close()
+
+    def test_demultiplex_batches(self):
+        batches = list(demultiplex_batches(self.seq_file, self.assigner))
+        self.assertEqual([sample for sample, _, _ in batches], [self.s1, self.s2])
+        _, fwds, revs = batches[0]
+        self.assertEqual(fwds.descs, ["b"])
+        self.assertEqual(fwds.seqs, ["CAGTCAGACGCGCATCAGATC"])
+        self.assertEqual(revs.seqs, ["GTNNNNNNNNNNNNNNNNNNN"])
+        self.assertEqual(self.assigner.read_counts["unassigned"], 1)
+
+    def test_demultiplex_batches_unassigned(self):
+        batches = demultiplex_batches(self.seq_file, self.assigner, unassigned=True)
+        descs = dict((sample, fwds.descs) for sample, fwds, _ in batches)
+        self.assertEqual(descs, {None: ["a"], self.s1: ["b"], self.s2: ["c"]})
+
+    def test_sample_batches(self):
+        fwds = FastqBatch(["a", "b", "c"], ["A", "C", "G"], ["1", "2", "3"])
+        revs = FastqBatch(["a", "b", "c"], ["T", "G", "C"], ["4", "5", "6"])
+        batches = list(sample_batches(fwds, revs, ["s", None, "s"]))
+        self.assertEqual(len(batches), 1)
+        sample, sample_fwds, sample_revs = batches[0]
+        self.assertEqual(sample, "s")
+        self.assertEqual(list(sample_fwds), [("a", "A", "1"), ("c", "G", "3")])
+        self.assertEqual(list(sample_revs), [("a", "T", "4"), ("c", "C", "6")])
+        # A batch with one sample is passed on as it is
+        batches = list(sample_batches(fwds, revs, ["s", "s", "s"]))
+        self.assertIs(batches[0][1], fwds)
+
+    def test_callback_writer(self):
+        received = []
+
+        def callback(sample, fwds, revs):
+            received.append((sample.name, fwds.descs, revs.descs))
+
+        read_counts = self.seq_file.demultiplex(self.assigner, CallbackWriter(callback))
+        self.assertEqual(
+            received, [("SampleS1", ["b"], ["b"]), ("SampleS2", ["c"], ["c"])]
+        )
+        self.assertEqual(read_counts["SampleS1"], 1)
@@ -1,9 +1,13 @@
 from collections import namedtuple
+import gzip
+from io import BytesIO
 import os.path
 import shutil
 import tempfile
 import unittest
 
+from src.dnabc.gzipio import BGZF_EOF
+from src.dnabc.seqfile import FastqBatch, parse_fastq_batches
 from src.dnabc.writer import FastaWriter, FastqWriter, PairedFastqWriter
 
 MockFastaRead = namedtuple("Read", "desc seq")
@@ -125,6 +129,127 @@ class PairedFastqWriterTests(unittest.TestCase):
             ],
         )
 
+    def test_write_batch(self):
+        s1 = MockSample("ghj")
+        s2 = MockSample("kl;")
+        w = PairedFastqWriter(self.output_dir)
+        fwds = FastqBatch(
+            [b"a", b"b", b"c"], [b"ACG", b"GGT", b"TTA"], [b"#", b"F", b";"]
+        )
+        revs = FastqBatch([b"a", b"b", b"c"], [b"CC", b"GG", b"AA"], [b"1", b"2", b"3"])
+        w.write_batch((fwds, revs), [s1, None, s1])
+        w.write_batch((fwds[1:], revs[1:]), [s2, s1])
+        w.close()
+
+        fp1, fp2 = w._get_output_fp(s1)
+        with open(fp1) as f:
+            self.assertEqual(f.read(), "@a\nACG\n+\n#\n@c\nTTA\n+\n;\n@c\nTTA\n+\n;\n")
+        with open(fp2) as f:
+            self.assertEqual(f.read(), "@a\nCC\n+\n1\n@c\nAA\n+\n3\n@c\nAA\n+\n3\n")
+        with open(w._get_output_fp(s2)[0]) as f:
+            self.assertEqual(f.read(), "@b\nGGT\n+\nF\n")
+
+    def test_write_batch_normalized(self):
+        # Records are formatted again from their fields, not copied from
+        # the input as byte ranges, so the "+" line, line endings and
+        # trailing spaces are normalized as for single reads
+        s1 = MockSample("ghj")
+        data = b"@a 1:N \r\nACG\r\n+a\r\n#F;\r\n@b\nGGT\n+\nF;#\n"
+        (fwds,) = parse_fastq_batches(BytesIO(data))
+        (revs,) = parse_fastq_batches(BytesIO(data))
+        w = PairedFastqWriter(self.output_dir)
+        w.write_batch((fwds, revs), [s1, s1])
+        w.close()
+        with open(w._get_output_fp(s1)[0], "rb") as f:
+            self.assertEqual(f.read(), b"@a 1:N\nACG\n+\n#F;\n@b\nGGT\n+\nF;#\n")
+
+    def test_write_compressed(self):
+        s1 = MockSample("ghj")
+        readpair = (
+            MockFastqRead("Read0", "ACCTTGG", "#######"),
+            MockFastqRead("Read1", "GCTAGCT", ";342dfA"),
+        )
+        for fmt in ["gzip", "bgzf"]:
+            w = PairedFastqWriter(self.output_dir, compress=fmt)
+            w.write(readpair, s1)
+            w.close()
+
+            fp1, fp2 = w._get_output_fp(s1)
+            self.assertTrue(fp1.endswith("ghj_R1.fastq.gz"))
+            with gzip.open(fp1, "rt") as f:
+                self.assertEqual(f.read(), "@Read0\nACCTTGG\n+\n#######\n")
+            with gzip.open(fp2, "rt") as f:
+                self.assertEqual(f.read(), "@Read1\nGCTAGCT\n+\n;342dfA\n")
+
+            f = MockFile()
+            w.write_qiime2_manifest(f)
+            self.assertEqual(f.contents[1], "ghj,{0},forward\n".format(fp1))
+
+    def test_buffer_memory(self):
+        samples = [MockSample("a"), MockSample("b")]
+        w = PairedFastqWriter(self.output_dir, buffer_memory=100)
+        readpair = (
+            MockFastqRead("Read0", "ACCTTGG", "#######"),
+            MockFastqRead("Read1", "GCTAGCT", ";342dfA"),
+        )
+        for _ in range(10):
+            for s in samples:
+                w.write(readpair, s)
+                self.assertLessEqual(w._buffered_bytes, 100)
+        # Reads were written out before the buffer for any file was full
+        fp1, _ = w._get_output_fp(samples[0])
+        self.assertIn(fp1, w._open_files)
+        w.close()
+        self.assertEqual(w._buffered_bytes, 0)
+        with open(fp1) as f:
+            self.assertEqual(f.read(), "@Read0\nACCTTGG\n+\n#######\n" * 10)
+
+    def test_buffer_memory_compressed(self):
+        samples = [MockSample("s%d" % n) for n in range(20)]
+        readpair = (
+            MockFastqRead("Read0", "ACCTTGG", "#######"),
+            MockFastqRead("Read1", "GCTAGCT", ";342dfA"),
+        )
+        w = PairedFastqWriter(self.output_dir, compress="gzip", buffer_memory=1000)
+        for _ in range(20):
+            for s in samples:
+                w.write(readpair, s)
+                # Data handed to the compressors is not held back there
+                compressor_bytes = sum(len(f._buf) for f in w._open_files.values())
+                self.assertLessEqual(w._buffered_bytes + compressor_bytes, 1000)
+        w.close()
+        with gzip.open(w._get_output_fp(samples[0])[0], "rt") as f:
+            self.assertEqual(f.read(), "@Read0\nACCTTGG\n+\n#######\n" * 20)
+
+    def test_max_open_files(self):
+        samples = [MockSample("a"), MockSample("b"), MockSample("c")]
+        for compress in [None, "gzip", "bgzf"]:
+            w = PairedFastqWriter(self.output_dir, compress=compress, max_open_files=2)
+            # Flush to the file after every read
+            w.buffer_size = 1
+            for n in range(4):
+                for s in samples:
+                    readpair = (
+                        MockFastqRead("%s%s" % (s.name, n), "ACGT", "####"),
+                        MockFastqRead("%s%s" % (s.name, n), "TTTT", "FFFF"),
+                    )
+                    w.write(readpair, s)
+                    self.assertLessEqual(len(w._open_files), 2)
+            w.close()
+
+            for s in samples:
+                fp1, fp2 = w._get_output_fp(s)
+                opener = gzip.open if compress else open
+                with opener(fp1, "rt") as f:
+                    obs = f.read()
+                self.assertEqual(
+                    obs,
+                    "".join("@%s%s\nACGT\n+\n####\n" % (s.name, n) for n in range(4)),
+                )
+                if compress == "bgzf":
+                    with open(fp1, "rb") as f:
+                        self.assertEqual(f.read().count(BGZF_EOF), 1)
+
 
 if __name__ == "__main__":
     unittest.main()